@@ -0,0 +1,482 @@
+# Copyright (C) 2022 Robin Jespersen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import codecs
+import json
+import re
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Mapping, NamedTuple, Optional, Tuple, TypeVar
+from urllib.parse import urlsplit
+
+import aiohttp
+
+from backend import Backend
+from metrics import BACKEND_ERRORS, BACKEND_LATENCY
+from models.event import Event
+from models.node import Node
+from models.sample import Sample
+from models.scanned_node import ScannedNode
+from models.server import Server
+
+
+T = TypeVar('T')
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+_DELIMITERS = ' \t\n\r,]'
+# tracked nodes with a change_value and no change_error, see Backend.node_index_requiring_update for the syntax
+_REQUIRING_UPDATE = (
+    'api/server_manager/node/index?filter[tracked]=1&filter[virtual]=0'
+    '&filter[change_value][neq]="NULL"&filter[change_error][in][]=NULL'
+)
+
+
+class _ArrayParser:
+    """
+    parses the elements of a json array from text that is fed in pieces
+    """
+
+    def __init__(self, item: Callable[[Any], T]):
+        self.item = item
+        self.items: List[T] = []
+        self._decoder = json.JSONDecoder()
+        self._buffer = ''
+        self._position = 0
+        # what comes next: '[', 'first' element or ']', 'value', ',' or ']', 'done'
+        self._expect = '['
+
+    def feed(self, text: str, eof: bool) -> bool:
+        """
+        returns True once the array is complete
+        """
+        buffer = self._buffer = self._buffer[self._position:] + text
+        self._position = 0
+        while self._expect != 'done':
+            self._position = _WHITESPACE.match(buffer, self._position).end()
+            if self._position == len(buffer):
+                return False
+            char = buffer[self._position]
+            if self._expect == ',' and char == ',':
+                self._expect = 'value'
+                self._position += 1
+            elif self._expect in ('first', 'value') and char not in ',]':
+                if not self._value(eof):
+                    return False
+            else:
+                self._delimiter(char)
+        return True
+
+    def _delimiter(self, char: str):
+        if self._expect == '[' and char == '[':
+            self._expect = 'first'
+        elif self._expect in ('first', ',') and char == ']':
+            self._expect = 'done'
+        elif self._expect == '[':
+            raise ValueError(f'expected a json array, got {self._buffer[self._position:self._position + 20]!r}')
+        else:
+            raise ValueError(f'unexpected {char!r} in json array')
+        self._position += 1
+
+    def _value(self, eof: bool) -> bool:
+        try:
+            value, end = self._decoder.raw_decode(self._buffer, self._position)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            return False
+        # an element is complete once it is followed by a delimiter, a number may continue in the next piece
+        if not eof and (end == len(self._buffer) or self._buffer[end] not in _DELIMITERS):
+            return False
+        self.items.append(self.item(value))
+        self._position = end
+        self._expect = ','
+        return True
+
+
+async def parse_array(stream: aiohttp.StreamReader, item: Callable[[Any], T], chunk_size: int = 2 ** 16) -> List[T]:
+    """
+    parses a json array while it is received, every element is passed to item
+    as soon as it is complete, so neither the whole text nor all parsed
+    elements are in memory at the same time
+    """
+    parser = _ArrayParser(item)
+    text = codecs.getincrementaldecoder('utf-8')()
+    while True:
+        chunk = await stream.read(chunk_size)
+        eof = not chunk
+        if parser.feed(text.decode(chunk, final=eof), eof):
+            return parser.items
+        if eof:
+            raise ValueError('unexpected end of json array')
+
+
+class BackendResponse(NamedTuple):
+    status_code: int
+    text: str
+    headers: Mapping[str, str] = {}
+
+
+class AsyncBackend:
+    """
+    asyncio variant of Backend
+
+    All requests share one keep-alive connection pool, the number of requests
+    in flight at the same time is limited to max_connections.
+
+    Listings are parsed while they are received. With a page_size they are
+    requested page by page, after the first page all others at the same time.
+    """
+    API_URL: str
+    ACCESS_TOKEN: str
+
+    def __init__(
+        self,
+        api_url: str,
+        access_token: str,
+        max_connections: int = 10,
+        timeout: float = 30,
+        page_size: int = 0,
+    ):
+        self.API_URL = api_url
+        self.ACCESS_TOKEN = access_token
+        self.max_connections = max_connections
+        self.page_size = page_size
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._etags: Dict[str, str] = {}
+        self._batch_update = True
+        self._batch_store = True
+
+    async def __aenter__(self) -> 'AsyncBackend':
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def available(self) -> bool:
+        response = await self._request('GET', f'{self.API_URL}/api/status/ping', auth=False)
+        return response.status_code == 200
+
+    async def server_index(self) -> List[Server]:
+        return await self._list(f'{self.API_URL}/api/server_manager/server/index', Server)
+
+    async def node_index_filtered(self) -> List[Node]:
+        return await self._list(
+            f'{self.API_URL}/api/server_manager/node/index?filter[tracked]=1&filter[virtual]=0',
+            Node,
+        )
+
+    async def server_index_changed(self) -> Optional[List[Server]]:
+        """
+        like server_index(), but returns None if the list did not change since the last call
+        """
+        return await self._list(f'{self.API_URL}/api/server_manager/server/index', Server, conditional=True)
+
+    async def node_index_changed(self, updated_since: Optional[int] = None) -> Optional[List[Node]]:
+        """
+        returns all tracked nodes, with updated_since all nodes updated since then whether tracked or not,
+        returns None if the result did not change since the last call
+        """
+        if updated_since is None:
+            url = f'{self.API_URL}/api/server_manager/node/index?filter[tracked]=1&filter[virtual]=0'
+        else:
+            url = f'{self.API_URL}/api/server_manager/node/index?filter[updated_at][gte]={updated_since}'
+        # one ETag for both, the query changes with every watermark and a stale ETag only costs a full response
+        return await self._list(url, Node, conditional=True, key='node_index_changed')
+
+    async def node_index_requiring_update(self) -> List[Node]:
+        return await self._list(f'{self.API_URL}/{_REQUIRING_UPDATE}', Node)
+
+    async def node_index_requiring_update_changed(self) -> Optional[List[Node]]:
+        """
+        like node_index_requiring_update(), but returns None if the list did not change since the last call
+        """
+        return await self._list(f'{self.API_URL}/{_REQUIRING_UPDATE}', Node, conditional=True)
+
+    async def node_value_writen(self, id: int):
+        data = {
+            'change_value': None,
+            'change_error_at': None,
+            'change_error': None,
+        }
+        await self.node_update(id, data)
+
+    async def node_value_writing_error(self, id: int, error: str):
+        data = {
+            'change_error_at': round(time.time()),
+            'change_error': error,
+        }
+        await self.node_update(id, data)
+
+    async def node_update(self, id: int, data: map) -> BackendResponse:
+        return await self._request(
+            'PATCH',
+            f'{self.API_URL}/api/server_manager/node/update?id={id}',
+            headers={"Content-Type": "application/json"},
+            data=json.dumps(data),
+        )
+
+    async def node_update_batch(self, updates: Dict[int, dict]) -> List[int]:
+        """
+        updates multiple nodes with one request, falls back to one request per node
+        if the API does not support batch updates, returns the ids of the nodes updated
+        """
+        if self._batch_update:
+            response = await self._request(
+                'PATCH',
+                f'{self.API_URL}/api/server_manager/node/update-batch',
+                headers={"Content-Type": "application/json"},
+                data=json.dumps([{'id': id, **data} for id, data in updates.items()]),
+            )
+            if response.status_code not in (404, 405):
+                return list(updates) if response.status_code < 300 else []
+            self._batch_update = False
+        updated = []
+        for id, data in updates.items():
+            if (await self.node_update(id, data)).status_code < 300:
+                updated.append(id)
+        return updated
+
+    async def influx_store(self, server_id: int, node_identifier: str, timestamp: int, value) -> BackendResponse:
+        data = {
+            "server_id": server_id,
+            "node_id": node_identifier,
+            "time": timestamp,
+            "value": json.dumps(value),
+        }
+        return await self._request(
+            'POST',
+            f'{self.API_URL}/api/server_manager/influx/store',
+            data=data,
+        )
+
+    async def influx_store_batch(self, samples: List[Sample]) -> BackendResponse:
+        """
+        stores multiple samples with one request, the values are embedded as json,
+        time is in nanoseconds and status the OPC UA status code. Falls back to one
+        influx_store() per sample, without the status, if the API does not support
+        batch stores.
+        """
+        if self._batch_store:
+            data = [
+                {
+                    "server_id": sample.server_id,
+                    "node_id": sample.node_id,
+                    "time": sample.time,
+                    "value": sample.value,
+                    "status": sample.status,
+                }
+                for sample in samples
+            ]
+            response = await self._request(
+                'POST',
+                f'{self.API_URL}/api/server_manager/influx/store-batch',
+                headers={"Content-Type": "application/json"},
+                data=json.dumps(data),
+            )
+            if response.status_code not in (404, 405):
+                return response
+            self._batch_store = False
+        # influx_store() takes the time in seconds
+        responses = await asyncio.gather(*[
+            self.influx_store(sample.server_id, sample.node_id, round(sample.time / 10 ** 9), sample.value)
+            for sample in samples
+        ])
+        return next((response for response in responses if response.status_code != 200), BackendResponse(200, ''))
+
+    async def event_store_batch(self, events: List[Event]) -> BackendResponse:
+        """
+        stores multiple events with one request, time is in nanoseconds
+        """
+        data = [
+            {
+                "server_id": event.server_id,
+                "time": event.time,
+                "fields": event.fields,
+            }
+            for event in events
+        ]
+        return await self._request(
+            'POST',
+            f'{self.API_URL}/api/server_manager/event/store-batch',
+            headers={"Content-Type": "application/json"},
+            data=json.dumps(data),
+        )
+
+    async def node_store_batch(self, server_id: int, nodes: List[ScannedNode]) -> BackendResponse:
+        """
+        creates or updates the nodes of the server found by a scan, nodes are matched by their identifier
+        """
+        data = [
+            {
+                "server_id": server_id,
+                "identifier": node.identifier,
+                "display_name": node.display_name,
+                "path": node.path,
+                "data_type": node.data_type,
+                "readable": node.readable,
+                "writable": node.writable,
+                "parent_identifier": node.parent_identifier,
+            }
+            for node in nodes
+        ]
+        return await self._request(
+            'POST',
+            f'{self.API_URL}/api/server_manager/node/store-batch',
+            headers={"Content-Type": "application/json"},
+            data=json.dumps(data),
+        )
+
+    async def server_scanned(self, server_id: int):
+        await self._request(
+            'PATCH',
+            f'{self.API_URL}/api/server_manager/server/update?id={server_id}',
+            data={'scan_required': 0},
+        )
+
+    async def server_update(self, server_id: int, connection_error: str = ''):
+        checked_at: int = round(time.time() + 5)  # hack
+
+        data = {
+            'checked_at': checked_at,
+        }
+        if connection_error == '':
+            data['has_connection_error'] = 0
+            data['connection_error'] = ''
+        else:
+            data['has_connection_error'] = 1
+            data['connection_error'] = connection_error
+
+        await self._request(
+            'PATCH',
+            f'{self.API_URL}/api/server_manager/server/update?id={server_id}',
+            data=data,
+        )
+
+    object_to_dict = Backend.object_to_dict
+
+    def _get_headers(self):
+        return {"Authorization": f"Bearer {self.ACCESS_TOKEN}"}
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        # created lazily because the session has to be bound to the running loop
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.max_connections)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+            self._semaphore = asyncio.Semaphore(self.max_connections)
+        return self._session
+
+    async def _request(self, method: str, url: str, auth: bool = True, headers: dict = None, **kwargs) -> BackendResponse:
+        status, response_headers, text = await self._send(
+            method, url, lambda response: response.text(), auth, headers, **kwargs,
+        )
+        return BackendResponse(status, text, response_headers)
+
+    async def _send(
+        self,
+        method: str,
+        url: str,
+        read: Callable[[aiohttp.ClientResponse], Awaitable[T]],
+        auth: bool = True,
+        headers: dict = None,
+        **kwargs,
+    ) -> Tuple[int, Mapping[str, str], T]:
+        """
+        sends a request and reads the response with read, returns the status code, headers and what was read
+        """
+        session = self._get_session()
+        request_headers = self._get_headers() if auth else {}
+        if headers is not None:
+            request_headers.update(headers)
+        endpoint = '/' + urlsplit(url).path.lstrip('/')
+        async with self._semaphore:
+            started = time.perf_counter()
+            try:
+                async with session.request(method, url, headers=request_headers, **kwargs) as response:
+                    result = (response.status, response.headers, await read(response))
+            except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+                BACKEND_ERRORS.labels(method, endpoint, type(error).__name__).inc()
+                raise
+            finally:
+                BACKEND_LATENCY.labels(method, endpoint).observe(time.perf_counter() - started)
+        if result[0] >= 400:
+            BACKEND_ERRORS.labels(method, endpoint, str(result[0])).inc()
+        return result
+
+    async def _list(
+        self,
+        url: str,
+        item: Callable[[dict], T],
+        conditional: bool = False,
+        key: Optional[str] = None,
+    ) -> Optional[List[T]]:
+        """
+        GET request of a listing, returns its elements converted by item.
+        A conditional request returns None if the listing did not change since
+        the last one with the same key (the url by default), which is only known
+        for listings that are not paged.
+        """
+        separator = '&' if '?' in url else '?'
+        if self.page_size <= 0:
+            key = url if key is None else key
+            headers = {}
+            if conditional and key in self._etags:
+                headers['If-None-Match'] = self._etags[key]
+            status, response_headers, items = await self._send(
+                'GET', f'{url}{separator}pageSize=-1', self._read_list(item), headers=headers,
+            )
+            if status == 304:
+                return None
+            if conditional:
+                if 'ETag' in response_headers:
+                    self._etags[key] = response_headers['ETag']
+                else:
+                    self._etags.pop(key, None)
+            return items
+
+        # a fixed order keeps the pages from overlapping
+        page_url = f'{url}{separator}sort=id&pageSize={self.page_size}&page='
+        _, response_headers, items = await self._send('GET', f'{page_url}1', self._read_list(item))
+        page_count = response_headers.get('X-Pagination-Page-Count')
+        if page_count is not None:
+            pages = await asyncio.gather(*[
+                self._send('GET', f'{page_url}{page}', self._read_list(item)) for page in range(2, int(page_count) + 1)
+            ])
+            for _, _, page_items in pages:
+                items.extend(page_items)
+            return items
+        # without the page count pages are requested until one is not full
+        page = 1
+        page_items = items
+        while len(page_items) >= self.page_size:
+            page += 1
+            _, _, page_items = await self._send('GET', f'{page_url}{page}', self._read_list(item))
+            items.extend(page_items)
+        return items
+
+    @staticmethod
+    def _read_list(item: Callable[[dict], T]) -> Callable[[aiohttp.ClientResponse], Awaitable[List[T]]]:
+        async def read(response: aiohttp.ClientResponse) -> List[T]:
+            if response.status == 304:
+                return []
+            response.raise_for_status()
+            return await parse_array(response.content, item)
+        return read
@@ -0,0 +1,291 @@
+#!/usr/local/bin/python3
+# Copyright (C) 2022 Robin Jespersen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Load test of the whole collector. Starts a fleet of local OPC UA servers whose
+variables change at a fixed rate and a mock of the /api/server_manager
+endpoints, runs main.py against both in its own process and reports
+
+- startup: seconds from starting the collector to the first sample of every node
+- samples/s stored through store-batch once all nodes are subscribed
+- latency percentiles from the server timestamp of a value to its arrival at the API
+- cpu of the collector process while measuring and its peak rss
+
+The fleet runs in separate processes so it does not compete with the mock API
+for the event loop. With --min-rate or --max-p99 the exit code is 1 when the
+result is worse, --json writes the report for comparing runs in CI.
+
+usage: python app/benchmarks/bench_fleet.py [--servers 10] [--variables 100] [--rate 1] [--duration 30]
+                                            [--env KEY=VALUE ...] [--json report.json]
+"""
+
+import argparse
+import asyncio
+import datetime
+import json
+import multiprocessing
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+from typing import Dict, List, Optional, Set, Tuple
+
+from aiohttp import web
+import asyncua
+from asyncua import ua
+
+APP = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+async def run_fleet(servers: int, variables: int, rate: float, urls, stop):
+    """
+    runs the servers of one fleet process until stop is set, sends the url and
+    the identifiers of the variables of every server to urls
+    """
+    running = []
+    for _ in range(servers):
+        server = asyncua.Server()
+        await server.init()
+        url = f'opc.tcp://127.0.0.1:{free_port()}/'
+        server.set_endpoint(url)
+        idx = await server.register_namespace('urn:opcua_collector:bench')
+        folder = await server.nodes.objects.add_object(idx, 'Bench')
+        nodes = [await folder.add_variable(idx, f'Variable{i}', 0.0) for i in range(variables)]
+        await server.start()
+        running.append((server, nodes))
+        urls.put((url, [node.nodeid.to_string() for node in nodes]))
+
+    async def change(server: asyncua.Server, nodes: List[asyncua.Node]):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time()
+        value = 0.0
+        while True:
+            value += 1
+            now = datetime.datetime.now(datetime.timezone.utc)
+            for node in nodes:
+                data_value = ua.DataValue(ua.Variant(value, ua.VariantType.Double), SourceTimestamp=now, ServerTimestamp=now)
+                await server.write_attribute_value(node.nodeid, data_value)
+            deadline += 1 / rate
+            await asyncio.sleep(max(0.0, deadline - loop.time()))
+
+    tasks = [asyncio.create_task(change(server, nodes)) for server, nodes in running]
+    while not stop.is_set():
+        await asyncio.sleep(0.1)
+    for task in tasks:
+        task.cancel()
+    for server, _ in running:
+        await server.stop()
+
+
+def fleet_process(servers: int, variables: int, rate: float, urls, stop):
+    asyncio.run(run_fleet(servers, variables, rate, urls, stop))
+
+
+class MockApi:
+    """
+    Answers the requests of the collector like the API with a fixed list of
+    servers and tracked nodes, records the samples sent to store-batch.
+    """
+
+    def __init__(self, servers: Dict[str, List[str]]):
+        now = int(time.time())
+        self.servers = []
+        self.nodes = []
+        for server_id, (url, identifiers) in enumerate(servers.items(), 1):
+            self.servers.append({
+                'id': server_id, 'created_at': 0, 'updated_at': 0, 'created_by': 0, 'updated_by': 0, 'sort': 0,
+                'name': f'server {server_id}', 'url': url, 'description': '', 'checked_at': now + 3600,
+                'scan_required': False, 'has_connection_error': False, 'connection_error': '', 'root_node': 'i=85',
+            })
+            for identifier in identifiers:
+                self.nodes.append({
+                    'id': len(self.nodes) + 1, 'created_at': 0, 'updated_at': 0, 'created_by': 0, 'updated_by': 0,
+                    'server_id': server_id, 'identifier': identifier, 'display_name': identifier,
+                    'checked_at': 0, 'tracked': True, 'path': '', 'data_type': 'Double', 'readable': True,
+                    'writable': False, 'virtual': False, 'parent_identifier': None, 'change_value': None,
+                    'change_error_at': None, 'change_error': None,
+                })
+
+        self.seen: Set[Tuple[int, str]] = set()
+        self.subscribed_at: Optional[float] = None
+        self.measuring = False
+        self.samples = 0
+        self.latencies: List[float] = []
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=1024 ** 3)
+        app.router.add_get('/api/server_manager/server/index', self.server_index)
+        app.router.add_get('/api/server_manager/node/index', self.node_index)
+        app.router.add_post('/api/server_manager/influx/store-batch', self.store_batch)
+        app.router.add_route('*', '/{path:.*}', self.ok)
+        return app
+
+    async def server_index(self, request: web.Request) -> web.Response:
+        return web.json_response(self.servers)
+
+    async def node_index(self, request: web.Request) -> web.Response:
+        # nothing changes and nothing is written
+        if 'change_value' in request.query_string or 'updated_at' in request.query_string:
+            return web.json_response([])
+        return web.json_response(self.nodes)
+
+    async def store_batch(self, request: web.Request) -> web.Response:
+        received = time.time_ns()
+        samples = await request.json()
+        if self.subscribed_at is None:
+            self.seen.update((sample['server_id'], sample['node_id']) for sample in samples)
+            if len(self.seen) >= len(self.nodes):
+                self.subscribed_at = time.monotonic()
+        if self.measuring:
+            self.samples += len(samples)
+            self.latencies.extend((received - sample['time']) / 1e9 for sample in samples)
+        return web.Response()
+
+    async def ok(self, request: web.Request) -> web.Response:
+        return web.json_response([])
+
+
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return float('nan')
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def cpu_seconds(pid: int) -> Optional[float]:
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+    except OSError:
+        return None
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+async def bench(args) -> dict:
+    urls = multiprocessing.Queue()
+    stop = multiprocessing.Event()
+    processes = []
+    for i in range(args.fleet_processes):
+        count = args.servers // args.fleet_processes + (1 if i < args.servers % args.fleet_processes else 0)
+        if count:
+            process = multiprocessing.Process(
+                target=fleet_process, args=(count, args.variables, args.rate, urls, stop), daemon=True,
+            )
+            process.start()
+            processes.append(process)
+    servers = {}
+    loop = asyncio.get_running_loop()
+    while len(servers) < args.servers:
+        url, identifiers = await loop.run_in_executor(None, urls.get)
+        servers[url] = identifiers
+
+    api = MockApi(servers)
+    runner = web.AppRunner(api.app(), access_log=None)
+    await runner.setup()
+    port = free_port()
+    await web.TCPSite(runner, '127.0.0.1', port).start()
+
+    env = dict(os.environ, API_URL=f'http://127.0.0.1:{port}', ACCESS_TOKEN='bench')
+    env.update(variable.split('=', 1) for variable in args.env)
+    log = open(args.collector_log, 'w') if args.collector_log else subprocess.DEVNULL
+    started = time.monotonic()
+    collector = subprocess.Popen([sys.executable, 'main.py'], cwd=APP, env=env, stdout=log, stderr=log)
+    report = {
+        'servers': args.servers,
+        'variables': args.servers * args.variables,
+        'rate': args.rate,
+        'expected_samples_per_second': args.servers * args.variables * args.rate,
+    }
+    try:
+        while api.subscribed_at is None:
+            if collector.poll() is not None:
+                raise RuntimeError(f'collector exited with {collector.returncode}')
+            if time.monotonic() - started > args.startup_timeout:
+                raise RuntimeError(f'only {len(api.seen)} of {len(api.nodes)} nodes subscribed')
+            await asyncio.sleep(0.05)
+        report['startup_seconds'] = api.subscribed_at - started
+
+        cpu = cpu_seconds(collector.pid)
+        measured = time.monotonic()
+        api.measuring = True
+        await asyncio.sleep(args.duration)
+        api.measuring = False
+        elapsed = time.monotonic() - measured
+        cpu_end = cpu_seconds(collector.pid)
+    finally:
+        collector.send_signal(signal.SIGINT)
+        try:
+            _, _, usage = await loop.run_in_executor(None, os.wait4, collector.pid, 0)
+        except ChildProcessError:
+            usage = None
+        stop.set()
+        for process in processes:
+            process.join(10)
+        await runner.cleanup()
+        if log is not subprocess.DEVNULL:
+            log.close()
+
+    latencies = sorted(api.latencies)
+    report['samples_per_second'] = api.samples / elapsed
+    for name, p in [('p50', 0.5), ('p90', 0.9), ('p99', 0.99), ('max', 1)]:
+        report[f'latency_{name}_seconds'] = percentile(latencies, p)
+    report['cpu_percent'] = (cpu_end - cpu) / elapsed * 100 if cpu is not None and cpu_end is not None else None
+    # ru_maxrss is in kilobytes on linux
+    report['max_rss_mb'] = usage.ru_maxrss / 1024 if usage is not None else None
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--servers', type=int, default=10)
+    parser.add_argument('--variables', type=int, default=100, help='changing variables per server')
+    parser.add_argument('--rate', type=float, default=1, help='changes per variable and second')
+    parser.add_argument('--duration', type=float, default=30, help='seconds to measure after startup')
+    parser.add_argument('--startup-timeout', type=float, default=120)
+    parser.add_argument('--fleet-processes', type=int, default=max(1, min(4, (os.cpu_count() or 2) - 1)))
+    parser.add_argument('--env', action='append', default=[], metavar='KEY=VALUE', help='setting of the collector')
+    parser.add_argument('--collector-log', help='file for the output of the collector')
+    parser.add_argument('--json', help='file to write the report to')
+    parser.add_argument('--min-rate', type=float, help='fail below this many samples/s')
+    parser.add_argument('--max-p99', type=float, help='fail above this p99 latency in seconds')
+    args = parser.parse_args()
+
+    report = asyncio.run(bench(args))
+    for name, value in report.items():
+        print(f'{name:<30} {value:>12.3f}' if isinstance(value, float) else f'{name:<30} {value!s:>12}')
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    failed = []
+    if args.min_rate is not None and report['samples_per_second'] < args.min_rate:
+        failed.append(f'samples/s {report["samples_per_second"]:.1f} < {args.min_rate}')
+    if args.max_p99 is not None and not report['latency_p99_seconds'] <= args.max_p99:
+        failed.append(f'p99 latency {report["latency_p99_seconds"]:.3f}s > {args.max_p99}s')
+    for failure in failed:
+        print(f'regression: {failure}')
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+#!/usr/local/bin/python3
+# Copyright (C) 2022 Robin Jespersen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Compares the per sample cost of the old recursive Backend.object_to_dict with
+the cached Serializer, including the json encoding of the result. Values the
+old implementation could not encode are reported as nan.
+
+usage: python app/benchmarks/bench_serializer.py [samples]
+"""
+
+import dataclasses
+import datetime
+import json
+import os
+import sys
+import timeit
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from serializer import Serializer  # noqa: E402
+
+
+def legacy_object_to_dict(value):
+    """
+    Backend.object_to_dict before the Serializer was introduced
+    """
+    if value is None:
+        return value
+    if type(value) in [str, int, float, list, dict, set, tuple]:
+        return value
+    if isinstance(value, bool):
+        return int(value)
+    if isinstance(value, datetime.datetime):
+        return str(round(value.timestamp()))
+
+    value = value.__dict__
+    values = {}
+    for key in value.keys():
+        if (key.startswith('__') and key.endswith('__')):
+            continue
+        values[key] = legacy_object_to_dict(value[key])
+    return values
+
+
+@dataclasses.dataclass
+class Axis:
+    Position: float = 0.0
+    Velocity: float = 0.0
+    Torque: float = 0.0
+    Enabled: bool = True
+    Error: int = 0
+
+
+@dataclasses.dataclass
+class Machine:
+    Name: str = 'machine 1'
+    Started: datetime.datetime = dataclasses.field(default_factory=datetime.datetime.now)
+    X: Axis = dataclasses.field(default_factory=Axis)
+    Y: Axis = dataclasses.field(default_factory=Axis)
+    Z: Axis = dataclasses.field(default_factory=Axis)
+    Counter: int = 0
+
+
+VALUES = {
+    'float': 1.5,
+    'bool': True,
+    'string': 'running',
+    'float[1000]': [float(i) for i in range(1000)],
+    'struct': Machine(),
+    'struct[10]': [Machine() for _ in range(10)],
+}
+
+
+def measure(convert, value, number: int) -> float:
+    """
+    returns the best time per sample in µs, or nan if the value cannot be encoded
+    """
+    try:
+        json.dumps(convert(value))
+    except (TypeError, AttributeError):
+        return float('nan')
+    return min(timeit.repeat(lambda: json.dumps(convert(value)), number=number, repeat=5)) / number * 1e6
+
+
+def main():
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    serializer = Serializer()
+    print(f'{"value":<12} {"legacy µs":>10} {"cached µs":>10} {"speedup":>8}')
+    for name, value in VALUES.items():
+        legacy = measure(legacy_object_to_dict, value, number)
+        cached = measure(serializer, value, number)
+        print(f'{name:<12} {legacy:>10.2f} {cached:>10.2f} {legacy / cached:>7.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,249 @@
+# Copyright (C) 2022 Robin Jespersen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import math
+from typing import Dict, List, NamedTuple, Optional
+
+from asyncua import ua
+
+from models.node import Node as NodeModel
+from models.sample import Sample
+from type_cache import parse_node_id
+
+KINDS = ('dedup', 'deadband', 'swinging_door', 'aggregate')
+
+# sample times are nanoseconds, the policies are configured in seconds
+_NS = 1000000000
+
+
+class CompressionPolicy(NamedTuple):
+    kind: Optional[str] = None
+    deviation: float = 0
+    max_interval: float = 3600
+    window: float = 60
+
+    def of(self, node: NodeModel) -> 'CompressionPolicy':
+        """
+        policy of the node, settings the node does not set are taken from self
+        """
+        return CompressionPolicy(
+            self.kind if node.compression is None else node.compression,
+            self.deviation if node.compression_deviation is None else node.compression_deviation,
+            self.max_interval if node.compression_max_interval is None else node.compression_max_interval,
+            self.window if node.compression_window is None else node.compression_window,
+        )
+
+
+def _numeric(value) -> bool:
+    return type(value) in (int, float) and math.isfinite(value)
+
+
+class Compressor:
+    """
+    Decides which samples of one node are stored.
+
+    put() returns the samples to store for a new sample, expire() the samples
+    that are due because no new sample arrived. Every max_interval seconds at
+    least one sample is stored while samples arrive.
+    """
+
+    def __init__(self, policy: CompressionPolicy):
+        self.policy = policy
+        self.max_interval = int(policy.max_interval * _NS)
+        # last stored sample and the latest sample that was not stored
+        self.stored: Optional[Sample] = None
+        self.held: Optional[Sample] = None
+
+    def put(self, sample: Sample) -> List[Sample]:
+        if self.stored is None or self._store(sample):
+            return self._emit(sample)
+        if sample.time - self.stored.time >= self.max_interval:
+            return self._emit(sample)
+        self.held = sample
+        return []
+
+    def expire(self, now: float) -> List[Sample]:
+        """
+        now in nanoseconds
+        """
+        if self.held is not None and now - self.stored.time >= self.max_interval:
+            return self._emit(self.held)
+        return []
+
+    def _store(self, sample: Sample) -> bool:
+        return sample.value != self.stored.value or sample.status != self.stored.status
+
+    def _emit(self, sample: Sample) -> List[Sample]:
+        self.stored = sample
+        self.held = None
+        return [sample]
+
+
+class DeadbandCompressor(Compressor):
+    def _store(self, sample: Sample) -> bool:
+        if _numeric(sample.value) and _numeric(self.stored.value):
+            return abs(sample.value - self.stored.value) > self.policy.deviation or sample.status != self.stored.status
+        return sample.value != self.stored.value or sample.status != self.stored.status
+
+
+class SwingingDoorCompressor(Compressor):
+    """
+    Swinging door trending: a sample is stored once the line from the last
+    stored sample can no longer pass within deviation of every sample since,
+    the stored sample is the last one that still fit.
+    """
+
+    def __init__(self, policy: CompressionPolicy):
+        super().__init__(policy)
+        self.upper = math.inf
+        self.lower = -math.inf
+
+    def put(self, sample: Sample) -> List[Sample]:
+        if self.stored is None or sample.status != self.stored.status \
+                or not (_numeric(sample.value) and _numeric(self.stored.value)):
+            return self.expire(math.inf) + self._emit(sample)
+        stored = []
+        if sample.time - self.stored.time >= self.max_interval and self.held is not None:
+            stored = self._emit(self.held)
+        elif not self._fits(sample) and self.held is not None:
+            # the door closed, the previous sample starts the next segment
+            stored = self._emit(self.held)
+        if not self._fits(sample):
+            return stored + self._emit(sample)
+        self.held = sample
+        return stored
+
+    def _fits(self, sample: Sample) -> bool:
+        elapsed = (sample.time - self.stored.time) / _NS
+        if elapsed <= 0:
+            return abs(sample.value - self.stored.value) <= self.policy.deviation
+        upper = min(self.upper, (sample.value + self.policy.deviation - self.stored.value) / elapsed)
+        lower = max(self.lower, (sample.value - self.policy.deviation - self.stored.value) / elapsed)
+        if lower > upper:
+            return False
+        self.upper, self.lower = upper, lower
+        return True
+
+    def _emit(self, sample: Sample) -> List[Sample]:
+        self.upper = math.inf
+        self.lower = -math.inf
+        return super()._emit(sample)
+
+
+class AggregateCompressor(Compressor):
+    """
+    Stores min, max, mean and count of every window instead of the samples,
+    non numeric values are stored as they are.
+    """
+
+    def __init__(self, policy: CompressionPolicy):
+        super().__init__(policy)
+        self.window = int(policy.window * _NS)
+        self.start: Optional[int] = None
+        self.values: List[float] = []
+        self.last: Optional[Sample] = None
+
+    def put(self, sample: Sample) -> List[Sample]:
+        if not _numeric(sample.value) or sample.status != 0:
+            # bad and uncertain values are not aggregated
+            return self.expire(math.inf) + [sample]
+        start = sample.time - sample.time % self.window
+        stored = self.expire(start) if self.start != start else []
+        self.start = start
+        self.values.append(sample.value)
+        self.last = sample
+        return stored
+
+    def expire(self, now: float) -> List[Sample]:
+        if not self.values or now < self.start + self.window:
+            return []
+        values = self.values
+        sample = Sample(self.last.server_id, self.last.node_id, self.start, {
+            'min': min(values),
+            'max': max(values),
+            'mean': sum(values) / len(values),
+            'count': len(values),
+        })
+        self.values = []
+        self.start = None
+        return [sample]
+
+
+_COMPRESSORS = {
+    'dedup': Compressor,
+    'deadband': DeadbandCompressor,
+    'swinging_door': SwingingDoorCompressor,
+    'aggregate': AggregateCompressor,
+}
+
+
+class Compression:
+    """
+    Compressors of the nodes of one server, keyed by the node id as received in notifications.
+
+    The state is kept across reconnects, values the server sends again after
+    reconnecting are suppressed like any other repeated value.
+    """
+
+    def __init__(self, defaults: CompressionPolicy = CompressionPolicy()):
+        self.defaults = defaults
+        self.compressors: Dict[str, Compressor] = {}
+        self.identifiers: Dict[int, str] = {}
+        self.suppressed: int = 0
+
+    def configure(self, changes: Dict[int, Optional[NodeModel]]):
+        """
+        sets the policy of changed nodes, None removes the node
+        """
+        for node_id, node in changes.items():
+            if node is not None and node_id in self.identifiers:
+                compressor = self.compressors.get(self.identifiers[node_id])
+                if compressor is not None and compressor.policy == self.defaults.of(node) \
+                        and self.identifiers[node_id] == _normalize(node.identifier):
+                    # unchanged, keep the state
+                    continue
+            if node_id in self.identifiers:
+                self.compressors.pop(self.identifiers.pop(node_id), None)
+            if node is None:
+                continue
+            policy = self.defaults.of(node)
+            if policy.kind not in _COMPRESSORS:
+                if policy.kind is not None:
+                    print(f'unknown compression {policy.kind!r} of node {node_id}')
+                continue
+            self.identifiers[node_id] = _normalize(node.identifier)
+            self.compressors[self.identifiers[node_id]] = _COMPRESSORS[policy.kind](policy)
+
+    def put(self, sample: Sample) -> List[Sample]:
+        compressor = self.compressors.get(sample.node_id)
+        if compressor is None:
+            return [sample]
+        samples = compressor.put(sample)
+        if not samples:
+            self.suppressed += 1
+        return samples
+
+    def expire(self, now: float) -> List[Sample]:
+        samples = []
+        for compressor in self.compressors.values():
+            samples.extend(compressor.expire(now))
+        return samples
+
+
+def _normalize(identifier: str) -> str:
+    try:
+        return parse_node_id(identifier).to_string()
+    except (ua.UaError, ValueError):
+        return identifier
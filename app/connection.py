@@ -0,0 +1,504 @@
+# Copyright (C) 2022 Robin Jespersen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import enum
+import math
+import random
+import time
+from concurrent.futures import CancelledError
+from typing import Dict, Iterable, Optional, Union
+
+import aiohttp
+import asyncua
+from asyncua.client.ua_client import UaClientState
+from asyncua import ua
+from asyncua.ua import UaError, UaStatusCodeError
+
+from async_backend import AsyncBackend
+from compression import Compression, CompressionPolicy
+from encoder import EncoderPool
+from events import EventSettings, subscribe_events
+from ingest import IngestQueue
+from last_values import LastValueCache
+from metrics import CONNECTION_ATTEMPTS
+from models.server import Server
+from monitored_items import MonitoringSettings
+from operation_limits import read_operation_limits
+from polling import Polling
+from sub_handler import SubHandler
+from subscriptions import Subscriptions
+from type_cache import TypeCache
+
+
+class ConnectionState(enum.Enum):
+    CONNECTING = 'connecting'
+    CONNECTED = 'connected'
+    RECONNECTING = 'reconnecting'
+    BACKOFF = 'backoff'
+    FAILED = 'failed'
+
+
+class ServerConnection:
+    """
+    Connection to a single OPC UA server.
+
+    A failed connection attempt is retried after an exponential backoff with
+    jitter, after max_attempts failed attempts in a row the connection stays in
+    the FAILED state until the url of the server is changed.
+
+    A lost connection is noticed by the client's watchdog within
+    watchdog_interval seconds, the client then reactivates the session and
+    transfers its subscriptions, missed notifications are republished. If that
+    does not succeed within reconnect_timeout seconds the client is dropped and
+    the server connected again from scratch. The data type definitions come
+    from the TypeCache, the operation limits are read again only when their key
+    changes.
+
+    Servers in the polling acquisition mode are read cyclically by Polling
+    instead of being subscribed to, it takes the place of the subscriptions.
+
+    With events enabled for the server its events are subscribed to as well
+    and queued to events. A status change of any subscription is reported to
+    the backend as soon as it is received. Received values are converted to
+    samples by the workers of encoder.
+    """
+
+    def __init__(
+        self,
+        server: Server,
+        backend: AsyncBackend,
+        ingest: IngestQueue,
+        timeout: float = 10,
+        min_backoff: float = 1,
+        max_backoff: float = 300,
+        max_attempts: int = 0,
+        max_items_per_call: int = 1000,
+        defaults: MonitoringSettings = MonitoringSettings(),
+        cache: Optional[LastValueCache] = None,
+        compression: CompressionPolicy = CompressionPolicy(),
+        timestamp_source: str = 'server',
+        watchdog_interval: float = 5,
+        reconnect_timeout: float = 60,
+        types: Optional[TypeCache] = None,
+        acquisition_mode: str = 'subscription',
+        max_nodes_per_read: int = 1000,
+        max_poll_slowdown: float = 8,
+        event_settings: EventSettings = EventSettings(),
+        events: Optional[IngestQueue] = None,
+        encoder: Optional[EncoderPool] = None,
+    ):
+        self.server = server
+        self.backend = backend
+        self.ingest = ingest
+        self.timeout = timeout
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.max_attempts = max_attempts
+        self.max_items_per_call = max_items_per_call
+        self.defaults = defaults
+        self.cache = cache
+        # kept across reconnects, values sent again after reconnecting are suppressed
+        self.compression = Compression(compression)
+        self.timestamp_source = timestamp_source
+        self.watchdog_interval = watchdog_interval
+        self.reconnect_timeout = reconnect_timeout
+        self.types = types if types is not None else TypeCache()
+        self.acquisition_mode = acquisition_mode
+        self.max_nodes_per_read = max_nodes_per_read
+        self.max_poll_slowdown = max_poll_slowdown
+        self.event_settings = event_settings
+        self.events = events
+        self.encoder = encoder if encoder is not None else EncoderPool()
+
+        self.state: ConnectionState = ConnectionState.CONNECTING
+        self.client: Optional[asyncua.Client] = None
+        self.subscriptions: Optional[Union[Subscriptions, Polling]] = None
+        self.handler: Optional[SubHandler] = None
+        self.limits: Dict[str, int] = {}
+        self.attempts: int = 0
+        self.connection_error: str = ''
+        self.attempted = asyncio.Event()
+        # incremented whenever the client restored the session after losing the connection
+        self.restores: int = 0
+        self.lost = asyncio.Event()
+        # key of the data types the limits were read for
+        self.types_key: Optional[str] = None
+
+    @property
+    def mode(self) -> str:
+        return self.server.acquisition_mode or self.acquisition_mode
+
+    @property
+    def connected(self) -> bool:
+        return self.state == ConnectionState.CONNECTED
+
+    def backoff(self) -> float:
+        delay = min(self.max_backoff, self.min_backoff * 2 ** (self.attempts - 1))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    async def run(self, semaphore: asyncio.Semaphore):
+        """
+        connects to the server, retries until connected or failed and connects
+        again when the connection is lost and could not be restored
+        """
+        while True:
+            self.state = ConnectionState.CONNECTING
+            self.attempted.clear()
+            async with semaphore:
+                await self.connect()
+            self.attempted.set()
+            if self.connected:
+                await self.supervise()
+                continue
+            if self.max_attempts and self.attempts >= self.max_attempts:
+                self.state = ConnectionState.FAILED
+                return
+            self.state = ConnectionState.BACKOFF
+            await asyncio.sleep(self.backoff())
+
+    async def connect(self):
+        client = asyncua.Client(
+            self.server.url,
+            timeout=self.timeout,
+            watchdog_intervall=self.watchdog_interval,
+            auto_reconnect=True,
+            reconnect_max_delay=min(self.max_backoff, self.reconnect_timeout),
+            reconnect_request_timeout=self.timeout,
+        )
+        client.connection_lost_callback = self._connection_lost
+        self.lost.clear()
+        # set before connecting, so the client is also disconnected if connect() raises unexpectedly
+        self.client = client
+        connection_error = ''
+        try:
+            await client.connect()
+            await self._load_server_info(client)
+            handler = self.handler = SubHandler(
+                self.server.id, self.backend, self.ingest, self.cache, self.compression, self.timestamp_source,
+                self.events, self._status_changed, self.encoder,
+            )
+            await self._subscribe_events(client, handler)
+            if self.mode == 'polling':
+                max_per_read = self.limits['MaxNodesPerRead']
+                self.subscriptions = Polling(
+                    client,
+                    handler,
+                    min(max_per_read, self.max_nodes_per_read) if max_per_read else self.max_nodes_per_read,
+                    self.defaults,
+                    self.compression,
+                    self.max_poll_slowdown,
+                )
+            else:
+                max_per_call = self.limits['MaxMonitoredItemsPerCall']
+                self.subscriptions = Subscriptions(
+                    client,
+                    handler,
+                    min(max_per_call, self.max_items_per_call) if max_per_call else self.max_items_per_call,
+                    self.defaults,
+                    self.compression,
+                )
+        except UaStatusCodeError as error:  # type: ignore
+            connection_error = f"UaStatusCodeError({error.code})"
+        except CancelledError:
+            connection_error = 'CancelledError'
+        except asyncio.TimeoutError:
+            connection_error = 'TimeoutError'
+        except OSError:
+            connection_error = 'OSError'
+        except UaError:
+            connection_error = 'UaError'
+        self.connection_error = connection_error
+        CONNECTION_ATTEMPTS.labels(str(self.server.id), 'failed' if connection_error else 'connected').inc()
+        if connection_error == '':
+            self.attempts = 0
+            self.state = ConnectionState.CONNECTED
+        else:
+            self.attempts += 1
+            self.subscriptions = None
+            await self._close_handler()
+            await self._disconnect_client()
+        await self._server_update(connection_error)
+
+    async def supervise(self):
+        """
+        waits for the connection to get lost and for the client to restore it,
+        returns when it could not be restored within reconnect_timeout
+        """
+        while True:
+            await self.lost.wait()
+            self.lost.clear()
+            self.state = ConnectionState.RECONNECTING
+            await self._server_update(self.connection_error)
+            try:
+                async with self.client.uaclient.subscribe_state() as changes:
+                    if self.client.uaclient.state == UaClientState.CONNECTED:
+                        # the loss was reported before the client started reconnecting
+                        await changes.next_change(self.reconnect_timeout)
+                    await changes.wait_for_state(UaClientState.CONNECTED, self.reconnect_timeout)
+            except asyncio.TimeoutError:
+                print(f'could not restore connection to server {self.server.id}: {self.connection_error}')
+                CONNECTION_ATTEMPTS.labels(str(self.server.id), 'failed').inc()
+                self.attempts += 1
+                await self.disconnect()
+                return
+            CONNECTION_ATTEMPTS.labels(str(self.server.id), 'restored').inc()
+            self.restores += 1
+            self.connection_error = ''
+            self.state = ConnectionState.CONNECTED
+            await self._server_update('')
+
+    async def _subscribe_events(self, client: asyncua.Client, handler: SubHandler):
+        settings = self.event_settings.of(self.server)
+        if not settings.enabled or self.events is None:
+            return
+        try:
+            await subscribe_events(client, handler, settings)
+        except UaStatusCodeError as error:  # type: ignore
+            # the values are collected anyway
+            print(f'could not subscribe to events of server {self.server.id}: UaStatusCodeError({error.code})')
+        except (UaError, ValueError) as error:  # type: ignore
+            # e.g. an event type or field that cannot be parsed
+            print(f'could not subscribe to events of server {self.server.id}: {error!r}')
+
+    async def _status_changed(self, status: ua.StatusCode):
+        self.connection_error = '' if status.is_good() else f'StatusChange({status.name})'
+        await self._server_update(self.connection_error)
+
+    async def _connection_lost(self, error: Exception):
+        self.connection_error = f'ConnectionLost({type(error).__name__})'
+        self.lost.set()
+
+    async def _load_server_info(self, client: asyncua.Client):
+        key = await self.types.load(client, self.server.url)
+        if key != self.types_key:
+            self.limits = await read_operation_limits(client)
+            self.types_key = key
+
+    async def _server_update(self, connection_error: str):
+        try:
+            await self.backend.server_update(self.server.id, connection_error)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+            print(f'could not update server {self.server.id}: {error!r}')
+
+    async def disconnect(self):
+        if self.subscriptions is not None:
+            await self.subscriptions.close()
+        self.subscriptions = None
+        await self._close_handler()
+        await self._disconnect_client()
+
+    async def _close_handler(self):
+        # values received before disconnecting are still stored
+        if self.handler is not None:
+            await self.handler.close()
+        self.handler = None
+
+    async def _disconnect_client(self):
+        if self.client is None:
+            return
+        try:
+            await self.client.disconnect()
+        except AttributeError:
+            print('AttributeError while disconnecting')
+        except UaStatusCodeError as error:  # type: ignore
+            print(f"UaStatusCodeError({error.code})")
+        except CancelledError:
+            print('CancelledError while disconnecting')
+        except OSError:
+            print('OSError while disconnecting')
+        except UaError:
+            print('UaError while disconnecting')
+        self.client = None
+
+
+class ConnectionManager:
+    """
+    Keeps one ServerConnection per server, connection attempts to different
+    servers run concurrently with at most max_concurrency at the same time.
+    """
+
+    def __init__(
+        self,
+        backend: AsyncBackend,
+        ingest: IngestQueue,
+        max_concurrency: int = 10,
+        timeout: float = 10,
+        min_backoff: float = 1,
+        max_backoff: float = 300,
+        max_attempts: int = 0,
+        max_items_per_call: int = 1000,
+        defaults: MonitoringSettings = MonitoringSettings(),
+        cache: Optional[LastValueCache] = None,
+        compression: CompressionPolicy = CompressionPolicy(),
+        expire_interval: float = 1,
+        timestamp_source: str = 'server',
+        watchdog_interval: float = 5,
+        reconnect_timeout: float = 60,
+        types: Optional[TypeCache] = None,
+        acquisition_mode: str = 'subscription',
+        max_nodes_per_read: int = 1000,
+        max_poll_slowdown: float = 8,
+        event_settings: EventSettings = EventSettings(),
+        events: Optional[IngestQueue] = None,
+        encoder: Optional[EncoderPool] = None,
+    ):
+        self.backend = backend
+        self.ingest = ingest
+        self.timeout = timeout
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.max_attempts = max_attempts
+        self.max_items_per_call = max_items_per_call
+        self.defaults = defaults
+        self.cache = cache
+        self.compression = compression
+        self.expire_interval = expire_interval
+        self.timestamp_source = timestamp_source
+        self.watchdog_interval = watchdog_interval
+        self.reconnect_timeout = reconnect_timeout
+        self.types = types if types is not None else TypeCache()
+        self.acquisition_mode = acquisition_mode
+        self.max_nodes_per_read = max_nodes_per_read
+        self.max_poll_slowdown = max_poll_slowdown
+        self.event_settings = event_settings
+        self.events = events
+        self.encoder = encoder if encoder is not None else EncoderPool()
+
+        self.connections: Dict[int, ServerConnection] = {}
+        self._tasks: Dict[int, asyncio.Task] = {}
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._expire_task: Optional[asyncio.Task] = None
+
+    def connected(self) -> Dict[int, ServerConnection]:
+        return {server_id: c for server_id, c in self.connections.items() if c.connected}
+
+    def states(self) -> Dict[str, int]:
+        states = {state.value: 0 for state in ConnectionState}
+        for connection in self.connections.values():
+            states[connection.state.value] += 1
+        return states
+
+    async def update(self, servers: Iterable[Server]):
+        """
+        starts connecting to new or changed servers and disconnects from servers no longer in the list
+        """
+        if self._expire_task is None:
+            self._expire_task = asyncio.create_task(self._expire())
+        servers = {server.id: server for server in servers}
+        for server_id in list(self.connections.keys()):
+            server = servers.get(server_id)
+            # updated_at is not compared, it changes with every server_update()
+            if server is None or server.url != self.connections[server_id].server.url \
+                    or server.acquisition_mode != self.connections[server_id].server.acquisition_mode:
+                await self.remove(server_id)
+        for server_id, server in servers.items():
+            if server_id in self.connections:
+                self.connections[server_id].server = server
+            else:
+                self._start(ServerConnection(
+                    server,
+                    self.backend,
+                    self.ingest,
+                    timeout=self.timeout,
+                    min_backoff=self.min_backoff,
+                    max_backoff=self.max_backoff,
+                    max_attempts=self.max_attempts,
+                    max_items_per_call=self.max_items_per_call,
+                    defaults=self.defaults,
+                    cache=self.cache,
+                    compression=self.compression,
+                    timestamp_source=self.timestamp_source,
+                    watchdog_interval=self.watchdog_interval,
+                    reconnect_timeout=self.reconnect_timeout,
+                    types=self.types,
+                    acquisition_mode=self.acquisition_mode,
+                    max_nodes_per_read=self.max_nodes_per_read,
+                    max_poll_slowdown=self.max_poll_slowdown,
+                    event_settings=self.event_settings,
+                    events=self.events,
+                    encoder=self.encoder,
+                ))
+
+    async def wait(self, timeout: float):
+        """
+        waits until all pending connection attempts are done, but at most timeout seconds
+        """
+        pending = [
+            asyncio.create_task(c.attempted.wait())
+            for c in self.connections.values() if c.state == ConnectionState.CONNECTING
+        ]
+        if pending:
+            await asyncio.wait(pending, timeout=timeout)
+            for task in pending:
+                task.cancel()
+
+    async def remove(self, server_id: int):
+        task = self._tasks.pop(server_id, None)
+        if task is not None and not task.done():
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+        connection = self.connections.pop(server_id)
+        await connection.disconnect()
+        # store what compression held back
+        for sample in connection.compression.expire(math.inf):
+            await self.ingest.put(sample)
+        if self.cache is not None:
+            self.cache.remove_server(server_id)
+
+    async def close(self):
+        if self._expire_task is not None:
+            self._expire_task.cancel()
+            await asyncio.gather(self._expire_task, return_exceptions=True)
+            self._expire_task = None
+        for server_id in list(self.connections.keys()):
+            await self.remove(server_id)
+
+    async def _expire(self):
+        """
+        stores the samples compression held back for longer than their policy allows
+        """
+        while True:
+            await asyncio.sleep(self.expire_interval)
+            now = time.time_ns()
+            for connection in list(self.connections.values()):
+                for sample in connection.compression.expire(now):
+                    await self.ingest.put(sample)
+
+    def _start(self, connection: ServerConnection, delay: float = 0):
+        self.connections[connection.server.id] = connection
+        task = asyncio.create_task(self._run(connection, delay))
+        task.add_done_callback(lambda task: self._done(connection, task))
+        self._tasks[connection.server.id] = task
+
+    async def _run(self, connection: ServerConnection, delay: float):
+        if delay:
+            await connection.disconnect()
+            await asyncio.sleep(delay)
+        await connection.run(self._semaphore)
+
+    def _done(self, connection: ServerConnection, task: asyncio.Task):
+        """
+        starts the connection again with backoff if it failed unexpectedly
+        """
+        if task.cancelled() or task.exception() is None:
+            return
+        print(f'connection to server {connection.server.id} failed: {task.exception()!r}')
+        CONNECTION_ATTEMPTS.labels(str(connection.server.id), 'failed').inc()
+        connection.attempts += 1
+        connection.state = ConnectionState.BACKOFF
+        connection.attempted.set()
+        if self.connections.get(connection.server.id) is connection:
+            self._start(connection, connection.backoff())
@@ -0,0 +1,124 @@
+# Copyright (C) 2022 Robin Jespersen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import asyncio
+import concurrent.futures
+import datetime
+import multiprocessing
+import time
+from typing import Any, List, Optional, Tuple, Union
+
+from asyncua import ua
+
+from models.sample import Sample
+from serializer import serialize
+
+KINDS = ('thread', 'process')
+
+_EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+_MICROSECOND = datetime.timedelta(microseconds=1)
+
+# modules of value types a worker process can unpickle, structures and enums
+# generated from the data type definitions of a server only exist in the collector
+_PORTABLE_MODULES = ('builtins', 'datetime', 'uuid')
+
+# a received value, the node is a NodeId or its string
+Notification = Tuple[Union[str, ua.NodeId], ua.DataValue]
+# the sample of a received value with its source and server timestamp
+Encoded = Tuple[Sample, Optional[int], Optional[int]]
+
+
+def nanoseconds(value: Optional[datetime.datetime]) -> Optional[int]:
+    if value is None:
+        return None
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=datetime.timezone.utc)
+    return (value - _EPOCH) // _MICROSECOND * 1000
+
+
+def encode(server_id: int, source_time: bool, notifications: List[Notification]) -> List[Encoded]:
+    """
+    converts received values of one server to samples in their order, runs in the workers
+    """
+    encoded = []
+    for node_id, data_value in notifications:
+        value = serialize(data_value.Value.Value if data_value.Value is not None else None)
+        source = nanoseconds(data_value.SourceTimestamp)
+        server = nanoseconds(data_value.ServerTimestamp)
+        status = data_value.StatusCode.value if data_value.StatusCode is not None else 0
+        if source_time:
+            timestamp = source or server or time.time_ns()
+        else:
+            timestamp = server or source or time.time_ns()
+        if not isinstance(node_id, str):
+            node_id = node_id.to_string()
+        encoded.append((Sample(server_id, node_id, timestamp, value, status), source, server))
+    return encoded
+
+
+def _portable(value: Any) -> bool:
+    if type(value) in (list, tuple):
+        # arrays have one type
+        return not value or _portable(value[0])
+    module = type(value).__module__
+    return module in _PORTABLE_MODULES or module.startswith('asyncua.ua.')
+
+
+class EncoderPool:
+    """
+    Workers that convert received values to samples off the event loop.
+
+    With no workers the values are encoded in the event loop, but still after
+    the notification callback returned. Thread workers keep large values from
+    delaying the loop, process workers encode in parallel but pay for pickling
+    the values. Values of types only known to the collector, like the
+    structures of a server, can not be sent to a process and are encoded in the
+    event loop. Every handler encodes one batch at a time so the samples of a
+    server keep their order.
+    """
+
+    def __init__(self, workers: int = 0, kind: str = 'thread'):
+        if kind not in KINDS:
+            raise ValueError(f'unknown encoder kind {kind}, expected one of {KINDS}')
+        self.workers = workers
+        self.kind = kind
+        self.executor: Optional[concurrent.futures.Executor] = None
+        if workers > 0:
+            if kind == 'process':
+                # forking the collector while its threads hold locks could deadlock the workers
+                self.executor = concurrent.futures.ProcessPoolExecutor(
+                    workers, mp_context=multiprocessing.get_context('spawn'),
+                )
+                # the workers are started on demand, starting them later would stall the first batches
+                for _ in range(workers):
+                    self.executor.submit(int)
+            else:
+                self.executor = concurrent.futures.ThreadPoolExecutor(workers, thread_name_prefix='encoder')
+
+    async def encode(self, server_id: int, source_time: bool, notifications: List[Notification]) -> List[Encoded]:
+        if self.executor is None or (
+            self.kind == 'process'
+            and not all(_portable(data_value.Value.Value) for _, data_value in notifications if data_value.Value)
+        ):
+            return encode(server_id, source_time, notifications)
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, encode, server_id, source_time, notifications,
+        )
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
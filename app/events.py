@@ -0,0 +1,142 @@
+# Copyright (C) 2022 Robin Jespersen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from typing import Callable, List, NamedTuple, Optional, Tuple
+
+import asyncua
+from asyncua import ua
+from asyncua.common.subscription import Subscription
+
+from models.server import Server
+
+DEFAULT_FIELDS = ('EventId', 'EventType', 'SourceNode', 'SourceName', 'Time', 'ReceiveTime', 'Message', 'Severity')
+
+
+def _split(value: Optional[str]) -> Optional[Tuple[str, ...]]:
+    if value is None:
+        return None
+    return tuple(item.strip() for item in value.split(',') if item.strip())
+
+
+class EventSettings(NamedTuple):
+    """
+    Which events of a server are collected.
+
+    fields are the browse paths of the selected event fields relative to the
+    BaseEventType, path elements are separated by / and may be prefixed with a
+    namespace index like 2:Name. The where filter keeps only events of one of
+    types or of their subtypes, and with at least min_severity. Both filters
+    are evaluated by the server.
+    """
+    enabled: bool = False
+    fields: Tuple[str, ...] = DEFAULT_FIELDS
+    types: Tuple[str, ...] = ()  # node ids of event types, empty for all
+    min_severity: int = 0
+    source: str = 'i=2253'  # the Server object receives the events of the whole server
+    publishing_interval: float = 1000
+    queue_size: int = 1000
+
+    def of(self, server: Server) -> 'EventSettings':
+        """
+        settings of the server, settings the server does not set are taken from self
+        """
+        return self._replace(
+            enabled=self.enabled if server.events is None else server.events,
+            fields=_split(server.event_fields) or self.fields,
+            types=self.types if server.event_types is None else _split(server.event_types),
+            min_severity=self.min_severity if server.event_min_severity is None else server.event_min_severity,
+        )
+
+    def filter(self) -> ua.EventFilter:
+        event_filter = ua.EventFilter()
+        for field in self.fields:
+            operand = ua.SimpleAttributeOperand()
+            operand.TypeDefinitionId = ua.NodeId(ua.ObjectIds.BaseEventType)
+            operand.BrowsePath = [ua.QualifiedName.from_string(name) for name in field.split('/')]
+            operand.AttributeId = ua.AttributeIds.Value
+            event_filter.SelectClauses.append(operand)
+
+        conditions: List[Callable[[List[ua.ContentFilterElement]], None]] = []
+        if self.types:
+            conditions.append(lambda elements: _combine(elements, ua.FilterOperator.Or, [
+                _of_type(ua.NodeId.from_string(event_type)) for event_type in self.types
+            ]))
+        if self.min_severity:
+            conditions.append(_min_severity(self.min_severity))
+        if conditions:
+            _combine(event_filter.WhereClause.Elements, ua.FilterOperator.And, conditions)
+        return event_filter
+
+
+def _element(operator: ua.FilterOperator, operands: list) -> ua.ContentFilterElement:
+    element = ua.ContentFilterElement()
+    element.FilterOperator = operator
+    element.FilterOperands = operands
+    return element
+
+
+def _combine(elements: List[ua.ContentFilterElement], operator: ua.FilterOperator, conditions: list):
+    """
+    appends the elements of the conditions joined by the binary operator, the first appended element is the root
+    """
+    if len(conditions) == 1:
+        conditions[0](elements)
+        return
+    root = len(elements)
+    elements.append(None)
+    first = len(elements)
+    conditions[0](elements)
+    second = len(elements)
+    _combine(elements, operator, conditions[1:])
+    elements[root] = _element(operator, [ua.ElementOperand(first), ua.ElementOperand(second)])
+
+
+def _of_type(event_type: ua.NodeId):
+    def condition(elements: List[ua.ContentFilterElement]):
+        elements.append(_element(ua.FilterOperator.OfType, [ua.LiteralOperand(ua.Variant(event_type))]))
+    return condition
+
+
+def _min_severity(severity: int):
+    def condition(elements: List[ua.ContentFilterElement]):
+        operand = ua.SimpleAttributeOperand()
+        operand.TypeDefinitionId = ua.NodeId(ua.ObjectIds.BaseEventType)
+        operand.BrowsePath = [ua.QualifiedName('Severity')]
+        operand.AttributeId = ua.AttributeIds.Value
+        elements.append(_element(ua.FilterOperator.GreaterThanOrEqual, [
+            operand, ua.LiteralOperand(ua.Variant(severity, ua.VariantType.UInt16)),
+        ]))
+    return condition
+
+
+async def subscribe_events(client: asyncua.Client, handler, settings: EventSettings) -> Subscription:
+    """
+    creates a subscription with one monitored item for the events of settings.source
+    """
+    subscription = await client.create_subscription(settings.publishing_interval, handler)
+    # not public API of asyncua, see monitored_items
+    request = subscription._make_monitored_item_request(
+        client.get_node(settings.source),
+        ua.AttributeIds.EventNotifier,
+        settings.filter(),
+        settings.queue_size,
+        ua.MonitoringMode.Reporting,
+        0,
+    )
+    result = (await subscription.create_monitored_items([request]))[0]
+    if isinstance(result, ua.StatusCode):
+        await subscription.delete()
+        result.check()
+    return subscription
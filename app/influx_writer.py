@@ -0,0 +1,131 @@
+# Copyright (C) 2022 Robin Jespersen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import gzip
+import json
+import math
+from typing import List, Optional
+
+import aiohttp
+
+from async_backend import BackendResponse
+from models.sample import Sample
+
+_TAG_ESCAPE = str.maketrans({',': '\\,', '=': '\\=', ' ': '\\ '})
+_MEASUREMENT_ESCAPE = str.maketrans({',': '\\,', ' ': '\\ '})
+_STRING_ESCAPE = str.maketrans({'"': '\\"', '\\': '\\\\'})
+
+
+class InfluxWriter:
+    """
+    Writes samples straight to the InfluxDB http /write endpoint.
+
+    Can be used instead of AsyncBackend as the sink of an IngestQueue. Every
+    sample becomes one point with server_id and node_id as tags, the value is
+    stored in typed fields, structures are flattened into one field per member.
+    The status code is stored in the status field, points are written with
+    nanosecond precision.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        database: str,
+        measurement: str = 'opcua',
+        username: Optional[str] = None,
+        password: Optional[str] = None,
+        token: Optional[str] = None,
+        retention_policy: Optional[str] = None,
+        compression_level: int = 1,
+        max_connections: int = 4,
+        timeout: float = 30,
+    ):
+        self.url = url.rstrip('/')
+        self.measurement = measurement.translate(_MEASUREMENT_ESCAPE)
+        self.params = {'db': database, 'precision': 'ns'}
+        if username is not None:
+            self.params['u'] = username
+            self.params['p'] = password or ''
+        if retention_policy is not None:
+            self.params['rp'] = retention_policy
+        self.headers = {'Content-Encoding': 'gzip', 'Content-Type': 'text/plain; charset=utf-8'}
+        if token is not None:
+            self.headers['Authorization'] = f'Token {token}'
+        self.compression_level = compression_level
+        self.max_connections = max_connections
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self._buffer = bytearray()
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def influx_store_batch(self, samples: List[Sample]) -> BackendResponse:
+        body = gzip.compress(self.encode(samples), self.compression_level)
+        session = self._get_session()
+        async with self._semaphore:
+            async with session.post(f'{self.url}/write', params=self.params, headers=self.headers, data=body) as response:
+                # influx answers 204 on success, IngestQueue expects 200
+                status = 200 if response.status == 204 else response.status
+                return BackendResponse(status, await response.text())
+
+    def encode(self, samples: List[Sample]) -> bytes:
+        """
+        encodes the samples as line protocol, the status is written even if the value
+        gives no field (None, NaN, inf), e.g. for bad values
+        """
+        buffer = self._buffer
+        buffer.clear()
+        for sample in samples:
+            fields = []
+            _append_fields(fields, 'value', sample.value)
+            _append_fields(fields, 'status', sample.status)
+            if not fields:
+                continue
+            buffer += (
+                f'{self.measurement},server_id={sample.server_id},node_id={str(sample.node_id).translate(_TAG_ESCAPE)} '
+                f'{",".join(fields)} {sample.time}\n'
+            ).encode()
+        return bytes(buffer)
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.max_connections)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+            self._semaphore = asyncio.Semaphore(self.max_connections)
+        return self._session
+
+
+def _append_fields(fields: List[str], key: str, value):
+    if value is None:
+        return
+    if isinstance(value, bool):
+        fields.append(f'{key.translate(_TAG_ESCAPE)}={"true" if value else "false"}')
+    elif isinstance(value, int):
+        fields.append(f'{key.translate(_TAG_ESCAPE)}={value}i')
+    elif isinstance(value, float):
+        if math.isfinite(value):
+            fields.append(f'{key.translate(_TAG_ESCAPE)}={value!r}')
+    elif isinstance(value, str):
+        fields.append(f'{key.translate(_TAG_ESCAPE)}="{value.translate(_STRING_ESCAPE)}"')
+    elif isinstance(value, dict):
+        for k, v in value.items():
+            _append_fields(fields, f'{key}.{k}', v)
+    else:
+        fields.append(f'{key.translate(_TAG_ESCAPE)}="{json.dumps(value).translate(_STRING_ESCAPE)}"')
@@ -0,0 +1,239 @@
+# Copyright (C) 2022 Robin Jespersen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+from collections import deque
+from typing import Deque, List, Optional, Union
+
+import aiohttp
+
+from async_backend import AsyncBackend
+from influx_writer import InfluxWriter
+from models.sample import Sample
+from spool import Spool
+
+
+class IngestQueue:
+    """
+    Bounded buffer between the subscription handlers and the backend.
+
+    A flusher task sends the buffered samples in batches, a batch is send as soon
+    as it holds max_batch_size samples or max_batch_age seconds after its first
+    sample was queued. If the buffer is full new samples are dropped, or put()
+    waits for free space when block is set.
+
+    With a spool, batches that could not be stored because of a network error or
+    a server error and samples that do not fit into the buffer are written to
+    disk instead. Batches the backend rejects as invalid are dropped, they would
+    be rejected again and hold back all later batches. While the spool is not empty new
+    batches are appended to it as well, so the backend receives all samples in
+    order once it is available again.
+
+    The batches are passed to the method of the backend named store,
+    influx_store_batch() by default, other items like events can be queued
+    with another store and without a spool.
+    """
+
+    def __init__(
+        self,
+        backend: Union[AsyncBackend, InfluxWriter],
+        max_size: int = 100000,
+        max_batch_size: int = 5000,
+        max_batch_age: float = 0.5,
+        block: bool = False,
+        spool: Optional[Spool] = None,
+        max_retry_delay: float = 30,
+        store: str = 'influx_store_batch',
+    ):
+        self.backend = backend
+        self.max_size = max_size
+        self.max_batch_size = max_batch_size
+        self.max_batch_age = max_batch_age
+        self.block = block
+        self.spool = spool
+        self.max_retry_delay = max_retry_delay
+        self.store = store
+
+        self.dropped: int = 0
+        self.sent: int = 0
+        self.failed: int = 0
+        self.spooled: int = 0
+        self.rejected: int = 0
+
+        self._buffer: Deque[Sample] = deque()
+        self._first_at: float = 0
+        self._closing = False
+        self._wakeup = asyncio.Event()
+        self._not_full = asyncio.Event()
+        self._not_full.set()
+        self._task: Optional[asyncio.Task] = None
+        self._retry_at: float = 0
+        self._retry_delay: float = 0
+
+    @property
+    def depth(self) -> int:
+        return len(self._buffer)
+
+    def stats(self) -> dict:
+        return {
+            'depth': self.depth,
+            'dropped': self.dropped,
+            'sent': self.sent,
+            'failed': self.failed,
+            'spooled': self.spooled,
+            'rejected': self.rejected,
+        }
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        """
+        stops accepting new samples and waits until the buffer is drained
+        """
+        self._closing = True
+        self._wakeup.set()
+        self._not_full.set()
+        if self._task is not None:
+            await self._task
+            self._task = None
+
+    async def put(self, sample: Sample) -> bool:
+        while len(self._buffer) >= self.max_size and self.block and not self._closing:
+            self._not_full.clear()
+            await self._not_full.wait()
+        return self.put_nowait(sample)
+
+    def put_nowait(self, sample: Sample) -> bool:
+        if self._closing or len(self._buffer) >= self.max_size:
+            if self.spool is not None:
+                self.spool.append([sample])
+                self.spooled += 1
+                return True
+            self.dropped += 1
+            return False
+        self._buffer.append(sample)
+        if len(self._buffer) == 1:
+            self._first_at = asyncio.get_running_loop().time()
+            self._wakeup.set()
+        elif len(self._buffer) >= self.max_batch_size:
+            self._wakeup.set()
+        return True
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while self._buffer or not self._closing:
+            if not self._buffer:
+                await self._idle()
+                continue
+            age = loop.time() - self._first_at
+            if len(self._buffer) < self.max_batch_size and age < self.max_batch_age and not self._closing:
+                self._wakeup.clear()
+                await self._wait(self.max_batch_age - age)
+                continue
+            batch = self._take_batch()
+            try:
+                await self._flush(batch)
+            except Exception as error:
+                # e.g. the disk of the spool is full, the following batches are still sent
+                self.failed += len(batch)
+                print(f'could not store {len(batch)} samples: {error!r}')
+        if self.spool is not None:
+            self.spool.close()
+
+    async def _idle(self):
+        """
+        waits for new samples, meanwhile catches up on the spool
+        """
+        self._wakeup.clear()
+        if self.spool is None or self.spool.empty or self._closing:
+            await self._wakeup.wait()
+            return
+        try:
+            await self._replay()
+        except Exception as error:
+            # e.g. the spool cannot be read, the buffer is still sent
+            print(f'could not replay spooled samples: {error!r}')
+        await self._wait(max(self._retry_at - asyncio.get_running_loop().time(), self.max_batch_age))
+
+    async def _wait(self, timeout: float):
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def _take_batch(self) -> List[Sample]:
+        count = min(len(self._buffer), self.max_batch_size)
+        batch = [self._buffer.popleft() for _ in range(count)]
+        # the age of the remaining samples is counted from now on
+        self._first_at = asyncio.get_running_loop().time()
+        self._not_full.set()
+        return batch
+
+    async def _flush(self, batch: List[Sample]):
+        if self.spool is not None and not self.spool.empty:
+            self.spool.append(batch)
+            self.spooled += len(batch)
+            await self._replay()
+            return
+        if not await self._store(batch) and self.spool is not None:
+            self.spool.append(batch)
+            self.spooled += len(batch)
+
+    async def _replay(self):
+        """
+        sends the spooled samples oldest first until the spool is empty or the backend fails
+        """
+        loop = asyncio.get_running_loop()
+        if loop.time() < self._retry_at:
+            return
+        while not self.spool.empty:
+            samples, position = self.spool.read(self.max_batch_size)
+            if samples and not await self._store(samples):
+                self._retry_delay = min(max(self._retry_delay * 2, 1), self.max_retry_delay)
+                self._retry_at = loop.time() + self._retry_delay
+                return
+            self.spool.commit(position)
+            if not samples:
+                # only skipped lines, the rest is replayed the next time
+                break
+        self._retry_delay = 0
+
+    async def _store(self, batch: List[Sample]) -> bool:
+        """
+        returns False if the batch could not be stored and is to be retried
+        """
+        try:
+            # looked up on every call so the method can be wrapped while running, e.g. by the profiler
+            response = await getattr(self.backend, self.store)(batch)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+            self.failed += len(batch)
+            print(f'could not store {len(batch)} samples: {error!r}')
+            return False
+        if 400 <= response.status_code < 500 and response.status_code not in (408, 429):
+            self.rejected += len(batch)
+            print(f'dropped {len(batch)} samples rejected by the backend:')
+            print('server response:')
+            print(response.text)
+            return True
+        if response.status_code != 200:
+            self.failed += len(batch)
+            print(f'could not store {len(batch)} samples:')
+            print('server response:')
+            print(response.text)
+            return False
+        self.sent += len(batch)
+        return True
@@ -0,0 +1,102 @@
+# Copyright (C) 2022 Robin Jespersen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import time
+from typing import Dict, List, Optional
+
+from async_backend import AsyncBackend
+from models.node import Node
+from models.server import Server
+
+
+class Inventory:
+    """
+    Servers and tracked nodes as known by the API.
+
+    After one full listing only nodes updated since the highest updated_at seen
+    are requested, unchanged listings are answered with 304 Not Modified if the
+    API supports ETags. Deleted nodes do not show up in incremental listings,
+    they are removed by a full listing every full_sync_interval seconds.
+    """
+
+    def __init__(self, backend: AsyncBackend, full_sync_interval: float = 3600):
+        self.backend = backend
+        self.full_sync_interval = full_sync_interval
+
+        self.servers: Dict[int, Server] = {}
+        self.nodes: Dict[int, Node] = {}
+        self.server_nodes: Dict[int, Dict[int, Node]] = {}
+        self.watermark: Optional[int] = None
+        self.synced_at: float = 0
+
+    async def sync_servers(self) -> List[Server]:
+        servers = await self.backend.server_index_changed()
+        if servers is not None:
+            self.servers = {server.id: server for server in servers}
+        return list(self.servers.values())
+
+    async def sync_nodes(self) -> Dict[int, Dict[int, Optional[Node]]]:
+        """
+        fetches the nodes changed since the last call,
+        returns the changes per server, removed nodes are None
+        """
+        changes: Dict[int, Dict[int, Optional[Node]]] = {}
+        if self.watermark is None or time.monotonic() - self.synced_at >= self.full_sync_interval:
+            nodes = await self.backend.node_index_changed()
+            if nodes is None:
+                self.synced_at = time.monotonic()
+                return changes
+            listed = {node.id for node in nodes}
+            for node_id in [node_id for node_id in self.nodes if node_id not in listed]:
+                self._remove(node_id, changes)
+            for node in nodes:
+                self._put(node, changes)
+            self.watermark = max((node.updated_at for node in nodes), default=None)
+            self.synced_at = time.monotonic()
+        else:
+            nodes = await self.backend.node_index_changed(self.watermark)
+            for node in nodes or []:
+                if node.tracked and not node.virtual:
+                    self._put(node, changes)
+                else:
+                    self._remove(node.id, changes)
+                self.watermark = max(self.watermark, node.updated_at)
+        return changes
+
+    def _put(self, node: Node, changes: Dict[int, Dict[int, Optional[Node]]]):
+        current = self.nodes.get(node.id)
+        # rows at the watermark are listed again, updated_at has a resolution of
+        # one second, so a second edit within it is only found by the contents
+        if current is not None and _contents(current) == _contents(node):
+            return
+        if current is not None and current.server_id != node.server_id:
+            self._remove(node.id, changes)
+        self.nodes[node.id] = node
+        self.server_nodes.setdefault(node.server_id, {})[node.id] = node
+        changes.setdefault(node.server_id, {})[node.id] = node
+
+    def _remove(self, node_id: int, changes: Dict[int, Dict[int, Optional[Node]]]):
+        node = self.nodes.pop(node_id, None)
+        if node is None:
+            return
+        server_nodes = self.server_nodes[node.server_id]
+        del server_nodes[node_id]
+        if not server_nodes:
+            del self.server_nodes[node.server_id]
+        changes.setdefault(node.server_id, {})[node_id] = None
+
+
+def _contents(node: Node) -> tuple:
+    return tuple(getattr(node, name) for name in Node.__slots__ if name != 'updated_at')
@@ -0,0 +1,95 @@
+# Copyright (C) 2022 Robin Jespersen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Set, Tuple
+
+Key = Tuple[int, str]
+
+
+class LastValue(NamedTuple):
+    value: Any
+    source_time: Optional[float]
+    server_time: Optional[float]
+    status: int
+
+
+class Watcher:
+    """
+    Changes of the watched keys since the last take(), only the latest value per key is kept.
+    """
+
+    def __init__(self, keys: Optional[Set[Key]] = None, server_ids: Optional[Set[int]] = None):
+        self.keys = keys
+        self.server_ids = server_ids
+        self.changes: Dict[Key, LastValue] = {}
+        self.changed = asyncio.Event()
+
+    def watches(self, key: Key) -> bool:
+        if self.keys is None and self.server_ids is None:
+            return True
+        return (self.keys is not None and key in self.keys) or (self.server_ids is not None and key[0] in self.server_ids)
+
+    async def take(self) -> Dict[Key, LastValue]:
+        await self.changed.wait()
+        self.changed.clear()
+        changes, self.changes = self.changes, {}
+        return changes
+
+
+class LastValueCache:
+    """
+    Last value of every node, keyed by (server_id, node_id).
+
+    Watchers are notified of every change of the keys they watch, a slow
+    watcher only misses intermediate values, never the latest one.
+    """
+
+    def __init__(self):
+        self.servers: Dict[int, Dict[str, LastValue]] = {}
+        self.watchers: List[Watcher] = []
+
+    def __len__(self) -> int:
+        return sum(len(values) for values in self.servers.values())
+
+    def put(self, server_id: int, node_id: str, value: LastValue):
+        values = self.servers.get(server_id)
+        if values is None:
+            values = self.servers[server_id] = {}
+        values[node_id] = value
+        for watcher in self.watchers:
+            if watcher.watches((server_id, node_id)):
+                watcher.changes[(server_id, node_id)] = value
+                watcher.changed.set()
+
+    def get(self, keys: Iterable[Key]) -> Dict[Key, LastValue]:
+        result = {}
+        for server_id, node_id in keys:
+            value = self.servers.get(server_id, {}).get(node_id)
+            if value is not None:
+                result[(server_id, node_id)] = value
+        return result
+
+    def server(self, server_id: int) -> Dict[Key, LastValue]:
+        return {(server_id, node_id): value for node_id, value in self.servers.get(server_id, {}).items()}
+
+    def remove_server(self, server_id: int):
+        self.servers.pop(server_id, None)
+
+    def watch(self, watcher: Watcher):
+        self.watchers.append(watcher)
+
+    def unwatch(self, watcher: Watcher):
+        self.watchers.remove(watcher)
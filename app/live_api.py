@@ -0,0 +1,157 @@
+# Copyright (C) 2022 Robin Jespersen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import hmac
+import json
+from typing import Dict, List, Optional
+
+from aiohttp import WSMsgType, web
+
+from last_values import Key, LastValue, LastValueCache, Watcher
+
+
+def _entries(values: Dict[Key, LastValue]) -> List[dict]:
+    return [
+        {
+            'server_id': server_id,
+            'node_id': node_id,
+            'value': value.value,
+            'source_time': value.source_time,
+            'server_time': value.server_time,
+            'status': value.status,
+        }
+        for (server_id, node_id), value in values.items()
+    ]
+
+
+def _watcher(request: dict) -> Watcher:
+    nodes = request.get('nodes')
+    server_ids = request.get('server_ids')
+    return Watcher(
+        None if nodes is None else {(int(server_id), str(node_id)) for server_id, node_id in nodes},
+        None if server_ids is None else {int(server_id) for server_id in server_ids},
+    )
+
+
+class LiveApi:
+    """
+    HTTP and websocket endpoint serving the LastValueCache.
+
+    GET  /values?server_id=1&node=1:ns=2;i=5  last values of servers and single nodes
+    POST /values {"server_ids": [1], "nodes": [[1, "ns=2;i=5"]]}  the same for long lists
+    GET  /ws  websocket, the first message selects the nodes like POST /values,
+              the current values are sent back followed by all changes,
+              every message is a list of values
+
+    It listens on localhost by default. With a token every request has to send
+    it as Authorization: Bearer <token> or, e.g. from a browser websocket, as the
+    access_token query parameter.
+    """
+
+    def __init__(self, cache: LastValueCache, host: str = '127.0.0.1', port: int = 8080, token: Optional[str] = None):
+        self.cache = cache
+        self.host = host
+        self.port = port
+        self.token = token
+
+        self.app = web.Application(middlewares=[self._authorize] if token is not None else [])
+        self.app.router.add_get('/values', self.get_values)
+        self.app.router.add_post('/values', self.post_values)
+        self.app.router.add_get('/ws', self.websocket)
+        self._runner: Optional[web.AppRunner] = None
+
+    async def start(self):
+        self._runner = web.AppRunner(self.app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+
+    async def close(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    @web.middleware
+    async def _authorize(self, request: web.Request, handler):
+        token = request.headers.get('Authorization', '').partition('Bearer ')[2] or request.query.get('access_token')
+        if token is None or not hmac.compare_digest(token, self.token):
+            raise web.HTTPUnauthorized()
+        return await handler(request)
+
+    def read(self, watcher: Watcher) -> Dict[Key, LastValue]:
+        if watcher.keys is None and watcher.server_ids is None:
+            values = {}
+            for server_id in list(self.cache.servers):
+                values.update(self.cache.server(server_id))
+            return values
+        values = self.cache.get(watcher.keys or [])
+        for server_id in watcher.server_ids or []:
+            values.update(self.cache.server(server_id))
+        return values
+
+    async def get_values(self, request: web.Request) -> web.Response:
+        try:
+            nodes = []
+            for node in request.query.getall('node', []):
+                server_id, _, node_id = node.partition(':')
+                nodes.append((int(server_id), node_id))
+            server_ids = [int(server_id) for server_id in request.query.getall('server_id', [])]
+        except ValueError:
+            raise web.HTTPBadRequest(text='node has to be <server_id>:<node_id>, server_id an integer')
+        return web.json_response(_entries(self.read(Watcher(set(nodes) or None, set(server_ids) or None))))
+
+    async def post_values(self, request: web.Request) -> web.Response:
+        try:
+            watcher = _watcher(await request.json())
+        except (ValueError, TypeError, AttributeError):
+            raise web.HTTPBadRequest(text='expected {"server_ids": [...], "nodes": [[server_id, node_id], ...]}')
+        return web.json_response(_entries(self.read(watcher)))
+
+    async def websocket(self, request: web.Request) -> web.WebSocketResponse:
+        ws = web.WebSocketResponse(heartbeat=30)
+        await ws.prepare(request)
+        message = await ws.receive()
+        if message.type != WSMsgType.TEXT:
+            await ws.close()
+            return ws
+        try:
+            watcher = _watcher(json.loads(message.data))
+        except (ValueError, TypeError, AttributeError):
+            await ws.close(message=b'invalid selection')
+            return ws
+
+        self.cache.watch(watcher)
+        # further messages are ignored, receive() returns a close message once the client is gone
+        received = asyncio.create_task(ws.receive())
+        changes = asyncio.create_task(watcher.take())
+        try:
+            await ws.send_json(_entries(self.read(watcher)))
+            while not ws.closed:
+                await asyncio.wait([changes, received], return_when=asyncio.FIRST_COMPLETED)
+                if received.done():
+                    if received.result().type in (WSMsgType.CLOSE, WSMsgType.CLOSING, WSMsgType.CLOSED, WSMsgType.ERROR):
+                        break
+                    received = asyncio.create_task(ws.receive())
+                if changes.done():
+                    await ws.send_json(_entries(changes.result()))
+                    changes = asyncio.create_task(watcher.take())
+        except ConnectionResetError:
+            pass
+        finally:
+            self.cache.unwatch(watcher)
+            received.cancel()
+            changes.cancel()
+            await ws.close()
+        return ws
@@ -16,74 +16,275 @@
 
 import asyncio
 import os
+import signal
+import socket
 import time
 import typing
-from concurrent.futures import CancelledError
 
+import aiohttp
 import sentry_sdk
-from asyncua.ua import UaError
 
-import asyncua
-from asyncua import Node
-from asyncua.ua import UaStatusCodeError
-from asyncua.ua.uaerrors import BadMonitoredItemIdInvalid
-from asyncua.common.subscription import Subscription
-
-from models.server import Server
+import metrics
+from connection import ConnectionManager, ServerConnection
+from inventory import Inventory
 from models.node import Node as NodeModel
-from sub_handler import SubHandler
+from models.server import Server
+from monitored_items import MonitoringSettings
+from compression import CompressionPolicy
+from subscriptions import Subscriptions
+from polling import Polling
+from write_back import WriteBack
+from last_values import LastValueCache
+from live_api import LiveApi
+from sharding import Shard, run_workers
+from type_cache import TypeCache
+from scanner import ScanSettings, Scans
+from profiling import Profiler
+from events import DEFAULT_FIELDS, EventSettings
+from encoder import EncoderPool
+from ingest import IngestQueue
+from spool import Spool
+from influx_writer import InfluxWriter
 
-from backend import Backend
+from async_backend import AsyncBackend
 
 if os.getenv('SENTRY_DSN') is not None:
     sentry_sdk.init(
         os.getenv('SENTRY_DSN'),
-        traces_sample_rate=os.getenv('SENTRY_TRACES_SAMPLE_RATE', '1'),
+        traces_sample_rate=float(os.getenv('SENTRY_TRACES_SAMPLE_RATE', '0.01')),
+    )
+
+
+def make_shard() -> typing.Optional[Shard]:
+    if os.getenv('SHARD_NAME') is None:
+        return None
+    return Shard(
+        os.getenv('SHARD_NAME'),
+        members=os.getenv('SHARD_MEMBERS').split(',') if os.getenv('SHARD_MEMBERS') else None,
+        directory=os.getenv('SHARD_DIR'),
+        ttl=float(os.getenv('SHARD_TTL', '60')),
+        settle=float(os.getenv('SHARD_SETTLE', '150')),
+    )
+
+
+def make_spool(shard: typing.Optional[Shard]) -> typing.Optional[Spool]:
+    if os.getenv('SPOOL_DIR') is None:
+        return None
+    return Spool(
+        # every shard needs its own spool
+        os.path.join(os.getenv('SPOOL_DIR'), shard.name) if shard is not None else os.getenv('SPOOL_DIR'),
+        segment_size=int(os.getenv('SPOOL_SEGMENT_SIZE', str(16 * 1024 * 1024))),
+        max_bytes=int(os.getenv('SPOOL_MAX_BYTES', str(1024 * 1024 * 1024))),
+        retention=float(os.getenv('SPOOL_RETENTION', str(7 * 24 * 60 * 60))),
+    )
+
+
+def make_sink(backend: AsyncBackend) -> typing.Union[AsyncBackend, InfluxWriter]:
+    if os.getenv('INFLUX_URL') is None:
+        return backend
+    return InfluxWriter(
+        os.getenv('INFLUX_URL'),
+        os.getenv('INFLUX_DATABASE', 'opcua'),
+        measurement=os.getenv('INFLUX_MEASUREMENT', 'opcua'),
+        username=os.getenv('INFLUX_USERNAME'),
+        password=os.getenv('INFLUX_PASSWORD'),
+        token=os.getenv('INFLUX_TOKEN'),
+        retention_policy=os.getenv('INFLUX_RETENTION_POLICY'),
+    )
+
+
+def make_live_api() -> typing.Optional[LiveApi]:
+    if os.getenv('LIVE_PORT') is None:
+        return None
+    # only reachable from other hosts if LIVE_HOST is set, e.g. to 0.0.0.0
+    return LiveApi(
+        LastValueCache(),
+        os.getenv('LIVE_HOST', '127.0.0.1'),
+        int(os.getenv('LIVE_PORT')),
+        token=os.getenv('LIVE_TOKEN'),
     )
 
 
-async def _connect_to_server(server: Server, backend: Backend) -> typing.Tuple[asyncua.Client, Subscription]:
-    client = asyncua.Client(server.url, timeout=10)
-    connected = False
-    connection_error = ''
-    subscription: Subscription
+# while the API is not available the servers and nodes known so far are kept
+async def sync_servers(inventory: Inventory) -> typing.List[Server]:
     try:
-        await client.connect()
-        await client.load_data_type_definitions()
-        subscription = await client.create_subscription(1000, SubHandler(server.id, backend))
-
-    except UaStatusCodeError as error:  # type: ignore
-        connection_error = f"UaStatusCodeError({error.code})"
-    except CancelledError:
-        connection_error = 'CancelledError'
-    except OSError:
-        connection_error = 'OSError'
-    except UaError:
-        connection_error = 'UaError'
-    if not connected or connection_error != '':
-        backend.server_update(server.id, connection_error)
-    return client, subscription
-
-
-# write new data to opcua server
-async def run_update(backend: Backend, clients: typing.Dict[int, asyncua.Client]):
-    node_list: typing.List[NodeModel] = backend.node_index_requiring_update()
-    for node in node_list:
-        try:
-            await clients[node.server_id].get_node(node.identifier).write_value(node.change_value)
-            backend.node_value_writen(node.id)
-        except Exception as exception:
-            backend.node_value_writing_error(node.id, str(exception))
+        return await inventory.sync_servers()
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as error:
+        print(f'could not sync servers: {error!r}')
+        return list(inventory.servers.values())
+
+
+async def sync_nodes(inventory: Inventory) -> typing.Dict[int, typing.Dict[int, typing.Optional[NodeModel]]]:
+    try:
+        return await inventory.sync_nodes()
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as error:
+        print(f'could not sync nodes: {error!r}')
+        return {}
+
+
+# filter servers to all that qualify
+def select_servers(servers: typing.List[Server], filter_time: int, shard: typing.Optional[Shard]) -> typing.List[Server]:
+    server_list = []
+    for s in servers:  # TODO filter on server side
+        if s.checked_at >= s.updated_at and s.checked_at > filter_time:
+            server_list.append(s)
+    if shard is not None:
+        owned = set(shard.owns([s.id for s in server_list]))
+        server_list = [s for s in server_list if s.id in owned]
+    return server_list
+
+
+# apply the node changes to the subscriptions of the connected servers
+async def apply_changes(
+    connections: ConnectionManager,
+    connected: typing.Dict[int, ServerConnection],
+    applied: typing.Dict[int, typing.Tuple[typing.Union[Subscriptions, Polling], int]],
+    inventory: Inventory,
+    changes: typing.Dict[int, typing.Dict[int, typing.Optional[NodeModel]]],
+):
+    updates = []
+    for server_id, connection in connected.items():
+        if applied.get(server_id) != (connection.subscriptions, connection.restores):
+            applied[server_id] = (connection.subscriptions, connection.restores)
+            updates.append(connection.subscriptions.apply(inventory.server_nodes.get(server_id, {})))
+        else:
+            updates.append(connection.subscriptions.update(changes.get(server_id, {})))
+    await asyncio.gather(*updates)
+    for server_id in [server_id for server_id in applied if server_id not in connections.connections]:
+        del applied[server_id]
+
+
+def update_metrics(connections: ConnectionManager, connected: typing.Dict[int, ServerConnection]):
+    for state, count in connections.states().items():
+        metrics.CONNECTIONS.labels(state).set(count)
+    metrics.SUBSCRIPTIONS.clear()
+    metrics.MONITORED_ITEMS.clear()
+    for server_id, connection in connected.items():
+        metrics.SUBSCRIPTIONS.labels(str(server_id)).set(len(connection.subscriptions.groups))
+        metrics.MONITORED_ITEMS.labels(str(server_id)).set(len(connection.subscriptions))
 
 
 async def main():
-    backend: Backend = Backend(
+    backend: AsyncBackend = AsyncBackend(
         os.getenv('API_URL', 'http://api/'),
         os.environ['ACCESS_TOKEN'],
+        int(os.getenv('API_MAX_CONNECTIONS', '10')),
+        page_size=int(os.getenv('API_PAGE_SIZE', '0')),
+    )
+    shard: typing.Optional[Shard] = make_shard()
+    heartbeat: typing.Optional[asyncio.Task] = None
+    if shard is not None:
+        heartbeat = asyncio.create_task(shard.run())
+    sink: typing.Union[AsyncBackend, InfluxWriter] = make_sink(backend)
+    ingest: IngestQueue = IngestQueue(
+        sink,
+        max_size=int(os.getenv('INGEST_QUEUE_SIZE', '100000')),
+        max_batch_size=int(os.getenv('INGEST_BATCH_SIZE', '5000')),
+        max_batch_age=float(os.getenv('INGEST_BATCH_AGE', '0.5')),
+        block=os.getenv('INGEST_BLOCK', '0') == '1',
+        spool=make_spool(shard),
+    )
+    ingest.start()
+    profiler: Profiler = Profiler(
+        os.getenv('PROFILE_DIR', '/tmp/opcua_collector_profiles'),
+        mode=os.getenv('PROFILE_MODE', 'cprofile'),
+        interval=float(os.getenv('PROFILE_INTERVAL', '60')),
+        slow_callback=float(os.getenv('PROFILE_SLOW_CALLBACK', '0.1')),
+    )
+    if os.getenv('PROFILE', '0') == '1':
+        profiler.enable()
+    # kill -USR1 switches profiling on and off while running
+    asyncio.get_running_loop().add_signal_handler(signal.SIGUSR1, profiler.toggle)
+    events: IngestQueue = IngestQueue(
+        backend,
+        max_size=int(os.getenv('EVENT_QUEUE_SIZE', '10000')),
+        max_batch_size=int(os.getenv('EVENT_BATCH_SIZE', '1000')),
+        max_batch_age=float(os.getenv('EVENT_BATCH_AGE', '1')),
+        store='event_store_batch',
+    )
+    events.start()
+    loop_lag: typing.Optional[asyncio.Task] = None
+    if os.getenv('METRICS_PORT') is not None:
+        metrics.start(int(os.getenv('METRICS_PORT')), ingest.stats)
+        loop_lag = asyncio.create_task(metrics.monitor_loop_lag())
+    live_api: typing.Optional[LiveApi] = make_live_api()
+    cache: typing.Optional[LastValueCache] = None
+    if live_api is not None:
+        cache = live_api.cache
+        await live_api.start()
+    encoder: EncoderPool = EncoderPool(
+        workers=int(os.getenv('ENCODE_WORKERS', '0')),
+        kind=os.getenv('ENCODE_WORKER_KIND', 'thread'),
+    )
+    connections: ConnectionManager = ConnectionManager(
+        backend,
+        ingest,
+        max_concurrency=int(os.getenv('CONNECT_CONCURRENCY', '10')),
+        timeout=float(os.getenv('CONNECT_TIMEOUT', '10')),
+        min_backoff=float(os.getenv('CONNECT_MIN_BACKOFF', '1')),
+        max_backoff=float(os.getenv('CONNECT_MAX_BACKOFF', '300')),
+        max_attempts=int(os.getenv('CONNECT_MAX_ATTEMPTS', '0')),
+        max_items_per_call=int(os.getenv('MONITORED_ITEMS_PER_CALL', '1000')),
+        defaults=MonitoringSettings(
+            publishing_interval=float(os.getenv('PUBLISHING_INTERVAL', '1000')),
+            sampling_interval=float(os.getenv('SAMPLING_INTERVAL', '50')),
+            queue_size=int(os.getenv('QUEUE_SIZE', '0')),
+            deadband_type=os.getenv('DEADBAND_TYPE'),
+            deadband_value=float(os.getenv('DEADBAND_VALUE', '0')),
+        ),
+        cache=cache,
+        compression=CompressionPolicy(
+            kind=os.getenv('COMPRESSION'),
+            deviation=float(os.getenv('COMPRESSION_DEVIATION', '0')),
+            max_interval=float(os.getenv('COMPRESSION_MAX_INTERVAL', '3600')),
+            window=float(os.getenv('COMPRESSION_WINDOW', '60')),
+        ),
+        timestamp_source=os.getenv('TIMESTAMP_SOURCE', 'server'),
+        watchdog_interval=float(os.getenv('CONNECT_WATCHDOG_INTERVAL', '5')),
+        reconnect_timeout=float(os.getenv('CONNECT_RECONNECT_TIMEOUT', '60')),
+        types=TypeCache(
+            os.getenv('TYPE_CACHE_DIR'),
+            max_age=float(os.getenv('TYPE_CACHE_MAX_AGE', str(24 * 60 * 60))),
+        ),
+        acquisition_mode=os.getenv('ACQUISITION_MODE', 'subscription'),
+        max_nodes_per_read=int(os.getenv('POLL_NODES_PER_READ', '1000')),
+        max_poll_slowdown=float(os.getenv('POLL_MAX_SLOWDOWN', '8')),
+        event_settings=EventSettings(
+            enabled=os.getenv('EVENTS', '0') == '1',
+            fields=tuple(os.getenv('EVENT_FIELDS', ','.join(DEFAULT_FIELDS)).split(',')),
+            types=tuple(t for t in os.getenv('EVENT_TYPES', '').split(',') if t),
+            min_severity=int(os.getenv('EVENT_MIN_SEVERITY', '0')),
+            source=os.getenv('EVENT_SOURCE', 'i=2253'),
+        ),
+        events=events,
+        encoder=encoder,
+    )
+    inventory: Inventory = Inventory(
+        backend,
+        full_sync_interval=float(os.getenv('SYNC_FULL_INTERVAL', '3600')),
+    )
+    # the subscriptions each server's tracked nodes were last applied to and the
+    # number of restores at that time, a reconnected server gets new ones that
+    # need all of its nodes, restored ones may have lost some monitored items
+    applied: typing.Dict[int, typing.Tuple[typing.Union[Subscriptions, Polling], int]] = {}
+    write_back: WriteBack = WriteBack(
+        backend,
+        connections,
+        interval=float(os.getenv('WRITE_INTERVAL', '5')),
+    )
+    write_back.start()
+    scans: Scans = Scans(
+        backend,
+        ScanSettings(
+            concurrency=int(os.getenv('SCAN_CONCURRENCY', '4')),
+            max_rate=float(os.getenv('SCAN_MAX_RATE', '50')),
+            max_depth=int(os.getenv('SCAN_MAX_DEPTH', '20')),
+            max_references=int(os.getenv('SCAN_MAX_REFERENCES', '1000')),
+        ),
+        directory=os.getenv('SCAN_CACHE_DIR'),
+        max_age=float(os.getenv('SCAN_CACHE_MAX_AGE', str(24 * 60 * 60))),
+        retry_interval=float(os.getenv('SCAN_RETRY_INTERVAL', str(10 * 60))),
     )
-    clients: typing.Dict[int, asyncua.Client] = {}
-    server_subscriptions: typing.Dict[int, Subscription] = {}
-    node_subscriptions: typing.Dict[int, any] = {}
 
     try:
         while True:
@@ -91,80 +292,56 @@ async def main():
             check_time = int(time.time())
             filter_time = check_time - 5 * 60
 
-            # filter servers to all that qualify
-            server_list = []
-            for s in backend.server_index():  # TODO filter on server side
-                if s.checked_at >= s.updated_at and s.checked_at > filter_time:
-                    server_list.append(s)
-
-            # connect and subscribe to all servers if not already done
-            server_ids = []
-            for server in server_list:
-                server_ids.append(server.id)
-                if server.id not in clients or server.id not in server_subscriptions:
-                    clients[server.id], server_subscriptions[server.id] = await _connect_to_server(
-                        server, backend)
-
-            # disconnect from all servers that no longer exist
-            server_keys = clients.keys()
-            for server_id in server_keys:
-                if server_id not in server_ids:
-                    if server_id in server_subscriptions:  # might not exist if init sequence fails for a server
-                        del server_subscriptions[server_id]
-                    await clients[server_id].disconnect()
-                    del clients[server_id]
-
-            node_list: typing.List[NodeModel] = backend.node_index_filtered()
-
-            # temp list to make unsubscribing easier
-            node_ids = []
-            for n in node_list:
-                node_ids.append(n.id)
-
-                if n.id not in node_subscriptions \
-                        and n.server_id in clients \
-                        and n.server_id in server_subscriptions:
-                    client = clients[n.server_id]
-                    node: Node = client.get_node(n.identifier)
-                    try:
-                        node_subscriptions[n.id] = {
-                            'server_id': n.server_id,
-                            'subscription': await server_subscriptions[n.server_id].subscribe_data_change(node)
-                        }
-                    except UaStatusCodeError as error:  # type: ignore
-                        print(f"UaStatusCodeError({error.code})")
-
-            # unsubscribe nodes that are no long available / tracked
-            node_subscriptions_keys = node_subscriptions.keys()
-            for n.id in node_subscriptions_keys:
-                if n.id not in node_ids:
-                    try:
-                        await server_subscriptions[node_subscriptions[n.id]['server_id']] \
-                            .unsubscribe(node_subscriptions[n.id]['subscription'])
-                    except BadMonitoredItemIdInvalid:  # type: ignore
-                        pass
-                    del node_subscriptions[n.id]
-
-            for _ in range(round(60 / 5)):
-                await run_update(backend, clients)
-                await asyncio.sleep(5)
+            server_list = select_servers(await sync_servers(inventory), filter_time, shard)
+
+            # connect to new servers and disconnect from all servers that no longer exist,
+            # slow servers are not waited for longer than one connection timeout
+            await connections.update(server_list)
+            await connections.wait(connections.timeout)
+            connected = connections.connected()
+            scans.update(connected)
+
+            # subscribe new and unsubscribe no longer tracked nodes, only changes are applied
+            # unless the server was (re)connected since the last cycle
+            changes = await sync_nodes(inventory)
+            await apply_changes(connections, connected, applied, inventory, changes)
+            update_metrics(connections, connected)
+
+            print(f'servers: {connections.states()}')
+            print(f'ingest: {ingest.stats()}')
+            print(f'events: {events.stats()}')
+            print(f'write back: {write_back.written} written, {write_back.errors} errors')
+
+            await asyncio.sleep(60)
 
     finally:
         # try to close all remaining open connections
-        for server in clients.values():
-            try:
-                await server.disconnect()
-            except AttributeError:
-                print('AttributeError while disconnecting')
-            except UaStatusCodeError as error:  # type: ignore
-                print(f"UaStatusCodeError({error.code})")
-            except CancelledError:
-                print('CancelledError while disconnecting')
-            except OSError:
-                print('OSError while disconnecting')
-            except UaError:
-                print('UaError while disconnecting')
+        if loop_lag is not None:
+            loop_lag.cancel()
+        await write_back.close()
+        await scans.close()
+        if live_api is not None:
+            await live_api.close()
+        await connections.close()
+        encoder.close()
+        profiler.disable()
+        await ingest.close()
+        await events.close()
+        if sink is not backend:
+            await sink.close()
+        await backend.close()
+        if shard is not None:
+            heartbeat.cancel()
+            shard.leave()
 
 
-if __name__ == '__main__':
+def run():
     asyncio.run(main())
+
+
+if __name__ == '__main__':
+    if int(os.getenv('COLLECTOR_WORKERS', '1')) > 1:
+        # the workers of other replicas sharing SHARD_DIR need other names
+        run_workers(int(os.getenv('COLLECTOR_WORKERS')), run, os.getenv('SHARD_NAME') or socket.gethostname())
+    else:
+        run()
@@ -0,0 +1,134 @@
+# Copyright (C) 2022 Robin Jespersen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+from typing import Callable
+
+from prometheus_client import Counter, Gauge, Histogram, REGISTRY, start_http_server
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+NOTIFICATIONS = Counter(
+    'opcua_collector_notifications',
+    'data change notifications received',
+    ['server_id'],
+)
+NOTIFICATIONS_DROPPED = Counter(
+    'opcua_collector_notifications_dropped',
+    'data change notifications dropped because too many were waiting to be encoded',
+    ['server_id'],
+)
+HANDLER_LATENCY = Histogram(
+    'opcua_collector_handler_seconds',
+    'time spent in the callback of one data change notification',
+    ['server_id'],
+    buckets=(0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.1, 1),
+)
+ENCODE_LATENCY = Histogram(
+    'opcua_collector_encode_seconds',
+    'time spent converting one batch of received values to samples',
+    ['server_id'],
+)
+BACKEND_LATENCY = Histogram(
+    'opcua_collector_backend_request_seconds',
+    'duration of requests to the API',
+    ['method', 'endpoint'],
+)
+BACKEND_ERRORS = Counter(
+    'opcua_collector_backend_errors',
+    'failed requests to the API, by status code or exception',
+    ['method', 'endpoint', 'error'],
+)
+CONNECTION_ATTEMPTS = Counter(
+    'opcua_collector_connection_attempts',
+    'connection attempts to OPC UA servers',
+    ['server_id', 'result'],
+)
+CONNECTIONS = Gauge(
+    'opcua_collector_connections',
+    'connections to OPC UA servers by state',
+    ['state'],
+)
+SUBSCRIPTIONS = Gauge(
+    'opcua_collector_subscriptions',
+    'subscriptions per server',
+    ['server_id'],
+)
+MONITORED_ITEMS = Gauge(
+    'opcua_collector_monitored_items',
+    'monitored items per server',
+    ['server_id'],
+)
+READ_LATENCY = Histogram(
+    'opcua_collector_read_seconds',
+    'duration of one Read call of polled nodes',
+    ['server_id'],
+)
+POLL_OVERRUNS = Counter(
+    'opcua_collector_poll_overruns',
+    'polling cycles skipped because the previous one took too long',
+    ['server_id'],
+)
+POLL_SLOWDOWN = Gauge(
+    'opcua_collector_poll_slowdown',
+    'factor the polling intervals of a server are stretched by',
+    ['server_id'],
+)
+STAGE_LATENCY = Histogram(
+    'opcua_collector_stage_seconds',
+    'duration of the timed stages while profiling is enabled',
+    ['stage'],
+)
+SLOW_CALLBACKS = Counter(
+    'opcua_collector_slow_callbacks',
+    'event loop callbacks slower than the threshold while profiling is enabled',
+)
+LOOP_LAG = Histogram(
+    'opcua_collector_event_loop_lag_seconds',
+    'delay of a scheduled callback, high values mean the event loop is blocked',
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5),
+)
+
+
+class StatsCollector:
+    """
+    Exposes the counters of an IngestQueue at the time of the scrape.
+    """
+
+    def __init__(self, stats: Callable[[], dict]):
+        self.stats = stats
+
+    def collect(self):
+        stats = self.stats()
+        yield GaugeMetricFamily('opcua_collector_ingest_queue_depth', 'samples waiting to be stored', value=stats['depth'])
+        samples = CounterMetricFamily('opcua_collector_ingest_samples', 'samples by outcome', labels=['outcome'])
+        for outcome in ('sent', 'dropped', 'failed', 'spooled', 'rejected'):
+            samples.add_metric([outcome], stats[outcome])
+        yield samples
+
+
+def start(port: int, stats: Callable[[], dict]):
+    """
+    serves the metrics on port from a background thread
+    """
+    REGISTRY.register(StatsCollector(stats))
+    start_http_server(port)
+
+
+async def monitor_loop_lag(interval: float = 0.5):
+    loop = asyncio.get_running_loop()
+    while True:
+        scheduled = loop.time() + interval
+        await asyncio.sleep(interval)
+        LOOP_LAG.observe(max(0.0, loop.time() - scheduled))
@@ -13,25 +13,38 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+from typing import Optional
+
+
 class Node:
+    """
+    A tracked node as listed by the API, only the fields the collector uses are kept.
+    """
+    __slots__ = (
+        'id', 'updated_at', 'server_id', 'identifier', 'tracked', 'virtual', 'change_value',
+        'publishing_interval', 'sampling_interval', 'queue_size', 'deadband_type', 'deadband_value',
+        'compression', 'compression_deviation', 'compression_max_interval', 'compression_window',
+    )
+
     def __init__(self, data):
         self.id: int = data['id']
-        self.created_at: int = data['created_at']
         self.updated_at: int = data['updated_at']
-        self.created_by: int = data['created_by']
-        self.updated_by: int = data['updated_by']
 
         self.server_id: int = data['server_id']
         self.identifier: str = data['identifier']
-        self.display_name: str = data['display_name']
-        self.checked_at: int = data['checked_at']
         self.tracked: bool = data['tracked']
-        self.path: str = data['path']
-        self.data_type: str = data['data_type']
-        self.readable: bool = data['readable']
-        self.writable: bool = data['writable']
         self.virtual: bool = data['virtual']
-        self.parent_identifier: int = data['parent_identifier']
         self.change_value: int = data['change_value']
-        self.change_error_at: int = data['change_error_at']
-        self.change_error: int = data['change_error']
+
+        # monitoring settings, None uses the defaults of the collector
+        self.publishing_interval: Optional[float] = data.get('publishing_interval')
+        self.sampling_interval: Optional[float] = data.get('sampling_interval')
+        self.queue_size: Optional[int] = data.get('queue_size')
+        self.deadband_type: Optional[str] = data.get('deadband_type')  # absolute or percent
+        self.deadband_value: Optional[float] = data.get('deadband_value')
+
+        # compression before storing, None uses the defaults of the collector
+        self.compression: Optional[str] = data.get('compression')  # dedup, deadband, swinging_door or aggregate
+        self.compression_deviation: Optional[float] = data.get('compression_deviation')
+        self.compression_max_interval: Optional[float] = data.get('compression_max_interval')
+        self.compression_window: Optional[float] = data.get('compression_window')
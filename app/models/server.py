@@ -13,20 +13,33 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+from typing import Optional
+
+
 class Server:
+    """
+    A server as listed by the API, only the fields the collector uses are kept.
+    """
+    __slots__ = (
+        'id', 'updated_at', 'name', 'url', 'checked_at', 'scan_required', 'root_node',
+        'acquisition_mode', 'events', 'event_fields', 'event_types', 'event_min_severity',
+    )
+
     def __init__(self, data):
         self.id: int = data['id']
-        self.created_at: int = data['created_at']
         self.updated_at: int = data['updated_at']
-        self.created_by: int = data['created_by']
-        self.updated_by: int = data['updated_by']
 
-        self.sort: int = data['sort']
         self.name: str = data['name']
         self.url: str = data['url']
-        self.description: str = data['description']
         self.checked_at: int = data['checked_at']
         self.scan_required: bool = data['scan_required']
-        self.has_connection_error: bool = data['has_connection_error']
-        self.connection_error: str = data['connection_error']
         self.root_node: str = data['root_node']
+
+        # subscription or polling, None uses the default of the collector
+        self.acquisition_mode: Optional[str] = data.get('acquisition_mode')
+
+        # event collection, None uses the defaults of the collector
+        self.events: Optional[bool] = data.get('events')
+        self.event_fields: Optional[str] = data.get('event_fields')  # comma separated browse paths
+        self.event_types: Optional[str] = data.get('event_types')  # comma separated node ids
+        self.event_min_severity: Optional[int] = data.get('event_min_severity')
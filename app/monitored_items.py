@@ -0,0 +1,223 @@
+# Copyright (C) 2022 Robin Jespersen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+from typing import Dict, List, NamedTuple, Optional, Set
+
+import asyncua
+from asyncua import ua
+# Subscription._make_monitored_item_request and Subscription._monitored_items are
+# not public API of asyncua, requirements.txt pins the major version they are used with
+from asyncua.common.subscription import Subscription
+from asyncua.ua import UaError, UaStatusCodeError
+
+from models.node import Node as NodeModel
+from operation_limits import chunks
+from type_cache import parse_node_id
+
+DEADBAND_TYPES = {
+    'absolute': ua.DeadbandType.Absolute,
+    'percent': ua.DeadbandType.Percent,
+}
+
+
+class MonitoringSettings(NamedTuple):
+    publishing_interval: float = 1000
+    sampling_interval: float = 50
+    queue_size: int = 0
+    deadband_type: Optional[str] = None
+    deadband_value: float = 0
+
+    def of(self, node: NodeModel) -> 'MonitoringSettings':
+        """
+        settings of the node, settings the node does not set are taken from self
+        """
+        return MonitoringSettings(
+            self.publishing_interval if node.publishing_interval is None else node.publishing_interval,
+            self.sampling_interval if node.sampling_interval is None else node.sampling_interval,
+            self.queue_size if node.queue_size is None else node.queue_size,
+            self.deadband_type if node.deadband_type is None else node.deadband_type,
+            self.deadband_value if node.deadband_value is None else node.deadband_value,
+        )
+
+    def filter(self) -> Optional[ua.DataChangeFilter]:
+        if self.deadband_type is None:
+            return None
+        data_change_filter = ua.DataChangeFilter()
+        data_change_filter.Trigger = ua.DataChangeTrigger.StatusValue
+        data_change_filter.DeadbandType = DEADBAND_TYPES[self.deadband_type]
+        data_change_filter.DeadbandValue = float(self.deadband_value)
+        return data_change_filter
+
+
+class MonitoredItems:
+    """
+    Monitored items of one subscription, keyed by the id of the node in the API.
+
+    apply() compares the tracked nodes with the current monitored items and
+    creates and deletes the difference with as few calls as possible, each call
+    carries at most max_per_call items. update() does the same for changed nodes
+    only, nodes that could not be subscribed are retried with every update().
+    A node whose identifier or monitoring settings changed is subscribed again.
+    When a call fails, e.g. because the server is slow or reconnecting, its
+    nodes stay pending, and monitored items that could not be deleted are
+    deleted again with every update() before their nodes are subscribed again.
+
+    Items are kept by their client handle, it stays the same when the client
+    transfers or recreates the subscription after a reconnect while the server
+    handle may change. Items the server dropped while recreating are
+    subscribed again by the next apply().
+    """
+
+    def __init__(
+        self,
+        client: asyncua.Client,
+        subscription: Subscription,
+        max_per_call: int = 1000,
+        defaults: MonitoringSettings = MonitoringSettings(),
+    ):
+        self.client = client
+        self.subscription = subscription
+        self.max_per_call = max_per_call
+        self.defaults = defaults
+
+        # client handles
+        self.handles: Dict[int, int] = {}
+        self.identifiers: Dict[int, str] = {}
+        self.settings: Dict[int, MonitoringSettings] = {}
+        self.pending: Dict[int, NodeModel] = {}
+        # nodes whose monitored items could not be deleted
+        self.stale: Set[int] = set()
+
+    def __len__(self) -> int:
+        return len(self.handles)
+
+    async def apply(self, nodes: Dict[int, NodeModel]) -> Dict[int, str]:
+        """
+        subscribes to all nodes that are not monitored yet and unsubscribes from the rest,
+        returns the error for every node that could not be (un)subscribed
+        """
+        changes: Dict[int, Optional[NodeModel]] = dict(nodes)
+        changes.update({node_id: None for node_id in self.identifiers if node_id not in nodes})
+        self.pending.clear()
+        return await self.update(changes)
+
+    async def update(self, changes: Dict[int, Optional[NodeModel]]) -> Dict[int, str]:
+        """
+        applies changed nodes, None unsubscribes the node,
+        returns the error for every node that could not be (un)subscribed
+        """
+        errors: Dict[int, str] = {}
+        for node_id, node in changes.items():
+            if node is not None and self._monitored(node):
+                self.pending.pop(node_id, None)
+                self.stale.discard(node_id)
+            elif node is None:
+                self.pending.pop(node_id, None)
+            else:
+                self.pending[node_id] = node
+        removed = [
+            node_id for node_id, node in changes.items()
+            if node_id in self.identifiers and (node is None or node_id in self.pending)
+        ]
+        removed.extend(node_id for node_id in self.stale if node_id not in changes)
+        await self.delete(removed, errors)
+        await self.create([node for node_id, node in self.pending.items() if node_id not in self.stale], errors)
+        for node_id, error in errors.items():
+            print(f'could not (un)subscribe node {node_id}: {error}')
+        return errors
+
+    async def create(self, nodes: List[NodeModel], errors: Dict[int, str]):
+        for chunk in chunks(self._requests(nodes, errors), self.max_per_call):
+            try:
+                results = await self.subscription.create_monitored_items([request for _, _, request in chunk])
+            except UaStatusCodeError as error:  # type: ignore
+                errors.update({node.id: f"UaStatusCodeError({error.code})" for node, _, _ in chunk})
+                continue
+            except (UaError, OSError, asyncio.TimeoutError) as error:  # type: ignore
+                # the nodes stay pending and are subscribed by the next update()
+                errors.update({node.id: repr(error) for node, _, _ in chunk})
+                continue
+            for (node, settings, request), result in zip(chunk, results):
+                if isinstance(result, ua.StatusCode):
+                    errors[node.id] = f"UaStatusCodeError({result.value})"
+                    continue
+                self.handles[node.id] = request.RequestedParameters.ClientHandle
+                self.identifiers[node.id] = node.identifier
+                self.settings[node.id] = settings
+                del self.pending[node.id]
+
+    def _requests(self, nodes: List[NodeModel], errors: Dict[int, str]) -> list:
+        """
+        the monitored item requests of the nodes with their settings
+        """
+        requests = []
+        for node in nodes:
+            settings = self.defaults.of(node)
+            try:
+                # the request reserves a client handle in the subscription, create_monitored_items() needs it
+                request = self.subscription._make_monitored_item_request(
+                    self.client.get_node(parse_node_id(node.identifier)),
+                    ua.AttributeIds.Value,
+                    settings.filter(),
+                    settings.queue_size,
+                    ua.MonitoringMode.Reporting,
+                    settings.sampling_interval,
+                )
+            except KeyError:
+                errors[node.id] = f'unknown deadband type {settings.deadband_type!r}'
+                continue
+            except (UaError, ValueError) as error:
+                errors[node.id] = repr(error)
+                continue
+            requests.append((node, settings, request))
+        return requests
+
+    async def delete(self, node_ids: List[int], errors: Dict[int, str]):
+        for chunk in chunks(node_ids, self.max_per_call):
+            # items the server dropped are only forgotten
+            server_handles = [
+                self.subscription._monitored_items[self.handles[node_id]].server_handle
+                for node_id in chunk if self._alive(node_id)
+            ]
+            try:
+                if server_handles:
+                    await self.subscription.unsubscribe(server_handles)
+            except ua.uaerrors.BadMonitoredItemIdInvalid:  # type: ignore
+                pass
+            except UaStatusCodeError as error:  # type: ignore
+                # the items are forgotten anyway, they will be gone with the subscription
+                errors.update({node_id: f"UaStatusCodeError({error.code})" for node_id in chunk})
+            except (UaError, OSError, asyncio.TimeoutError) as error:  # type: ignore
+                # the items may still exist on the server, they are deleted by the next update()
+                errors.update({node_id: repr(error) for node_id in chunk})
+                self.stale.update(chunk)
+                continue
+            for node_id in chunk:
+                self.stale.discard(node_id)
+                del self.handles[node_id]
+                del self.identifiers[node_id]
+                del self.settings[node_id]
+
+    def _monitored(self, node: NodeModel) -> bool:
+        return (
+            self.identifiers.get(node.id) == node.identifier
+            and self.settings[node.id] == self.defaults.of(node)
+            and self._alive(node.id)
+        )
+
+    def _alive(self, node_id: int) -> bool:
+        item = self.subscription._monitored_items.get(self.handles[node_id])
+        return item is not None and item.server_handle is not None
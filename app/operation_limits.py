@@ -0,0 +1,55 @@
+# Copyright (C) 2022 Robin Jespersen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from typing import Dict, Iterator, List, TypeVar
+
+import asyncua
+from asyncua import ua
+from asyncua.ua import UaError
+
+T = TypeVar('T')
+
+LIMITS = {
+    'MaxMonitoredItemsPerCall': ua.ObjectIds.Server_ServerCapabilities_OperationLimits_MaxMonitoredItemsPerCall,
+    'MaxNodesPerRead': ua.ObjectIds.Server_ServerCapabilities_OperationLimits_MaxNodesPerRead,
+    'MaxNodesPerWrite': ua.ObjectIds.Server_ServerCapabilities_OperationLimits_MaxNodesPerWrite,
+    'MaxNodesPerBrowse': ua.ObjectIds.Server_ServerCapabilities_OperationLimits_MaxNodesPerBrowse,
+}
+
+
+async def read_operation_limits(client: asyncua.Client) -> Dict[str, int]:
+    """
+    reads the operation limits of the server with one request, 0 means no limit
+    """
+    try:
+        values = await client.read_attributes([client.get_node(node_id) for node_id in LIMITS.values()])
+    except (UaError, OSError) as error:
+        print(f'could not read operation limits: {error!r}')
+        return {name: 0 for name in LIMITS}
+    limits = {}
+    for name, value in zip(LIMITS, values):
+        limit = value.Value.Value if value.StatusCode.is_good() and value.Value is not None else None
+        limits[name] = limit if isinstance(limit, int) else 0
+    return limits
+
+
+def chunks(items: List[T], size: int) -> Iterator[List[T]]:
+    """
+    splits items into lists of at most size items, size 0 means no limit
+    """
+    if size <= 0:
+        size = max(len(items), 1)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
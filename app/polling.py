@@ -0,0 +1,226 @@
+# Copyright (C) 2022 Robin Jespersen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import math
+import time
+from typing import Dict, List, Optional, Tuple
+
+import asyncua
+from asyncua import ua
+from asyncua.ua import UaError
+
+from compression import Compression
+from metrics import POLL_OVERRUNS, POLL_SLOWDOWN, READ_LATENCY
+from models.node import Node as NodeModel
+from monitored_items import MonitoringSettings
+from operation_limits import chunks
+from type_cache import parse_node_id
+
+# share of the interval the reads of a cycle may take before the intervals are stretched
+HIGH_LOAD = 0.8
+# share of the interval below which stretched intervals shrink again
+LOW_LOAD = 0.25
+
+
+class PollGroup:
+    """
+    Nodes of one server that are read together every interval milliseconds.
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+
+        self.identifiers: Dict[int, str] = {}
+        self.node_ids: Dict[int, ua.NodeId] = {}
+        # value and status code of the last read, only changes are stored
+        self.last: Dict[int, Tuple[Optional[ua.Variant], ua.StatusCode]] = {}
+        # read parameters and the nodes they read, built again when the nodes change
+        self.requests: Optional[List[Tuple[List[int], ua.ReadParameters]]] = None
+        self.task: Optional[asyncio.Task] = None
+        self.error: str = ''
+
+    def __len__(self) -> int:
+        return len(self.node_ids)
+
+
+class Polling:
+    """
+    Reads the nodes of one server with cyclic Read calls instead of subscribing to them.
+
+    Nodes are grouped by their publishing interval. Every group is read on a
+    fixed schedule relative to its start so it does not drift, cycles missed
+    because the previous one took too long are skipped. Reads are split into
+    calls of at most max_per_read nodes and the groups of a server never read
+    at the same time. When a cycle takes more than HIGH_LOAD of its interval the
+    intervals of the server are doubled up to max_slowdown times, below LOW_LOAD
+    they shrink back gradually. Like a subscription only values whose value or
+    status code changed are passed to handler.store().
+    """
+
+    def __init__(
+        self,
+        client: asyncua.Client,
+        handler,
+        max_per_read: int = 1000,
+        defaults: MonitoringSettings = MonitoringSettings(),
+        compression: Optional[Compression] = None,
+        max_slowdown: float = 8,
+    ):
+        self.client = client
+        self.handler = handler
+        self.max_per_read = max_per_read
+        self.defaults = defaults
+        self.compression = compression
+        self.max_slowdown = max_slowdown
+
+        self.groups: Dict[float, PollGroup] = {}
+        self.intervals: Dict[int, float] = {}
+        self.slowdown: float = 1
+        self.overruns: int = 0
+        self._lock = asyncio.Lock()
+        self._latency = READ_LATENCY.labels(str(handler.server_id))
+        self._overruns = POLL_OVERRUNS.labels(str(handler.server_id))
+        self._slowdown = POLL_SLOWDOWN.labels(str(handler.server_id))
+
+    def __len__(self) -> int:
+        return sum(len(group) for group in self.groups.values())
+
+    async def apply(self, nodes: Dict[int, NodeModel]) -> Dict[int, str]:
+        """
+        polls all nodes that are not polled yet and stops polling the rest,
+        returns the error for every node that could not be polled
+        """
+        changes: Dict[int, Optional[NodeModel]] = dict(nodes)
+        changes.update({node_id: None for node_id in self.intervals if node_id not in nodes})
+        return await self.update(changes)
+
+    async def update(self, changes: Dict[int, Optional[NodeModel]]) -> Dict[int, str]:
+        """
+        applies changed nodes to the group of their publishing interval, None stops polling the node,
+        returns the error for every node that could not be polled
+        """
+        if self.compression is not None:
+            self.compression.configure(changes)
+        errors: Dict[int, str] = {}
+        for node_id, node in changes.items():
+            previous = self.intervals.pop(node_id, None)
+            if previous is not None:
+                self._remove(self.groups[previous], node_id)
+            if node is None:
+                continue
+            try:
+                parsed = parse_node_id(node.identifier)
+            except (UaError, ValueError) as error:
+                errors[node_id] = repr(error)
+                continue
+            interval = self.defaults.of(node).publishing_interval
+            group = self.groups.get(interval)
+            if group is None:
+                group = self.groups[interval] = PollGroup(interval)
+                group.task = asyncio.create_task(self._run(group))
+            group.identifiers[node_id] = parsed.to_string()
+            group.node_ids[node_id] = parsed
+            group.requests = None
+            self.intervals[node_id] = interval
+
+        for interval in [interval for interval, group in self.groups.items() if not group]:
+            await self._stop(self.groups.pop(interval))
+        for node_id, error in errors.items():
+            print(f'could not poll node {node_id}: {error}')
+        return errors
+
+    async def close(self):
+        for group in self.groups.values():
+            await self._stop(group)
+        self.groups.clear()
+        self.intervals.clear()
+
+    async def read(self, group: PollGroup):
+        """
+        reads all nodes of the group once and stores the changed values
+        """
+        if group.requests is None:
+            group.requests = []
+            for node_ids in chunks(list(group.node_ids), self.max_per_read):
+                parameters = ua.ReadParameters()
+                parameters.TimestampsToReturn = ua.TimestampsToReturn.Both
+                for node_id in node_ids:
+                    read_value = ua.ReadValueId()
+                    read_value.NodeId = group.node_ids[node_id]
+                    read_value.AttributeId = ua.AttributeIds.Value
+                    parameters.NodesToRead.append(read_value)
+                group.requests.append((node_ids, parameters))
+        async with self._lock:
+            for node_ids, parameters in group.requests:
+                started = time.perf_counter()
+                results = await self.client.uaclient.read(parameters)
+                self._latency.observe(time.perf_counter() - started)
+                for node_id, result in zip(node_ids, results):
+                    # the node may have been removed while reading
+                    identifier = group.identifiers.get(node_id)
+                    last = (result.Value, result.StatusCode)
+                    if identifier is None or group.last.get(node_id) == last:
+                        continue
+                    group.last[node_id] = last
+                    await self.handler.store(
+                        identifier, result.Value.Value if result.Value is not None else None, result,
+                    )
+
+    async def _run(self, group: PollGroup):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time()
+        while True:
+            started = loop.time()
+            error = ''
+            try:
+                await self.read(group)
+            except (UaError, OSError, asyncio.TimeoutError) as e:  # type: ignore
+                error = repr(e)
+            if error != group.error:
+                print(f'could not poll nodes with interval {group.interval}: {error}' if error else
+                      f'polling nodes with interval {group.interval} again')
+                group.error = error
+            now = loop.time()
+            self._adapt((now - started) / (group.interval / 1000 * self.slowdown))
+            interval = group.interval / 1000 * self.slowdown
+            deadline += interval
+            if deadline < now:
+                missed = math.ceil((now - deadline) / interval)
+                deadline += missed * interval
+                self.overruns += missed
+                self._overruns.inc(missed)
+            await asyncio.sleep(deadline - now)
+
+    def _adapt(self, load: float):
+        if load > HIGH_LOAD:
+            self.slowdown = min(self.slowdown * 2, self.max_slowdown)
+        elif load < LOW_LOAD:
+            self.slowdown = max(self.slowdown * 0.9, 1)
+        self._slowdown.set(self.slowdown)
+
+    @staticmethod
+    def _remove(group: PollGroup, node_id: int):
+        del group.identifiers[node_id]
+        del group.node_ids[node_id]
+        group.last.pop(node_id, None)
+        group.requests = None
+
+    @staticmethod
+    async def _stop(group: PollGroup):
+        if group.task is not None:
+            group.task.cancel()
+            await asyncio.gather(group.task, return_exceptions=True)
+            group.task = None
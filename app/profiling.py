@@ -0,0 +1,264 @@
+# Copyright (C) 2022 Robin Jespersen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import asyncio
+import collections
+import cProfile
+import functools
+import inspect
+import os
+import sys
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+from async_backend import AsyncBackend
+from backend import Backend
+from metrics import SLOW_CALLBACKS, STAGE_LATENCY
+from sub_handler import SubHandler
+
+MODES = ('cprofile', 'sample')
+
+# methods timed as stages while profiling, all public methods of the backends
+_STAGES: List[Tuple[type, str]] = [
+    (SubHandler, 'datachange_notification'),
+    (SubHandler, '_store'),
+] + [
+    (cls, name) for cls in (AsyncBackend, Backend)
+    for name, member in vars(cls).items() if not name.startswith('_') and inspect.isfunction(member)
+]
+
+
+class StageTimes:
+    """
+    Calls, total and maximum seconds per stage since the last dump.
+    """
+
+    def __init__(self):
+        self.calls: Dict[str, int] = collections.defaultdict(int)
+        self.total: Dict[str, float] = collections.defaultdict(float)
+        self.max: Dict[str, float] = collections.defaultdict(float)
+
+    def add(self, stage: str, seconds: float):
+        self.calls[stage] += 1
+        self.total[stage] += seconds
+        if seconds > self.max[stage]:
+            self.max[stage] = seconds
+        STAGE_LATENCY.labels(stage).observe(seconds)
+
+    def report(self) -> str:
+        lines = [f'{"stage":<50} {"calls":>10} {"total s":>10} {"mean ms":>10} {"max ms":>10}']
+        for stage in sorted(self.total, key=self.total.get, reverse=True):
+            calls = self.calls[stage]
+            lines.append(
+                f'{stage:<50} {calls:>10} {self.total[stage]:>10.3f} '
+                f'{self.total[stage] / calls * 1000:>10.3f} {self.max[stage] * 1000:>10.3f}'
+            )
+        return '\n'.join(lines) + '\n'
+
+
+class Profiler:
+    """
+    Opt-in profiling of the collector process, nothing is patched or sampled while it is disabled.
+
+    While enabled the event loop thread is profiled with cProfile or, in sample
+    mode, by a thread that records its stack every sample_interval seconds.
+    Every interval seconds the profile is written to directory, as pstats for
+    cProfile and as collapsed stacks for flame graphs when sampling, together
+    with the times of the stages in _STAGES. Callbacks of the event loop that
+    run longer than slow_callback seconds are printed with the task or handler
+    they belong to.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        mode: str = 'cprofile',
+        interval: float = 60,
+        slow_callback: float = 0.1,
+        sample_interval: float = 0.01,
+    ):
+        if mode not in MODES:
+            raise ValueError(f'unknown profiling mode {mode}, expected one of {MODES}')
+        self.directory = directory
+        self.mode = mode
+        self.interval = interval
+        self.slow_callback = slow_callback
+        self.sample_interval = sample_interval
+
+        self.enabled = False
+        self.slow_callbacks: int = 0
+        self._dumps: int = 0
+        self.stages = StageTimes()
+        self._profile: Optional[cProfile.Profile] = None
+        self._samples: Dict[str, int] = collections.Counter()
+        self._sampler: Optional[threading.Thread] = None
+        self._stop_sampling = threading.Event()
+        self._dump_task: Optional[asyncio.Task] = None
+        self._originals: Dict[Tuple[type, str], Callable] = {}
+        self._handle_run: Optional[Callable] = None
+
+    def toggle(self):
+        if self.enabled:
+            self.disable()
+        else:
+            self.enable()
+
+    def enable(self):
+        if self.enabled:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        self.enabled = True
+        self._instrument()
+        self._start()
+        self._dump_task = asyncio.get_running_loop().create_task(self._dump_periodically())
+        print(f'profiling enabled, {self.mode} profiles are written to {self.directory}')
+
+    def disable(self):
+        if not self.enabled:
+            return
+        self.enabled = False
+        self._dump_task.cancel()
+        self._dump_task = None
+        self.dump()
+        self._stop()
+        self._restore()
+        print('profiling disabled')
+
+    def dump(self) -> List[str]:
+        """
+        writes the profile and the stage times collected since the last dump, returns the files written
+        """
+        self._dumps += 1
+        name = os.path.join(self.directory, f'{time.strftime("%Y%m%d-%H%M%S")}-{os.getpid()}-{self._dumps}')
+        files = []
+        if self.mode == 'cprofile':
+            self._profile.disable()
+            self._profile.dump_stats(f'{name}.pstats')
+            files.append(f'{name}.pstats')
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+        else:
+            samples, self._samples = self._samples, collections.Counter()
+            with open(f'{name}.folded', 'w') as f:
+                for stack, count in samples.items():
+                    f.write(f'{stack} {count}\n')
+            files.append(f'{name}.folded')
+        with open(f'{name}.stages.txt', 'w') as f:
+            f.write(self.stages.report())
+        files.append(f'{name}.stages.txt')
+        self.stages = StageTimes()
+        return files
+
+    async def _dump_periodically(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            self.dump()
+
+    def _start(self):
+        if self.mode == 'cprofile':
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+        else:
+            self._stop_sampling.clear()
+            self._sampler = threading.Thread(
+                target=self._sample, args=(threading.get_ident(),), name='profiler', daemon=True,
+            )
+            self._sampler.start()
+
+    def _stop(self):
+        if self._profile is not None:
+            self._profile.disable()
+            self._profile = None
+        if self._sampler is not None:
+            self._stop_sampling.set()
+            self._sampler.join()
+            self._sampler = None
+
+    def _sample(self, thread_id: int):
+        while not self._stop_sampling.wait(self.sample_interval):
+            frame = sys._current_frames().get(thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                frame = frame.f_back
+            if stack:
+                self._samples[';'.join(reversed(stack))] += 1
+
+    def _instrument(self):
+        for cls, name in _STAGES:
+            original = vars(cls)[name]
+            self._originals[(cls, name)] = original
+            setattr(cls, name, _timed(self, f'{cls.__name__}.{name}', original))
+
+        self._handle_run = asyncio.Handle._run
+        handle_run = self._handle_run
+        profiler = self
+
+        def run(handle: asyncio.Handle):
+            started = time.perf_counter()
+            handle_run(handle)
+            duration = time.perf_counter() - started
+            if duration >= profiler.slow_callback:
+                profiler.slow_callbacks += 1
+                SLOW_CALLBACKS.inc()
+                print(f'slow callback took {duration:.3f}s: {describe(handle)}')
+
+        asyncio.Handle._run = run
+
+    def _restore(self):
+        for (cls, name), original in self._originals.items():
+            setattr(cls, name, original)
+        self._originals.clear()
+        if self._handle_run is not None:
+            asyncio.Handle._run = self._handle_run
+            self._handle_run = None
+
+
+def _timed(profiler: Profiler, stage: str, function: Callable) -> Callable:
+    if inspect.iscoroutinefunction(function):
+        @functools.wraps(function)
+        async def timed_coroutine(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await function(*args, **kwargs)
+            finally:
+                profiler.stages.add(stage, time.perf_counter() - started)
+        return timed_coroutine
+
+    @functools.wraps(function)
+    def timed(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            profiler.stages.add(stage, time.perf_counter() - started)
+    return timed
+
+
+def describe(handle: asyncio.Handle) -> str:
+    """
+    names what a callback of the event loop runs, the coroutine and where it is suspended for tasks
+    """
+    callback = handle._callback
+    owner = getattr(callback, '__self__', None)
+    if isinstance(owner, asyncio.Task):
+        coroutine = owner.get_coro()
+        frame = getattr(coroutine, 'cr_frame', None)
+        location = f' suspended at {frame.f_code.co_filename}:{frame.f_lineno}' if frame is not None else ''
+        return f'task {owner.get_name()} {getattr(coroutine, "__qualname__", coroutine)}{location}'
+    return repr(handle)
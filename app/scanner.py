@@ -0,0 +1,348 @@
+# Copyright (C) 2022 Robin Jespersen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import asyncio
+import hashlib
+import json
+import os
+import time
+from typing import Dict, List, NamedTuple, Optional, Set, Tuple
+
+import aiohttp
+import asyncua
+from asyncua import ua
+from asyncua.ua import UaError
+
+from async_backend import AsyncBackend
+from models.scanned_node import ScannedNode
+from operation_limits import chunks
+
+# only objects and variables are listed, methods and types are not collected
+_NODE_CLASSES = ua.NodeClass.Object | ua.NodeClass.Variable
+_READABLE = 1 << ua.AccessLevel.CurrentRead
+_WRITABLE = 1 << ua.AccessLevel.CurrentWrite
+
+
+class ScanSettings(NamedTuple):
+    concurrency: int = 4  # browse and read requests in flight per server
+    max_rate: float = 50  # requests per second per server, 0 for no limit
+    max_depth: int = 20  # levels below the root node
+    max_references: int = 1000  # references per node and response, the rest is fetched with BrowseNext
+    max_nodes_per_browse: int = 100  # nodes per Browse request, the server limit is used if lower
+    max_nodes_per_read: int = 1000  # nodes per Read request, the server limit is used if lower
+
+
+class Scanner:
+    """
+    Browses the address space of one server breadth first from a root node.
+
+    Every level is browsed with requests of many nodes at once, at most
+    concurrency requests are in flight and they are started at no more than
+    max_rate per second, so a large server is crawled quickly without
+    overloading it. References that do not fit into one response are fetched
+    with their continuation points. Nodes of namespace 0 below the root, like
+    the Server object, are skipped. The data type and access level of the
+    variables found are read in bulk afterwards.
+    """
+
+    def __init__(
+        self,
+        client: asyncua.Client,
+        settings: ScanSettings = ScanSettings(),
+        limits: Optional[Dict[str, int]] = None,
+    ):
+        if limits is None:
+            limits = {}
+        self.client = client
+        self.settings = settings
+        self.max_per_browse = _limit(settings.max_nodes_per_browse, limits.get('MaxNodesPerBrowse', 0))
+        self.max_per_read = _limit(settings.max_nodes_per_read, limits.get('MaxNodesPerRead', 0))
+
+        self.requests: int = 0
+        self.errors: int = 0
+        self._semaphore = asyncio.Semaphore(settings.concurrency)
+        self._next_request: float = 0
+
+    async def scan(self, root: str) -> List[ScannedNode]:
+        root_id = ua.NodeId.from_string(root)
+        found: Dict[ua.NodeId, Tuple[ScannedNode, ua.NodeClass]] = {}
+        visited = {root_id}
+        level: List[Tuple[ua.NodeId, str]] = [(root_id, '')]
+        for _ in range(self.settings.max_depth):
+            if not level:
+                break
+            results = await asyncio.gather(*[self._browse(batch) for batch in chunks(level, self.max_per_browse)])
+            next_level = []
+            for batch, references in zip(chunks(level, self.max_per_browse), results):
+                for (parent, path), node_references in zip(batch, references):
+                    for reference in node_references:
+                        node_id = _local(reference.NodeId)
+                        if node_id is None or node_id in visited:
+                            continue
+                        visited.add(node_id)
+                        if node_id.NamespaceIndex == 0:
+                            continue
+                        name = reference.DisplayName.Text or reference.BrowseName.Name
+                        node_path = f'{path}/{name}'
+                        found[node_id] = (
+                            ScannedNode(node_id.to_string(), name, node_path, '', False, False, parent.to_string()),
+                            reference.NodeClass,
+                        )
+                        next_level.append((node_id, node_path))
+            level = next_level
+
+        variables = [node_id for node_id, (_, node_class) in found.items() if node_class == ua.NodeClass.Variable]
+        attributes = await self._read_attributes(variables)
+        names = await self._data_type_names({data_type for data_type, _ in attributes.values() if data_type})
+        nodes = []
+        for node_id, (node, _) in found.items():
+            if node_id in attributes:
+                data_type, access = attributes[node_id]
+                node = node._replace(
+                    data_type=names.get(data_type, '') if data_type else '',
+                    readable=bool(access & _READABLE),
+                    writable=bool(access & _WRITABLE),
+                )
+            nodes.append(node)
+        return nodes
+
+    async def _browse(self, batch: List[Tuple[ua.NodeId, str]]) -> List[List[ua.ReferenceDescription]]:
+        """
+        returns the references of every node in the batch, following continuation points
+        """
+        parameters = ua.BrowseParameters()
+        parameters.RequestedMaxReferencesPerNode = self.settings.max_references
+        for node_id, _ in batch:
+            description = ua.BrowseDescription()
+            description.NodeId = node_id
+            description.BrowseDirection = ua.BrowseDirection.Forward
+            description.ReferenceTypeId = ua.NodeId(ua.ObjectIds.HierarchicalReferences)
+            description.IncludeSubtypes = True
+            description.NodeClassMask = _NODE_CLASSES
+            description.ResultMask = ua.BrowseResultMask.All
+            parameters.NodesToBrowse.append(description)
+        results = await self._request(self.client.uaclient.browse, parameters)
+
+        references: List[List[ua.ReferenceDescription]] = [[] for _ in batch]
+        pending = list(enumerate(results))
+        while pending:
+            continued = []
+            for i, result in pending:
+                if not result.StatusCode.is_good():
+                    self.errors += 1
+                    continue
+                references[i].extend(result.References)
+                if result.ContinuationPoint:
+                    continued.append((i, result.ContinuationPoint))
+            if not continued:
+                break
+            parameters = ua.BrowseNextParameters()
+            parameters.ContinuationPoints = [point for _, point in continued]
+            results = await self._request(self.client.uaclient.browse_next, parameters)
+            pending = [(i, result) for (i, _), result in zip(continued, results)]
+        return references
+
+    async def _read_attributes(self, node_ids: List[ua.NodeId]) -> Dict[ua.NodeId, Tuple[Optional[ua.NodeId], int]]:
+        """
+        reads the data type and access level of the variables
+        """
+        async def read(batch: List[ua.NodeId]) -> List[ua.DataValue]:
+            parameters = ua.ReadParameters()
+            for node_id in batch:
+                for attribute in (ua.AttributeIds.DataType, ua.AttributeIds.AccessLevel):
+                    read_value = ua.ReadValueId()
+                    read_value.NodeId = node_id
+                    read_value.AttributeId = attribute
+                    parameters.NodesToRead.append(read_value)
+            return await self._request(self.client.uaclient.read, parameters)
+
+        # every node reads two attributes
+        batches = list(chunks(node_ids, max(self.max_per_read // 2, 1)))
+        attributes = {}
+        for batch, values in zip(batches, await asyncio.gather(*[read(batch) for batch in batches])):
+            for i, node_id in enumerate(batch):
+                data_type, access = values[2 * i], values[2 * i + 1]
+                attributes[node_id] = (
+                    data_type.Value.Value if data_type.StatusCode.is_good() and data_type.Value is not None else None,
+                    access.Value.Value if access.StatusCode.is_good() and access.Value is not None else 0,
+                )
+        return attributes
+
+    async def _data_type_names(self, data_types: set) -> Dict[ua.NodeId, str]:
+        names = {}
+        unknown = []
+        for data_type in data_types:
+            name = ua.ObjectIdNames.get(data_type.Identifier) if data_type.NamespaceIndex == 0 else None
+            if name is None:
+                unknown.append(data_type)
+            else:
+                names[data_type] = name
+        for batch in chunks(unknown, self.max_per_read):
+            parameters = ua.ReadParameters()
+            for data_type in batch:
+                read_value = ua.ReadValueId()
+                read_value.NodeId = data_type
+                read_value.AttributeId = ua.AttributeIds.BrowseName
+                parameters.NodesToRead.append(read_value)
+            for data_type, value in zip(batch, await self._request(self.client.uaclient.read, parameters)):
+                if value.StatusCode.is_good() and value.Value is not None:
+                    names[data_type] = value.Value.Value.Name
+        return names
+
+    async def _request(self, method, parameters):
+        async with self._semaphore:
+            if self.settings.max_rate > 0:
+                loop = asyncio.get_running_loop()
+                now = loop.time()
+                start = max(now, self._next_request)
+                self._next_request = start + 1 / self.settings.max_rate
+                await asyncio.sleep(start - now)
+            self.requests += 1
+            return await method(parameters)
+
+
+def _limit(setting: int, server_limit: int) -> int:
+    return min(setting, server_limit) if server_limit else setting
+
+
+def _local(node_id: ua.ExpandedNodeId) -> Optional[ua.NodeId]:
+    """
+    the node id of a reference target on this server, None for other servers
+    """
+    if getattr(node_id, 'ServerIndex', 0):
+        return None
+    return ua.NodeId(node_id.Identifier, node_id.NamespaceIndex, node_id.NodeIdType)
+
+
+class Scans:
+    """
+    Scans the connected servers whose scan_required is set and pushes the
+    nodes found to the API, then clears scan_required.
+
+    A server is scanned once per request, it can be requested again after the
+    API listed it with scan_required cleared. A failed scan, including one whose
+    nodes the API did not accept, is retried after retry_interval seconds. With
+    a directory the nodes of every server are cached in a file keyed by the
+    request (the updated_at of the server) and the data types of the server,
+    so a request that is retried, e.g. by another collector or after a
+    restart, is not browsed again within max_age seconds, while every new
+    request browses the address space again.
+    """
+
+    def __init__(
+        self,
+        backend: AsyncBackend,
+        settings: ScanSettings = ScanSettings(),
+        directory: Optional[str] = None,
+        max_age: float = 24 * 60 * 60,
+        batch_size: int = 5000,
+        retry_interval: float = 10 * 60,
+    ):
+        self.backend = backend
+        self.settings = settings
+        self.directory = directory
+        self.max_age = max_age
+        self.batch_size = batch_size
+        self.retry_interval = retry_interval
+
+        self.tasks: Dict[int, asyncio.Task] = {}
+        # servers scanned while scan_required is still listed as set
+        self.scanned: Set[int] = set()
+        # monotonic time after which a failed scan is retried
+        self.retry_at: Dict[int, float] = {}
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def update(self, connected: dict):
+        """
+        starts scanning the servers of the connections that require it, stops scanning disconnected ones
+        """
+        for server_id, connection in connected.items():
+            if not connection.server.scan_required:
+                self.scanned.discard(server_id)
+                self.retry_at.pop(server_id, None)
+                continue
+            if server_id in self.tasks or server_id in self.scanned:
+                continue
+            if time.monotonic() < self.retry_at.get(server_id, 0):
+                continue
+            self.tasks[server_id] = asyncio.create_task(self._scan(connection))
+        for server_id in [server_id for server_id in self.tasks if server_id not in connected]:
+            self.tasks.pop(server_id).cancel()
+
+    async def close(self):
+        for task in self.tasks.values():
+            task.cancel()
+        await asyncio.gather(*self.tasks.values(), return_exceptions=True)
+        self.tasks.clear()
+
+    async def _scan(self, connection):
+        server = connection.server
+        try:
+            started = time.monotonic()
+            key = None
+            if connection.types_key is not None:
+                key = f'{server.updated_at}:{connection.types_key}'
+            nodes = self._read(server.url, key)
+            if nodes is None:
+                scanner = Scanner(connection.client, self.settings, connection.limits)
+                nodes = await scanner.scan(server.root_node or 'i=85')
+                self._write(server.url, key, nodes)
+                print(f'scanned {len(nodes)} nodes of server {server.id} with {scanner.requests} requests '
+                      f'in {time.monotonic() - started:.1f}s, {scanner.errors} errors')
+            for batch in chunks(nodes, self.batch_size):
+                response = await self.backend.node_store_batch(server.id, batch)
+                if response.status_code >= 400:
+                    print(f'could not store scanned nodes of server {server.id}: {response.status_code}')
+                    self.retry_at[server.id] = time.monotonic() + self.retry_interval
+                    return
+            await self.backend.server_scanned(server.id)
+            self.scanned.add(server.id)
+            self.retry_at.pop(server.id, None)
+        except (UaError, OSError, asyncio.TimeoutError, ValueError, aiohttp.ClientError) as error:  # type: ignore
+            print(f'could not scan server {server.id}: {error!r}')
+            self.retry_at[server.id] = time.monotonic() + self.retry_interval
+        finally:
+            self.tasks.pop(server.id, None)
+
+    def _path(self, url: str) -> str:
+        return os.path.join(self.directory, hashlib.sha256(url.encode()).hexdigest()[:32] + '.json')
+
+    def _read(self, url: str, key: Optional[str]) -> Optional[List[ScannedNode]]:
+        if self.directory is None or key is None:
+            return None
+        try:
+            with open(self._path(url)) as f:
+                cached = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as error:
+            print(f'could not read scanned nodes of {url}: {error!r}')
+            return None
+        if cached.get('key') != key or cached.get('created_at', 0) < time.time() - self.max_age:
+            return None
+        return [ScannedNode(*node) for node in cached['nodes']]
+
+    def _write(self, url: str, key: Optional[str], nodes: List[ScannedNode]):
+        if self.directory is None or key is None:
+            return
+        path = self._path(url)
+        try:
+            with open(path + '.tmp', 'w') as f:
+                json.dump({'url': url, 'key': key, 'created_at': time.time(), 'nodes': nodes}, f)
+            os.replace(path + '.tmp', path)
+        except OSError as error:
+            print(f'could not write scanned nodes of {url}: {error!r}')
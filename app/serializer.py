@@ -0,0 +1,168 @@
+# Copyright (C) 2022 Robin Jespersen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import base64
+import dataclasses
+import datetime
+import enum
+import uuid
+from typing import Any, Callable, Dict
+
+from asyncua import ua
+
+_PRIMITIVES = (str, int, float)
+
+# field annotations whose values need no conversion
+_DIRECT_FIELD_TYPES = {
+    'str', 'int', 'float', 'String', 'Double', 'Float', 'Byte', 'SByte',
+    'Int16', 'Int32', 'Int64', 'UInt16', 'UInt32', 'UInt64',
+}
+_BOOLEAN_FIELD_TYPES = {'bool', 'Boolean'}
+
+
+def _identity(value):
+    return value
+
+
+class Serializer:
+    """
+    Converts values received from the OPC UA server into json compatible values.
+
+    A converter is built once per type and cached, structures generated by
+    load_data_type_definitions() are dataclasses and get a converter that reads
+    their fields directly instead of walking __dict__ on every value.
+    """
+
+    def __init__(self):
+        self._converters: Dict[type, Callable[[Any], Any]] = {
+            type(None): _identity,
+            str: _identity,
+            int: _identity,
+            float: _identity,
+            dict: _identity,
+            bool: int,
+            list: self._convert_list,
+            tuple: self._convert_list,
+            set: self._convert_list,
+            frozenset: self._convert_list,
+            bytes: self._convert_bytes,
+            bytearray: self._convert_bytes,
+            datetime.datetime: self._convert_datetime,
+            uuid.UUID: str,
+            ua.LocalizedText: self._convert_localized_text,
+            ua.NodeId: self._convert_to_string,
+            ua.ExpandedNodeId: self._convert_to_string,
+            ua.QualifiedName: self._convert_to_string,
+            ua.StatusCode: self._convert_status_code,
+            ua.Variant: self._convert_variant,
+        }
+
+    def serialize(self, value):
+        try:
+            converter = self._converters[type(value)]
+        except KeyError:
+            converter = self._compile(type(value))
+        return converter(value)
+
+    __call__ = serialize
+
+    def _compile(self, value_type: type) -> Callable[[Any], Any]:
+        if value_type is type:
+            # classes have different attributes each, do not cache them
+            return self._convert_object
+        if issubclass(value_type, enum.Enum):
+            converter = self._convert_enum
+        elif hasattr(value_type, 'tolist') and hasattr(value_type, 'dtype'):
+            # numpy compatible arrays and scalars
+            converter = self._convert_array
+        elif dataclasses.is_dataclass(value_type):
+            converter = self._compile_dataclass(value_type)
+        elif issubclass(value_type, _PRIMITIVES):
+            converter = _identity
+        else:
+            converter = self._convert_object
+        self._converters[value_type] = converter
+        return converter
+
+    def _compile_dataclass(self, value_type: type) -> Callable[[Any], Any]:
+        fields = [f for f in dataclasses.fields(value_type) if not (f.name.startswith('__') and f.name.endswith('__'))]
+        if not all(f.name.isidentifier() for f in fields):
+            return self._convert_object
+        # generates a function like `lambda v: {'a': v.a, 'b': int(v.b), 'c': s(v.c)}`
+        items = []
+        for f in fields:
+            type_name = _type_name(f.type)
+            if type_name in _DIRECT_FIELD_TYPES:
+                items.append(f'{f.name!r}: v.{f.name}')
+            elif type_name in _BOOLEAN_FIELD_TYPES:
+                items.append(f'{f.name!r}: int(v.{f.name})')
+            else:
+                items.append(f'{f.name!r}: s(v.{f.name})')
+        return eval('lambda v: {' + ', '.join(items) + '}', {'s': self.serialize})
+
+    def _convert_list(self, value):
+        if isinstance(value, (set, frozenset)):
+            value = list(value)
+        if value and type(value[0]) in _PRIMITIVES and type(value[-1]) is type(value[0]):
+            # OPC UA arrays hold a single type, arrays of primitives need no conversion
+            return value if type(value) is list else list(value)
+        return [self.serialize(v) for v in value]
+
+    def _convert_array(self, value):
+        return self.serialize(value.tolist())
+
+    def _convert_object(self, value):
+        values = {}
+        for key, v in value.__dict__.items():
+            if key.startswith('__') and key.endswith('__'):
+                continue
+            values[key] = self.serialize(v)
+        return values
+
+    def _convert_variant(self, value: ua.Variant):
+        return self.serialize(value.Value)
+
+    @staticmethod
+    def _convert_bytes(value):
+        return base64.b64encode(value).decode('ascii')
+
+    @staticmethod
+    def _convert_datetime(value: datetime.datetime):
+        return str(round(value.timestamp()))
+
+    @staticmethod
+    def _convert_enum(value: enum.Enum):
+        return value.value
+
+    @staticmethod
+    def _convert_localized_text(value: ua.LocalizedText):
+        return {'Locale': value.Locale, 'Text': value.Text}
+
+    @staticmethod
+    def _convert_to_string(value):
+        return value.to_string()
+
+    @staticmethod
+    def _convert_status_code(value: ua.StatusCode):
+        return value.value
+
+
+def _type_name(annotation) -> str:
+    if isinstance(annotation, str):
+        return annotation.strip('\'"').rpartition('.')[2]
+    return getattr(annotation, '__name__', '')
+
+
+serialize = Serializer().serialize
@@ -0,0 +1,200 @@
+# Copyright (C) 2022 Robin Jespersen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import bisect
+import hashlib
+import multiprocessing
+import os
+import signal
+import sys
+import time
+from typing import Callable, Dict, FrozenSet, List, Optional
+
+
+def _hash(key: str) -> int:
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], 'big')
+
+
+class HashRing:
+    """
+    Consistent hash ring, every member owns replicas points on the ring and a key
+    belongs to the member owning the next point. If a member joins or leaves only
+    the keys of the points it gains or loses move to another member.
+    """
+
+    def __init__(self, members: FrozenSet[str], replicas: int = 64):
+        points = sorted((_hash(f'{member}#{i}'), member) for member in members for i in range(replicas))
+        self._keys = [key for key, _ in points]
+        self._members = [member for _, member in points]
+
+    def owner(self, key: str) -> Optional[str]:
+        if not self._keys:
+            return None
+        index = bisect.bisect(self._keys, _hash(key)) % len(self._keys)
+        return self._members[index]
+
+
+class Shard:
+    """
+    Decides which servers are handled by this collector.
+
+    The members are either the fixed list members, or every collector that wrote
+    a heartbeat file into directory within the last ttl seconds. A server is
+    owned if this collector is its owner now and settle seconds ago, so after a
+    member joined or left the previous owner releases a server before the new
+    owner takes it over, as long as settle is longer than one update cycle.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        members: Optional[List[str]] = None,
+        directory: Optional[str] = None,
+        ttl: float = 60,
+        settle: float = 150,
+        replicas: int = 64,
+    ):
+        self.name = name
+        self.members = members
+        self.directory = directory
+        self.ttl = ttl
+        self.settle = settle
+        self.replicas = replicas
+
+        self._rings: Dict[FrozenSet[str], HashRing] = {}
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def heartbeat(self):
+        """
+        announces this collector as a member, has to be called more often than every ttl seconds
+        """
+        if self.directory is None:
+            return
+        path = os.path.join(self.directory, self.name)
+        try:
+            alive = os.path.getmtime(path) + self.ttl > time.time()
+        except OSError:
+            alive = False
+        if alive and self._read_joined_at(path) is not None:
+            os.utime(path)
+            return
+        # the join time is kept in the file, the modification time is the last heartbeat
+        with open(path, 'w') as file:
+            file.write(str(time.time()))
+
+    async def run(self):
+        while True:
+            self.heartbeat()
+            await asyncio.sleep(self.ttl / 3)
+
+    def leave(self):
+        if self.directory is None:
+            return
+        try:
+            os.remove(os.path.join(self.directory, self.name))
+        except FileNotFoundError:
+            pass
+
+    def members_at(self, at: float) -> FrozenSet[str]:
+        if self.directory is None:
+            return frozenset(self.members or [self.name])
+        members = set()
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            joined_at = self._read_joined_at(path)
+            if joined_at is None:
+                continue
+            try:
+                left_at = os.path.getmtime(path) + self.ttl
+            except OSError:
+                continue
+            if joined_at <= at < left_at:
+                members.add(name)
+        return frozenset(members)
+
+    def owns(self, server_ids: List[int]) -> List[int]:
+        """
+        returns the server ids owned by this collector
+        """
+        now = time.time()
+        current = self._ring(self.members_at(now))
+        previous = self._ring(self.members_at(now - self.settle))
+        return [
+            server_id for server_id in server_ids
+            if current.owner(str(server_id)) == self.name and previous.owner(str(server_id)) == self.name
+        ]
+
+    def _ring(self, members: FrozenSet[str]) -> HashRing:
+        if members not in self._rings:
+            if len(self._rings) > 16:
+                self._rings.clear()
+            self._rings[members] = HashRing(members, self.replicas)
+        return self._rings[members]
+
+    @staticmethod
+    def _read_joined_at(path: str) -> Optional[float]:
+        try:
+            with open(path) as file:
+                return float(file.read())
+        except (OSError, ValueError):
+            return None
+
+
+def _run_worker(target: Callable[[], None], index: int, members: List[str]):
+    os.environ['SHARD_NAME'] = members[index]
+    os.environ['SHARD_MEMBERS'] = ','.join(members)
+    # every worker serves its own metrics and last values
+    for port in ('METRICS_PORT', 'LIVE_PORT'):
+        if os.getenv(port) is not None:
+            os.environ[port] = str(int(os.environ[port]) + index)
+    target()
+
+
+def worker_names(name: str, count: int) -> List[str]:
+    """
+    the shard names of the workers of the collector name, unique among the
+    collectors sharing a shard directory as long as their names are
+    """
+    return [f'{name}-worker-{i}' for i in range(count)]
+
+
+def run_workers(count: int, target: Callable[[], None], name: str):
+    """
+    runs target in count processes, each one a member of a fixed shard named
+    after the collector name, a process that exits is started again
+    """
+    members = worker_names(name, count)
+    context = multiprocessing.get_context('spawn')
+    processes: Dict[str, multiprocessing.Process] = {}
+    # stop the workers as well when the container is stopped
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    try:
+        while True:
+            for index, name in enumerate(members):
+                process = processes.get(name)
+                if process is not None and process.is_alive():
+                    continue
+                if process is not None:
+                    print(f'{name} exited with {process.exitcode}, restarting')
+                processes[name] = context.Process(target=_run_worker, args=(target, index, members), name=name)
+                processes[name].start()
+            time.sleep(1)
+    finally:
+        for process in processes.values():
+            process.terminate()
+        for process in processes.values():
+            process.join()
@@ -0,0 +1,169 @@
+# Copyright (C) 2022 Robin Jespersen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import os
+import time
+from typing import IO, Iterable, List, Optional, Tuple
+
+from models.sample import Sample
+
+SEGMENT_SUFFIX = '.spool'
+CURSOR_FILE = 'cursor'
+
+
+class Spool:
+    """
+    Append-only on disk log for samples that could not be stored.
+
+    Samples are written as json lines into numbered segment files. Segments are
+    read oldest first, a segment is deleted once all of its samples have been
+    committed. Lines that cannot be parsed, e.g. one written partly before a
+    crash, are skipped. The oldest segments are dropped when the spool grows beyond
+    max_bytes or when they are older than retention seconds.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        segment_size: int = 16 * 1024 * 1024,
+        max_bytes: int = 1024 * 1024 * 1024,
+        retention: float = 7 * 24 * 60 * 60,
+    ):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_bytes = max_bytes
+        self.retention = retention
+
+        self.dropped_segments: int = 0
+        self.skipped_lines: int = 0
+
+        os.makedirs(directory, exist_ok=True)
+        self._segments: List[int] = sorted(
+            int(f[:-len(SEGMENT_SUFFIX)]) for f in os.listdir(directory) if f.endswith(SEGMENT_SUFFIX)
+        )
+        self._sizes = {s: os.path.getsize(self._path(s)) for s in self._segments}
+        self._writer: Optional[IO[str]] = None
+        self._read_segment, self._read_offset = self._load_cursor()
+
+    def __len__(self) -> int:
+        return len(self._segments)
+
+    @property
+    def empty(self) -> bool:
+        if not self._segments:
+            return True
+        return len(self._segments) == 1 and self._read_segment == self._segments[0] \
+            and self._read_offset >= self._sizes[self._segments[0]]
+
+    @property
+    def size(self) -> int:
+        return sum(self._sizes.values())
+
+    def append(self, samples: Iterable[Sample]):
+        lines = ''.join(json.dumps(list(sample), separators=(',', ':')) + '\n' for sample in samples)
+        if not lines:
+            return
+        if self._writer is None or self._sizes[self._segments[-1]] >= self.segment_size:
+            self._rotate()
+        self._writer.write(lines)
+        self._writer.flush()
+        self._sizes[self._segments[-1]] += len(lines.encode())
+        self._enforce_limits()
+
+    def read(self, max_count: int) -> Tuple[List[Sample], Tuple[int, int]]:
+        """
+        returns up to max_count samples of the oldest segment and the position to commit after they were stored
+        """
+        if not self._segments:
+            return [], (self._read_segment, self._read_offset)
+        segment = self._segments[0]
+        offset = self._read_offset if segment == self._read_segment else 0
+        if self._writer is not None and segment == self._segments[-1]:
+            # never read the segment that is still written to
+            self._close_writer()
+        samples = []
+        with open(self._path(segment), 'rb') as f:
+            f.seek(offset)
+            while len(samples) < max_count:
+                line = f.readline()
+                if not line:
+                    # the segment is no longer written, what was read is all there is
+                    self._sizes[segment] = offset
+                    break
+                offset += len(line)
+                try:
+                    samples.append(Sample(*json.loads(line)))
+                except (ValueError, TypeError):
+                    # incomplete write or corrupt line
+                    self.skipped_lines += 1
+        return samples, (segment, offset)
+
+    def commit(self, position: Tuple[int, int]):
+        segment, offset = position
+        if segment in self._sizes and offset >= self._sizes[segment] and \
+                (self._writer is None or segment != self._segments[-1]):
+            self._remove(segment)
+            segment, offset = (self._segments[0], 0) if self._segments else (0, 0)
+        self._read_segment, self._read_offset = segment, offset
+        self._save_cursor()
+
+    def close(self):
+        self._close_writer()
+
+    def _rotate(self):
+        self._close_writer()
+        segment = self._segments[-1] + 1 if self._segments else 1
+        self._segments.append(segment)
+        self._sizes[segment] = 0
+        self._writer = open(self._path(segment), 'a', encoding='utf-8')
+
+    def _close_writer(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    def _enforce_limits(self):
+        min_mtime = time.time() - self.retention
+        while len(self._segments) > 1 and (
+                self.size > self.max_bytes or os.path.getmtime(self._path(self._segments[0])) < min_mtime):
+            self._remove(self._segments[0])
+            self.dropped_segments += 1
+            self._read_segment, self._read_offset = self._segments[0], 0
+            self._save_cursor()
+
+    def _remove(self, segment: int):
+        os.remove(self._path(segment))
+        self._segments.remove(segment)
+        del self._sizes[segment]
+
+    def _path(self, segment: int) -> str:
+        return os.path.join(self.directory, f'{segment:020d}{SEGMENT_SUFFIX}')
+
+    def _load_cursor(self) -> Tuple[int, int]:
+        try:
+            with open(os.path.join(self.directory, CURSOR_FILE), encoding='utf-8') as f:
+                segment, offset = json.load(f)
+        except (OSError, ValueError):
+            return (self._segments[0] if self._segments else 0), 0
+        if segment not in self._sizes:
+            return (self._segments[0] if self._segments else 0), 0
+        return segment, offset
+
+    def _save_cursor(self):
+        path = os.path.join(self.directory, CURSOR_FILE)
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump([self._read_segment, self._read_offset], f)
+        os.replace(path + '.tmp', path)
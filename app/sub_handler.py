@@ -13,16 +13,25 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import asyncio
+import datetime
 import time
+from collections import deque
+from typing import Awaitable, Callable, Deque, List, Optional
 
-from asyncua import Node
+from asyncua import Node, ua
+from asyncua.common.events import Event as UaEvent
 from asyncua.common.subscription import DataChangeNotif
-from asyncua.ua import MonitoredItemNotification, EventNotificationList, StatusChangeNotification
-import sentry_sdk
+from asyncua.ua import MonitoredItemNotification, StatusChangeNotification
 
-from backend import Backend
-
-sentry_sdk.init(traces_sample_rate=1)
+from async_backend import AsyncBackend
+from compression import Compression
+from encoder import EncoderPool, Notification, nanoseconds
+from ingest import IngestQueue
+from last_values import LastValue, LastValueCache
+from metrics import ENCODE_LATENCY, HANDLER_LATENCY, NOTIFICATIONS, NOTIFICATIONS_DROPPED
+from models.event import Event
+from serializer import serialize
 
 
 class SubHandler(object):
@@ -30,45 +39,137 @@ class SubHandler(object):
     Subscription Handler. To receive events from server for a subscription
     This class is just a sample class. Whatever class having these methods can be used
     https://python-opcua.readthedocs.io/en/latest/_modules/opcua/common/subscription.html
+
+    Received values are only queued in the notification callback so the
+    publish responses of the server are handled right away. A task of the
+    handler takes them in batches of up to batch_size, has the encoder convert
+    them to samples and stores those in the order they were received. When
+    more than max_pending values wait the new ones are dropped.
     """
 
-    def __init__(self, server_id: int, backend: Backend):
+    def __init__(
+        self,
+        server_id: int,
+        backend: AsyncBackend,
+        ingest: IngestQueue,
+        cache: Optional[LastValueCache] = None,
+        compression: Optional[Compression] = None,
+        timestamp_source: str = 'server',
+        events: Optional[IngestQueue] = None,
+        status_changed: Optional[Callable[[ua.StatusCode], Awaitable[None]]] = None,
+        encoder: Optional[EncoderPool] = None,
+        batch_size: int = 1000,
+        max_pending: int = 100000,
+    ):
         self.backend = backend
+        self.ingest = ingest
+        self.cache = cache
+        self.compression = compression
+        # samples are stored with the source or the server timestamp, the other one is the fallback
+        self.source_time = timestamp_source == 'source'
+        self.events = events
+        self.status_changed = status_changed
+        self.encoder = encoder if encoder is not None else EncoderPool()
+        self.batch_size = batch_size
+        self.max_pending = max_pending
         self.server_id = server_id
+        self.dropped = 0
+        self._pending: Deque[Notification] = deque()
+        self._wakeup = asyncio.Event()
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._task: Optional[asyncio.Task] = None
+        self._notifications = NOTIFICATIONS.labels(str(server_id))
+        self._dropped = NOTIFICATIONS_DROPPED.labels(str(server_id))
+        self._latency = HANDLER_LATENCY.labels(str(server_id))
+        self._encode_latency = ENCODE_LATENCY.labels(str(server_id))
 
-    def datachange_notification(self, node: Node, value, data: DataChangeNotif):
+    async def datachange_notification(self, node: Node, value, data: DataChangeNotif):
         """
         called for every datachange notification from server
         """
         monitored_item_notification: MonitoredItemNotification = data.monitored_item
+        self.put(node.nodeid, monitored_item_notification.Value)
+
+    async def store(self, node_id: str, value, data_value: ua.DataValue):
+        """
+        stores a value of the node, received with a notification or read by polling
+        """
+        self.put(node_id, data_value)
+
+    def put(self, node_id, data_value: ua.DataValue):
+        started = time.perf_counter()
+        self._notifications.inc()
+        if len(self._pending) >= self.max_pending:
+            self.dropped += 1
+            self._dropped.inc()
+            return
+        self._pending.append((node_id, data_value))
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+        self._idle.clear()
+        self._wakeup.set()
+        self._latency.observe(time.perf_counter() - started)
+
+    async def flush(self):
+        """
+        waits until all values received so far are stored
+        """
+        await self._idle.wait()
+
+    async def close(self):
+        await self.flush()
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self):
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            while self._pending:
+                batch = [self._pending.popleft() for _ in range(min(len(self._pending), self.batch_size))]
+                try:
+                    await self._store(batch)
+                except Exception as error:
+                    # the task has to keep running for the following values
+                    print(f'could not store {len(batch)} values of server {self.server_id}: {error!r}')
+            self._idle.set()
+
+    async def _store(self, batch: List[Notification]):
+        started = time.perf_counter()
+        encoded = await self.encoder.encode(self.server_id, self.source_time, batch)
+        self._encode_latency.observe(time.perf_counter() - started)
+        for sample, source_time, server_time in encoded:
+            if self.compression is None:
+                await self.ingest.put(sample)
+            else:
+                for stored in self.compression.put(sample):
+                    await self.ingest.put(stored)
+            if self.cache is not None:
+                self.cache.put(self.server_id, sample.node_id, LastValue(
+                    sample.value,
+                    source_time / 1e9 if source_time is not None else None,
+                    server_time / 1e9 if server_time is not None else None,
+                    sample.status,
+                ))
 
-        value = self.backend.object_to_dict(value)
-
-        st = monitored_item_notification.Value.ServerTimestamp
-        response = self.backend.influx_store(
-            self.server_id,
-            node.nodeid.to_string(),
-            round(st.timestamp()) if st is not None else round(time.time()),
-            value
-        )
-        if response.status_code != 200:
-            print('could not store data:')
-            print(data)
-            print('could not store value:')
-            print(value)
-            print('server response:')
-            print(response.text)
-
-    def event_notification(self, event: EventNotificationList):
+    async def event_notification(self, event: UaEvent):
         """
-        called for every event notification from server
+        called for every event notification from server, the event is queued without waiting
         """
-        print('event_notification:')
-        print(event)
+        if self.events is None:
+            return
+        fields = {name: serialize(getattr(event, name)) for name in event.data_types}
+        event_time = getattr(event, 'Time', None)
+        timestamp = nanoseconds(event_time) if isinstance(event_time, datetime.datetime) else time.time_ns()
+        self.events.put_nowait(Event(self.server_id, timestamp, fields))
 
-    def status_change_notification(self, status: StatusChangeNotification):
+    async def status_change_notification(self, status: StatusChangeNotification):
         """
-        called for every status change notification from server
+        called when the state of a subscription changed, e.g. it timed out
         """
-        print('status_change_notification:')
-        print(status)
+        print(f'server {self.server_id}: subscription status changed to {status.Status.name}')
+        if self.status_changed is not None:
+            await self.status_changed(status.Status)
@@ -0,0 +1,138 @@
+# Copyright (C) 2022 Robin Jespersen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+from typing import Dict, Optional
+
+import asyncua
+from asyncua.ua import UaError, UaStatusCodeError
+
+from compression import Compression
+from models.node import Node as NodeModel
+from monitored_items import MonitoredItems, MonitoringSettings
+
+
+class Subscriptions:
+    """
+    Subscriptions of one server, one per distinct publishing interval of its nodes.
+
+    Subscriptions are created when the first node with their publishing interval
+    is applied and deleted when their last node is gone.
+    """
+
+    def __init__(
+        self,
+        client: asyncua.Client,
+        handler,
+        max_per_call: int = 1000,
+        defaults: MonitoringSettings = MonitoringSettings(),
+        compression: Optional[Compression] = None,
+    ):
+        self.client = client
+        self.handler = handler
+        self.max_per_call = max_per_call
+        self.defaults = defaults
+        self.compression = compression
+
+        self.groups: Dict[float, MonitoredItems] = {}
+        self.intervals: Dict[int, float] = {}
+        # nodes whose subscription could not be created
+        self.pending: Dict[int, NodeModel] = {}
+
+    def __len__(self) -> int:
+        return sum(len(items) for items in self.groups.values())
+
+    async def apply(self, nodes: Dict[int, NodeModel]) -> Dict[int, str]:
+        """
+        subscribes to all nodes that are not monitored yet and unsubscribes from the rest,
+        returns the error for every node that could not be (un)subscribed
+        """
+        changes: Dict[int, Optional[NodeModel]] = dict(nodes)
+        changes.update({node_id: None for node_id in self.intervals if node_id not in nodes})
+        self.pending.clear()
+        return await self.update(changes)
+
+    async def update(self, changes: Dict[int, Optional[NodeModel]]) -> Dict[int, str]:
+        """
+        applies changed nodes to the subscription of their publishing interval, None unsubscribes the node,
+        returns the error for every node that could not be (un)subscribed
+        """
+        if self.compression is not None:
+            self.compression.configure(changes)
+        changes = {**self.pending, **changes}
+        self.pending.clear()
+        group_changes = self._group(changes)
+
+        errors: Dict[int, str] = {}
+        for interval in [interval for interval in group_changes if interval not in self.groups]:
+            await self._create(interval, group_changes, errors)
+
+        results = await asyncio.gather(*[
+            self.groups[interval].update(group_changes[interval]) for interval in group_changes
+        ])
+        for result in results:
+            errors.update(result)
+
+        for interval in [interval for interval, items in self.groups.items() if not items and not items.pending]:
+            await self._delete(interval)
+        return errors
+
+    async def close(self):
+        """
+        nothing to do, the subscriptions end with the session
+        """
+
+    def _group(self, changes: Dict[int, Optional[NodeModel]]) -> Dict[float, Dict[int, Optional[NodeModel]]]:
+        """
+        the changes per publishing interval, a node whose interval changed is removed from the previous one
+        """
+        group_changes: Dict[float, Dict[int, Optional[NodeModel]]] = {interval: {} for interval in self.groups}
+        for node_id, node in changes.items():
+            interval = None if node is None else self.defaults.of(node).publishing_interval
+            previous = self.intervals.get(node_id)
+            if previous is not None and previous != interval:
+                group_changes[previous][node_id] = None
+                del self.intervals[node_id]
+            if interval is not None:
+                group_changes.setdefault(interval, {})[node_id] = node
+                self.intervals[node_id] = interval
+        return group_changes
+
+    async def _create(
+        self,
+        interval: float,
+        group_changes: Dict[float, Dict[int, Optional[NodeModel]]],
+        errors: Dict[int, str],
+    ):
+        """
+        creates the subscription of interval, if that fails its nodes stay pending
+        """
+        try:
+            subscription = await self.client.create_subscription(interval, self.handler)
+        except (UaStatusCodeError, UaError, OSError, asyncio.TimeoutError) as error:  # type: ignore
+            print(f'could not create subscription with publishing interval {interval}: {error!r}')
+            for node_id, node in group_changes.pop(interval).items():
+                del self.intervals[node_id]
+                self.pending[node_id] = node
+                errors[node_id] = repr(error)
+            return
+        self.groups[interval] = MonitoredItems(self.client, subscription, self.max_per_call, self.defaults)
+
+    async def _delete(self, interval: float):
+        items = self.groups.pop(interval)
+        try:
+            await items.subscription.delete()
+        except (UaStatusCodeError, UaError, OSError, asyncio.TimeoutError) as error:  # type: ignore
+            print(f'could not delete subscription with publishing interval {interval}: {error!r}')
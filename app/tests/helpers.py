@@ -0,0 +1,93 @@
+# Copyright (C) 2022 Robin Jespersen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import socket
+from typing import List, Tuple
+
+import asyncua
+
+from models.node import Node
+from models.server import Server
+
+
+def make_server(id: int, url: str, **data) -> Server:
+    return Server({
+        'id': id,
+        'created_at': 0,
+        'updated_at': 0,
+        'created_by': 0,
+        'updated_by': 0,
+        'sort': 0,
+        'name': f'server {id}',
+        'url': url,
+        'description': '',
+        'checked_at': 0,
+        'scan_required': False,
+        'has_connection_error': False,
+        'connection_error': '',
+        'root_node': 'i=85',
+        **data,
+    })
+
+
+def make_node(id: int, server_id: int, identifier: str, **data) -> Node:
+    return Node({
+        'id': id,
+        'created_at': 0,
+        'updated_at': 0,
+        'created_by': 0,
+        'updated_by': 0,
+        'server_id': server_id,
+        'identifier': identifier,
+        'display_name': f'node {id}',
+        'checked_at': 0,
+        'tracked': True,
+        'path': '',
+        'data_type': 'Double',
+        'readable': True,
+        'writable': True,
+        'virtual': False,
+        'parent_identifier': None,
+        'change_value': None,
+        'change_error_at': None,
+        'change_error': None,
+        **data,
+    })
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+async def start_opcua_server(variables: int, url: str = '') -> Tuple[asyncua.Server, str, List[asyncua.Node]]:
+    """
+    starts a local OPC UA server with the given number of writable double variables,
+    on a free port unless the url is given
+    """
+    server = asyncua.Server()
+    await server.init()
+    url = url or f'opc.tcp://127.0.0.1:{free_port()}/'
+    server.set_endpoint(url)
+    idx = await server.register_namespace('urn:opcua_collector:test')
+    folder = await server.nodes.objects.add_object(idx, 'Test')
+    nodes = []
+    for i in range(variables):
+        node = await folder.add_variable(idx, f'Variable{i}', 0.0)
+        await node.set_writable()
+        nodes.append(node)
+    await server.start()
+    return server, url, nodes
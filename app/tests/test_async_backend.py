@@ -0,0 +1,183 @@
+# Copyright (C) 2022 Robin Jespersen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import json
+import unittest
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from async_backend import AsyncBackend, parse_array
+from models.sample import Sample
+
+
+class ChunkedStream:
+    def __init__(self, data: bytes, size: int):
+        self.chunks = [data[i:i + size] for i in range(0, len(data), size)]
+
+    async def read(self, n: int) -> bytes:
+        return self.chunks.pop(0) if self.chunks else b''
+
+
+class TestParseArray(unittest.IsolatedAsyncioTestCase):
+
+    async def test_parse_in_chunks(self):
+        elements = [{'id': i, 'text': 'ä€𝄞 ]}, "x'} for i in range(20)] + [12345, 1.5e3, None, 'end']
+        data = ('  [\n' + ' ,\n'.join(json.dumps(e, ensure_ascii=False) for e in elements) + '\n] ').encode()
+        for size in [1, 3, 7, 1000]:
+            self.assertEqual(await parse_array(ChunkedStream(data, size), lambda e: e), elements)
+        self.assertEqual(await parse_array(ChunkedStream(b'[]', 1), lambda e: e), [])
+
+    async def test_invalid(self):
+        for data in [b'{"a": 1}', b'[{"a": 1}', b'[{"a": }]', b'[1,,2]', b'[,1]', b'[1,]', b'[1 2]', b'[1}']:
+            with self.assertRaises(ValueError):
+                await parse_array(ChunkedStream(data, 4), lambda e: e)
+
+
+class TestPagination(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.data = [dict(id=i, updated_at=0, server_id=1, identifier=f'ns=2;i={i}', tracked=True, virtual=False,
+                          change_value=None) for i in range(1, 24)]
+        self.pages = []
+        self.page_count_header = True
+
+        async def handler(request: web.Request):
+            size = int(request.query['pageSize'])
+            page = int(request.query['page'])
+            self.pages.append(page)
+            count = (len(self.data) + size - 1) // size
+            headers = {'X-Pagination-Page-Count': str(count)} if self.page_count_header else {}
+            return web.json_response(self.data[(page - 1) * size:page * size], headers=headers)
+
+        app = web.Application()
+        app.router.add_route('*', '/{tail:.*}', handler)
+        self.server = TestServer(app)
+        await self.server.start_server()
+        self.backend = AsyncBackend(str(self.server.make_url('')).rstrip('/'), 'test-token', page_size=5)
+
+    async def asyncTearDown(self):
+        await self.backend.close()
+        await self.server.close()
+
+    async def test_pages_in_parallel(self):
+        nodes = await self.backend.node_index_filtered()
+        self.assertEqual([node.id for node in nodes], list(range(1, 24)))
+        self.assertEqual(self.pages[0], 1)
+        self.assertEqual(sorted(self.pages), [1, 2, 3, 4, 5])
+
+    async def test_pages_without_page_count(self):
+        self.page_count_header = False
+        self.data = self.data[:20]
+        nodes = await self.backend.node_index_changed()
+        self.assertEqual([node.id for node in nodes], list(range(1, 21)))
+        # the empty page ends the listing
+        self.assertEqual(self.pages, [1, 2, 3, 4, 5])
+
+
+class TestAsyncBackend(unittest.IsolatedAsyncioTestCase):
+    backend: AsyncBackend
+
+    async def asyncSetUp(self):
+        self.requests = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.patched = []
+        self.stored = []
+
+        async def handler(request: web.Request):
+            self.requests.append(request)
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            await asyncio.sleep(0.01)
+            self.in_flight -= 1
+            if request.path == '/api/status/ping':
+                return web.Response(status=200)
+            if request.path == '/api/server_manager/influx/store':
+                self.posted = dict(await request.post())
+                self.stored.append(self.posted)
+                return web.Response(status=200, text='ok')
+            if request.path == '/api/server_manager/influx/store-batch':
+                return web.Response(status=404)
+            if request.path == '/api/server_manager/node/update-batch':
+                return web.Response(status=404)
+            if request.path == '/api/server_manager/node/update':
+                self.patched.append((request.query['id'], await request.json()))
+                return web.Response(status=200)
+            if request.path == '/api/server_manager/node/index' and 'filter[updated_at][gte]' in request.query:
+                if request.headers.get('If-None-Match') == '"v1"':
+                    return web.Response(status=304)
+                return web.json_response([], headers={'ETag': '"v1"'})
+            return web.json_response([])
+
+        app = web.Application()
+        app.router.add_route('*', '/{tail:.*}', handler)
+        self.server = TestServer(app)
+        await self.server.start_server()
+        self.backend = AsyncBackend(str(self.server.make_url('')).rstrip('/'), 'test-token', max_connections=2)
+
+    async def asyncTearDown(self):
+        await self.backend.close()
+        await self.server.close()
+
+    async def test_available(self):
+        self.assertTrue(await self.backend.available())
+
+    async def test_server_index(self):
+        servers = await self.backend.server_index()
+        self.assertEqual(self.requests[0].headers['Authorization'], 'Bearer test-token')
+        self.assertEqual(len(servers), 0)
+
+    async def test_influx_store(self):
+        response = await self.backend.influx_store(1, 'ns=2;i=1', 123, {'a': 1})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.posted, {'server_id': '1', 'node_id': 'ns=2;i=1', 'time': '123', 'value': '{"a": 1}'})
+
+    async def test_influx_store_batch_fallback(self):
+        samples = [Sample(1, 'ns=2;i=1', 2 * 10 ** 9, 1.5), Sample(1, 'ns=2;i=2', 2 * 10 ** 9, 'a')]
+        response = await self.backend.influx_store_batch(samples)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(sorted(stored['node_id'] for stored in self.stored), ['ns=2;i=1', 'ns=2;i=2'])
+        self.assertEqual(self.stored[0]['time'], '2')
+        await self.backend.influx_store_batch(samples)
+        self.assertEqual([r.path for r in self.requests].count('/api/server_manager/influx/store-batch'), 1)
+
+    async def test_node_index_changed(self):
+        self.assertEqual(await self.backend.node_index_changed(), [])
+        self.assertEqual(await self.backend.node_index_changed(10), [])
+        self.assertIsNone(await self.backend.node_index_changed(10))
+        self.assertEqual(self.requests[1].query['filter[updated_at][gte]'], '10')
+        self.assertNotIn('If-None-Match', self.requests[1].headers)
+        self.assertEqual(self.requests[2].headers['If-None-Match'], '"v1"')
+
+    async def test_node_update_batch_fallback(self):
+        updated = await self.backend.node_update_batch({1: {'change_value': None}, 2: {'change_error': 'e'}})
+        self.assertEqual(updated, [1, 2])
+        await self.backend.node_update_batch({3: {'change_value': None}})
+        self.assertEqual(self.patched, [
+            ('1', {'change_value': None}), ('2', {'change_error': 'e'}), ('3', {'change_value': None}),
+        ])
+        # the batch endpoint is not requested again once it is known to be missing
+        self.assertEqual([r.path for r in self.requests].count('/api/server_manager/node/update-batch'), 1)
+
+    async def test_max_connections(self):
+        await asyncio.gather(*[self.backend.node_index_filtered() for _ in range(10)])
+        self.assertEqual(len(self.requests), 10)
+        self.assertLessEqual(self.max_in_flight, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
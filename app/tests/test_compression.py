@@ -0,0 +1,104 @@
+# Copyright (C) 2022 Robin Jespersen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import math
+import unittest
+
+from compression import (AggregateCompressor, Compression, CompressionPolicy, Compressor, DeadbandCompressor,
+                         SwingingDoorCompressor)
+from models.sample import Sample
+from tests.helpers import make_node
+
+NS = 1000000000
+
+
+def feed(compressor, values, start=0):
+    """
+    puts one value per second, returns the stored (second, value) pairs
+    """
+    stored = []
+    for t, value in enumerate(values, start):
+        stored.extend(compressor.put(Sample(1, 'ns=2;i=1', t * NS, value)))
+    return seconds(stored)
+
+
+def seconds(samples):
+    return [(s.time // NS, s.value) for s in samples]
+
+
+class TestCompressors(unittest.TestCase):
+
+    def test_dedup(self):
+        compressor = Compressor(CompressionPolicy('dedup', max_interval=3))
+        self.assertEqual(feed(compressor, [1, 1, 1, 2, 2, 1, 1, 1, 1, 1]), [(0, 1), (3, 2), (5, 1), (8, 1)])
+        self.assertEqual(compressor.expire(10 * NS), [])
+        self.assertEqual(seconds(compressor.expire(11 * NS)), [(9, 1)])
+
+    def test_dedup_status(self):
+        compressor = Compressor(CompressionPolicy('dedup'))
+        compressor.put(Sample(1, 'ns=2;i=1', 0, 1))
+        self.assertEqual(len(compressor.put(Sample(1, 'ns=2;i=1', 1, 1, 0x80000000))), 1)
+
+    def test_deadband(self):
+        compressor = DeadbandCompressor(CompressionPolicy('deadband', deviation=0.5))
+        self.assertEqual(feed(compressor, [1.0, 1.2, 1.5, 1.6, 0.9, 'a', 'a']), [(0, 1.0), (3, 1.6), (4, 0.9), (5, 'a')])
+
+    def test_swinging_door(self):
+        compressor = SwingingDoorCompressor(CompressionPolicy('swinging_door', deviation=0.1))
+        # a ramp is stored as its end points, the sample before the bend is stored once the door closes
+        values = [float(i) for i in range(10)] + [9.0] * 10
+        self.assertEqual(feed(compressor, values), [(0, 0.0), (9, 9.0)])
+        self.assertEqual(seconds(compressor.expire(math.inf)), [(19, 9.0)])
+
+    def test_swinging_door_noise(self):
+        compressor = SwingingDoorCompressor(CompressionPolicy('swinging_door', deviation=0.5))
+        values = [0.0, 0.3, -0.2, 0.1, 0.4, -0.3, 5.0, 5.2, 4.9]
+        self.assertEqual(feed(compressor, values), [(0, 0.0), (5, -0.3), (6, 5.0)])
+
+    def test_aggregate(self):
+        compressor = AggregateCompressor(CompressionPolicy('aggregate', window=5))
+        self.assertEqual(feed(compressor, [1, 2, 3, 4, 5, 10, 20]), [
+            (0, {'min': 1, 'max': 5, 'mean': 3.0, 'count': 5}),
+        ])
+        self.assertEqual(compressor.expire(9 * NS), [])
+        self.assertEqual(compressor.expire(10 * NS)[0].value, {'min': 10, 'max': 20, 'mean': 15.0, 'count': 2})
+
+
+class TestCompression(unittest.TestCase):
+
+    def test_configure(self):
+        compression = Compression(CompressionPolicy('dedup'))
+        compression.configure({
+            1: make_node(1, 1, 'ns=2;i=1'),
+            2: make_node(2, 1, 'ns=2;i=2', compression='none'),
+        })
+        self.assertEqual(set(compression.compressors), {'ns=2;i=1'})
+        self.assertEqual(len(compression.put(Sample(1, 'ns=2;i=1', 0, 1))), 1)
+        self.assertEqual(len(compression.put(Sample(1, 'ns=2;i=1', 1, 1))), 0)
+        self.assertEqual(len(compression.put(Sample(1, 'ns=2;i=2', 1, 1))), 1)
+
+        # unchanged nodes keep their state, e.g. after reconnecting
+        compressor = compression.compressors['ns=2;i=1']
+        compression.configure({1: make_node(1, 1, 'ns=2;i=1')})
+        self.assertIs(compression.compressors['ns=2;i=1'], compressor)
+        compression.configure({1: make_node(1, 1, 'ns=2;i=1', compression='aggregate')})
+        self.assertIsInstance(compression.compressors['ns=2;i=1'], AggregateCompressor)
+        compression.configure({1: None})
+        self.assertEqual(compression.compressors, {})
+        self.assertEqual(compression.suppressed, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
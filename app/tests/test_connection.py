@@ -0,0 +1,175 @@
+# Copyright (C) 2022 Robin Jespersen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import unittest
+from unittest import mock
+
+import type_cache
+from connection import ConnectionManager, ConnectionState, ServerConnection
+from polling import Polling
+from tests.helpers import make_node, make_server, start_opcua_server
+
+
+class RecordingBackend:
+    def __init__(self):
+        self.updates = []
+
+    async def server_update(self, server_id: int, connection_error: str = ''):
+        self.updates.append((server_id, connection_error))
+
+
+class RecordingIngest:
+    def __init__(self):
+        self.samples = []
+
+    async def put(self, sample):
+        self.samples.append(sample)
+
+
+async def wait_for(condition, timeout: float = 10):
+    for _ in range(int(timeout / 0.05)):
+        if condition():
+            return
+        await asyncio.sleep(0.05)
+    raise AssertionError('condition not met')
+
+
+class TestServerConnection(unittest.TestCase):
+
+    def test_backoff(self):
+        connection = ServerConnection(make_server(1, ''), None, None, min_backoff=1, max_backoff=8)
+        for attempts, delay in [(1, 1), (2, 2), (3, 4), (4, 8), (10, 8)]:
+            connection.attempts = attempts
+            for _ in range(10):
+                self.assertGreaterEqual(connection.backoff(), delay / 2)
+                self.assertLessEqual(connection.backoff(), delay)
+
+
+class TestConnectionManager(unittest.IsolatedAsyncioTestCase):
+
+    async def test_unreachable_servers_fail_concurrently(self):
+        backend = RecordingBackend()
+        manager = ConnectionManager(backend, None, max_concurrency=4, timeout=1, min_backoff=0.01, max_attempts=2)
+        # nothing listens on port 1, every attempt fails immediately
+        await manager.update([make_server(i, 'opc.tcp://127.0.0.1:1') for i in range(4)])
+        for _ in range(100):
+            if manager.states()['failed'] == 4:
+                break
+            await asyncio.sleep(0.05)
+        self.assertEqual(manager.states()['failed'], 4)
+        self.assertEqual(manager.connected(), {})
+        self.assertEqual(len(backend.updates), 8)
+        self.assertTrue(all(error != '' for _, error in backend.updates))
+
+        await manager.update([])
+        self.assertEqual(manager.connections, {})
+        await manager.close()
+
+    async def test_remove_cancels_backoff(self):
+        manager = ConnectionManager(RecordingBackend(), None, timeout=1, min_backoff=60)
+        await manager.update([make_server(1, 'opc.tcp://127.0.0.1:1')])
+        for _ in range(100):
+            if manager.connections[1].state == ConnectionState.BACKOFF:
+                break
+            await asyncio.sleep(0.05)
+        self.assertEqual(manager.connections[1].state, ConnectionState.BACKOFF)
+        await asyncio.wait_for(manager.close(), 1)
+        self.assertEqual(manager.connections, {})
+
+
+class TestReconnect(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.server, self.url, self.variables = await start_opcua_server(1)
+        self.backend = RecordingBackend()
+        self.ingest = RecordingIngest()
+        self.manager = ConnectionManager(
+            self.backend, self.ingest, timeout=2, min_backoff=0.1, watchdog_interval=1, reconnect_timeout=10,
+        )
+
+    async def asyncTearDown(self):
+        await self.manager.close()
+        await self.server.stop()
+
+    async def test_restores_subscriptions(self):
+        await self.manager.update([make_server(1, self.url)])
+        await wait_for(lambda: self.manager.connected())
+        connection = self.manager.connections[1]
+        subscriptions = connection.subscriptions
+        await subscriptions.apply({1: make_node(1, 1, self.variables[0].nodeid.to_string())})
+
+        await self.server.stop()
+        await wait_for(lambda: connection.state == ConnectionState.RECONNECTING)
+        self.server, _, self.variables = await start_opcua_server(1, self.url)
+        await wait_for(lambda: connection.connected)
+        self.assertEqual(connection.restores, 1)
+        self.assertIs(connection.subscriptions, subscriptions)
+        self.assertNotEqual(self.backend.updates[-2][1], '')
+        self.assertEqual(self.backend.updates[-1], (1, ''))
+
+        # the new server dropped the subscription, it was recreated with its monitored items
+        await wait_for(lambda: len(subscriptions) == 1 and subscriptions.groups[1000]._alive(1))
+        self.ingest.samples.clear()
+        await self.variables[0].write_value(42.0)
+        await wait_for(lambda: any(sample.value == 42.0 for sample in self.ingest.samples))
+
+    async def test_reconnects_from_scratch(self):
+        self.manager.reconnect_timeout = 0.5
+        await self.manager.update([make_server(1, self.url)])
+        await wait_for(lambda: self.manager.connected())
+        connection = self.manager.connections[1]
+        subscriptions = connection.subscriptions
+
+        await self.server.stop()
+        await wait_for(lambda: connection.state in (ConnectionState.CONNECTING, ConnectionState.BACKOFF))
+        self.server, _, self.variables = await start_opcua_server(1, self.url)
+        await wait_for(lambda: connection.connected)
+        self.assertIsNot(connection.subscriptions, subscriptions)
+        self.assertEqual(connection.restores, 0)
+
+    async def test_unexpected_error_is_retried(self):
+        with mock.patch.object(ServerConnection, '_subscribe_events', side_effect=[RuntimeError('unexpected'), None]):
+            await self.manager.update([make_server(1, self.url)])
+            await wait_for(lambda: self.manager.connected())
+        self.assertEqual(self.manager.connections[1].attempts, 0)
+
+    async def test_type_definitions_are_loaded_once(self):
+        connection = ServerConnection(make_server(1, self.url), self.backend, self.ingest, timeout=2)
+        with mock.patch.object(type_cache, 'collect', wraps=type_cache.collect) as load:
+            await connection.connect()
+            await connection.disconnect()
+            await connection.connect()
+            await connection.disconnect()
+        self.assertEqual(load.call_count, 1)
+        self.assertIn('MaxMonitoredItemsPerCall', connection.limits)
+
+    async def test_polling_mode(self):
+        await self.manager.update([make_server(1, self.url, acquisition_mode='polling')])
+        await wait_for(lambda: self.manager.connected())
+        polling = self.manager.connections[1].subscriptions
+        self.assertIsInstance(polling, Polling)
+        await polling.apply({1: make_node(1, 1, self.variables[0].nodeid.to_string(), publishing_interval=100)})
+        await wait_for(lambda: len(self.ingest.samples) == 1)
+
+        # changing the mode connects again
+        await self.manager.update([make_server(1, self.url)])
+        await wait_for(lambda: self.manager.connected())
+        self.assertNotIsInstance(self.manager.connections[1].subscriptions, Polling)
+        self.assertEqual(polling.groups, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,119 @@
+# Copyright (C) 2022 Robin Jespersen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import asyncio
+import unittest
+
+from asyncua import ua
+
+from connection import ServerConnection
+from events import EventSettings
+from sub_handler import SubHandler
+from tests.helpers import make_server, start_opcua_server
+from tests.test_connection import RecordingBackend, RecordingIngest, wait_for
+
+
+class RecordingQueue:
+    def __init__(self):
+        self.events = []
+
+    def put_nowait(self, event):
+        self.events.append(event)
+
+
+class TestEventSettings(unittest.TestCase):
+
+    def test_server_overrides_defaults(self):
+        defaults = EventSettings(enabled=True, min_severity=100)
+        settings = defaults.of(make_server(1, '', events=False, event_fields='Message, 2:Custom/Value'))
+        self.assertFalse(settings.enabled)
+        self.assertEqual(settings.fields, ('Message', '2:Custom/Value'))
+        self.assertEqual(settings.min_severity, 100)
+        self.assertEqual(defaults.of(make_server(1, '')), defaults)
+
+    def test_filter(self):
+        event_filter = EventSettings(fields=('Message', '2:Custom/Value')).filter()
+        self.assertEqual(
+            [clause.BrowsePath for clause in event_filter.SelectClauses],
+            [[ua.QualifiedName('Message')], [ua.QualifiedName('Custom', 2), ua.QualifiedName('Value')]],
+        )
+        self.assertEqual(event_filter.WhereClause.Elements, [])
+
+        elements = EventSettings(types=('i=2041', 'i=2782', 'i=2915'), min_severity=500).filter().WhereClause.Elements
+        operators = [element.FilterOperator for element in elements]
+        # (OfType or (OfType or OfType)) and Severity >= 500
+        self.assertEqual(operators, [
+            ua.FilterOperator.And, ua.FilterOperator.Or, ua.FilterOperator.OfType, ua.FilterOperator.Or,
+            ua.FilterOperator.OfType, ua.FilterOperator.OfType, ua.FilterOperator.GreaterThanOrEqual,
+        ])
+        self.assertEqual([operand.Index for operand in elements[0].FilterOperands], [1, 6])
+        self.assertEqual([operand.Index for operand in elements[3].FilterOperands], [4, 5])
+
+
+class TestEventCollection(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.server, self.url, _ = await start_opcua_server(0)
+        self.backend = RecordingBackend()
+        self.events = RecordingQueue()
+
+    async def asyncTearDown(self):
+        await self.server.stop()
+
+    async def test_collects_filtered_events(self):
+        connection = ServerConnection(
+            make_server(1, self.url), self.backend, RecordingIngest(), timeout=2,
+            event_settings=EventSettings(enabled=True, min_severity=500, publishing_interval=50),
+            events=self.events,
+        )
+        await connection.connect()
+        generator = await self.server.get_event_generator()
+        for severity in [100, 800]:
+            generator.event.Severity = severity
+            generator.event.Message = ua.LocalizedText(f'severity {severity}')
+            await generator.trigger()
+        await wait_for(lambda: self.events.events)
+        await asyncio.sleep(0.2)
+        await connection.disconnect()
+
+        # the event below the minimum severity was dropped by the server
+        self.assertEqual(len(self.events.events), 1)
+        event = self.events.events[0]
+        self.assertEqual(event.server_id, 1)
+        self.assertEqual(event.fields['Severity'], 800)
+        self.assertEqual(event.fields['SourceName'], 'Server')
+        self.assertEqual(set(event.fields), set(EventSettings().fields))
+
+    async def test_invalid_event_types(self):
+        connection = ServerConnection(
+            make_server(1, self.url, event_types='not a node id'), self.backend, RecordingIngest(), timeout=2,
+            event_settings=EventSettings(enabled=True), events=self.events,
+        )
+        # the values are collected anyway
+        await connection.connect()
+        self.assertTrue(connection.connected)
+        await connection.disconnect()
+
+    async def test_status_change_updates_server(self):
+        connection = ServerConnection(make_server(1, self.url), self.backend, RecordingIngest())
+        handler = SubHandler(1, self.backend, RecordingIngest(), status_changed=connection._status_changed)
+        await handler.status_change_notification(ua.StatusChangeNotification(ua.StatusCode(ua.StatusCodes.BadTimeout)))
+        await handler.status_change_notification(ua.StatusChangeNotification(ua.StatusCode(ua.StatusCodes.Good)))
+        self.assertEqual(self.backend.updates, [(1, 'StatusChange(BadTimeout)'), (1, '')])
+
+
+if __name__ == '__main__':
+    unittest.main()
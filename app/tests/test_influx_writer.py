@@ -0,0 +1,93 @@
+# Copyright (C) 2022 Robin Jespersen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from influx_writer import InfluxWriter
+from models.sample import Sample
+
+
+class TestInfluxWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.writer = InfluxWriter('http://influx', 'test')
+
+    def test_encode_types(self):
+        lines = self.writer.encode([
+            Sample(1, 'ns=2;s=a b', 10, 1),
+            Sample(1, 'ns=2;i=2', 10, 1.5),
+            Sample(1, 'ns=2;i=3', 10, True),
+            Sample(1, 'ns=2;i=4', 10, 'say "hi"'),
+            Sample(1, 'ns=2;i=5', 10, {'x': 1, 'y': {'z': 2.0}}),
+            Sample(1, 'ns=2;i=6', 10, [1, 2]),
+            Sample(1, 'ns=2;i=7', 10, None),
+            Sample(1, 'ns=2;i=8', 1640995200123456789, 1.5, 0x80000000),
+            Sample(1, 'ns=2;i=9', 10, float('nan'), 0x80000000),
+        ]).decode().splitlines()
+        self.assertEqual(lines, [
+            'opcua,server_id=1,node_id=ns\\=2;s\\=a\\ b value=1i,status=0i 10',
+            'opcua,server_id=1,node_id=ns\\=2;i\\=2 value=1.5,status=0i 10',
+            'opcua,server_id=1,node_id=ns\\=2;i\\=3 value=true,status=0i 10',
+            'opcua,server_id=1,node_id=ns\\=2;i\\=4 value="say \\"hi\\"",status=0i 10',
+            'opcua,server_id=1,node_id=ns\\=2;i\\=5 value.x=1i,value.y.z=2.0,status=0i 10',
+            'opcua,server_id=1,node_id=ns\\=2;i\\=6 value="[1, 2]",status=0i 10',
+            'opcua,server_id=1,node_id=ns\\=2;i\\=7 status=0i 10',
+            'opcua,server_id=1,node_id=ns\\=2;i\\=8 value=1.5,status=2147483648i 1640995200123456789',
+            'opcua,server_id=1,node_id=ns\\=2;i\\=9 status=2147483648i 10',
+        ])
+
+    def test_encode_reuses_buffer(self):
+        self.writer.encode([Sample(1, 'a', 1, 1)] * 10)
+        self.assertEqual(self.writer.encode([Sample(1, 'a', 1, 1)]), b'opcua,server_id=1,node_id=a value=1i,status=0i 1\n')
+
+
+class TestInfluxWriterHttp(unittest.IsolatedAsyncioTestCase):
+
+    async def test_write(self):
+        received = []
+
+        async def write(request: web.Request):
+            # aiohttp decompresses the body according to the Content-Encoding header
+            received.append((request.query, request.headers['Content-Encoding'], await request.read()))
+            return web.Response(status=204)
+
+        app = web.Application()
+        app.router.add_post('/write', write)
+        server = TestServer(app)
+        await server.start_server()
+        writer = InfluxWriter(str(server.make_url('')), 'test', username='user', password='secret')
+        try:
+            response = await writer.influx_store_batch([Sample(1, 'a', 1, 1), Sample(1, 'b', 1, 2)])
+        finally:
+            await writer.close()
+            await server.close()
+
+        self.assertEqual(response.status_code, 200)
+        query, encoding, body = received[0]
+        self.assertEqual(query['db'], 'test')
+        self.assertEqual(query['precision'], 'ns')
+        self.assertEqual(query['u'], 'user')
+        self.assertEqual(encoding, 'gzip')
+        self.assertEqual(body, (
+            b'opcua,server_id=1,node_id=a value=1i,status=0i 1\n'
+            b'opcua,server_id=1,node_id=b value=2i,status=0i 1\n'
+        ))
+
+
+if __name__ == '__main__':
+    unittest.main()
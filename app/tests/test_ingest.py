@@ -0,0 +1,109 @@
+# Copyright (C) 2022 Robin Jespersen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import unittest
+
+from async_backend import BackendResponse
+from ingest import IngestQueue
+from models.sample import Sample
+
+
+class RecordingBackend:
+    def __init__(self, status_code: int = 200):
+        self.status_code = status_code
+        self.batches = []
+
+    async def influx_store_batch(self, samples):
+        self.batches.append(samples)
+        return BackendResponse(self.status_code, '')
+
+
+class TestIngestQueue(unittest.IsolatedAsyncioTestCase):
+
+    async def test_batch_size(self):
+        backend = RecordingBackend()
+        ingest = IngestQueue(backend, max_batch_size=3, max_batch_age=10)
+        ingest.start()
+        for i in range(7):
+            await ingest.put(Sample(1, 'ns=2;i=1', i, i))
+        await asyncio.sleep(0)
+        await ingest.close()
+        self.assertEqual([len(b) for b in backend.batches], [3, 3, 1])
+        self.assertEqual(ingest.sent, 7)
+        self.assertEqual([s.value for b in backend.batches for s in b], list(range(7)))
+
+    async def test_batch_age(self):
+        backend = RecordingBackend()
+        ingest = IngestQueue(backend, max_batch_size=100, max_batch_age=0.01)
+        ingest.start()
+        await ingest.put(Sample(1, 'ns=2;i=1', 0, 0))
+        await asyncio.sleep(0.05)
+        self.assertEqual(len(backend.batches), 1)
+        await ingest.close()
+
+    async def test_drop(self):
+        backend = RecordingBackend()
+        ingest = IngestQueue(backend, max_size=2)
+        for i in range(3):
+            await ingest.put(Sample(1, 'ns=2;i=1', i, i))
+        self.assertEqual(ingest.depth, 2)
+        self.assertEqual(ingest.dropped, 1)
+
+    async def test_block(self):
+        backend = RecordingBackend()
+        ingest = IngestQueue(backend, max_size=2, max_batch_size=2, block=True)
+        ingest.start()
+        await asyncio.wait_for(
+            asyncio.gather(*[ingest.put(Sample(1, 'ns=2;i=1', i, i)) for i in range(6)]),
+            1,
+        )
+        await ingest.close()
+        self.assertEqual(ingest.dropped, 0)
+        self.assertEqual(ingest.sent, 6)
+
+    async def test_failed(self):
+        backend = RecordingBackend(500)
+        ingest = IngestQueue(backend)
+        ingest.start()
+        await ingest.put(Sample(1, 'ns=2;i=1', 0, 0))
+        await ingest.close()
+        self.assertEqual(ingest.failed, 1)
+        self.assertEqual(ingest.sent, 0)
+
+    async def test_unexpected_error(self):
+        backend = RecordingBackend()
+        batches = backend.batches
+
+        async def influx_store_batch(samples):
+            if not batches:
+                batches.append(None)
+                raise TypeError('not serializable')
+            batches.append(samples)
+            return BackendResponse(200, '')
+        backend.influx_store_batch = influx_store_batch
+
+        ingest = IngestQueue(backend, max_batch_size=1)
+        ingest.start()
+        for i in range(3):
+            await ingest.put(Sample(1, 'ns=2;i=1', i, i))
+            await asyncio.sleep(0)
+        await asyncio.wait_for(ingest.close(), 1)
+        self.assertEqual(ingest.failed, 1)
+        self.assertEqual(ingest.sent, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
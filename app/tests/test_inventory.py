@@ -0,0 +1,89 @@
+# Copyright (C) 2022 Robin Jespersen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+
+from inventory import Inventory
+from tests.helpers import make_node, make_server
+
+
+class FakeBackend:
+    def __init__(self):
+        self.nodes = {}
+        self.servers = []
+        self.requests = []
+
+    async def server_index_changed(self):
+        return self.servers
+
+    async def node_index_changed(self, updated_since=None):
+        self.requests.append(updated_since)
+        if updated_since is None:
+            return [n for n in self.nodes.values() if n.tracked and not n.virtual]
+        return [n for n in self.nodes.values() if n.updated_at >= updated_since]
+
+
+class TestInventory(unittest.IsolatedAsyncioTestCase):
+
+    async def test_servers(self):
+        backend = FakeBackend()
+        backend.servers = [make_server(1, 'opc.tcp://a'), make_server(2, 'opc.tcp://b')]
+        inventory = Inventory(backend)
+        self.assertEqual([s.id for s in await inventory.sync_servers()], [1, 2])
+        backend.servers = None  # not modified
+        self.assertEqual([s.id for s in await inventory.sync_servers()], [1, 2])
+
+    async def test_incremental(self):
+        backend = FakeBackend()
+        backend.nodes = {i: make_node(i, 1, f'ns=2;i={i}', updated_at=10) for i in range(3)}
+        backend.nodes[3] = make_node(3, 2, 'ns=2;i=3', updated_at=10, tracked=False)
+        inventory = Inventory(backend)
+
+        changes = await inventory.sync_nodes()
+        self.assertEqual(set(changes), {1})
+        self.assertEqual(set(changes[1]), {0, 1, 2})
+        self.assertEqual(inventory.watermark, 10)
+
+        # unchanged rows at the watermark are listed again, but are no change
+        self.assertEqual(await inventory.sync_nodes(), {})
+        self.assertEqual(backend.requests, [None, 10])
+
+        # a second edit within the same second is a change
+        backend.nodes[2] = make_node(2, 1, 'ns=2;i=2', updated_at=10, sampling_interval=100)
+        self.assertEqual(await inventory.sync_nodes(), {1: {2: backend.nodes[2]}})
+        self.assertEqual(await inventory.sync_nodes(), {})
+
+        backend.nodes[0] = make_node(0, 1, 'ns=2;i=0', updated_at=11, tracked=False)
+        backend.nodes[1] = make_node(1, 2, 'ns=2;i=1', updated_at=11)
+        backend.nodes[3] = make_node(3, 2, 'ns=2;i=3', updated_at=12)
+        changes = await inventory.sync_nodes()
+        self.assertEqual(changes, {1: {0: None, 1: None}, 2: {1: backend.nodes[1], 3: backend.nodes[3]}})
+        self.assertEqual(set(inventory.server_nodes[1]), {2})
+        self.assertEqual(set(inventory.server_nodes[2]), {1, 3})
+        self.assertEqual(inventory.watermark, 12)
+
+    async def test_full_sync_removes_deleted(self):
+        backend = FakeBackend()
+        backend.nodes = {i: make_node(i, 1, f'ns=2;i={i}', updated_at=10) for i in range(3)}
+        inventory = Inventory(backend, full_sync_interval=0)
+        await inventory.sync_nodes()
+        del backend.nodes[1]
+        self.assertEqual(await inventory.sync_nodes(), {1: {1: None}})
+        self.assertEqual(backend.requests, [None, None])
+        self.assertEqual(set(inventory.nodes), {0, 2})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+# Copyright (C) 2022 Robin Jespersen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import unittest
+
+from aiohttp.test_utils import TestClient, TestServer
+
+from last_values import LastValue, LastValueCache, Watcher
+from live_api import LiveApi
+
+
+class TestLastValueCache(unittest.IsolatedAsyncioTestCase):
+
+    async def test_watcher(self):
+        cache = LastValueCache()
+        watcher = Watcher({(1, 'ns=2;i=1')}, {2})
+        cache.watch(watcher)
+        for i in range(3):
+            cache.put(1, 'ns=2;i=1', LastValue(i, None, None, 0))
+        cache.put(1, 'ns=2;i=2', LastValue(0, None, None, 0))
+        cache.put(2, 'ns=2;i=2', LastValue(5, None, None, 0))
+        # only the latest value of every watched key is kept
+        self.assertEqual(await watcher.take(), {
+            (1, 'ns=2;i=1'): LastValue(2, None, None, 0),
+            (2, 'ns=2;i=2'): LastValue(5, None, None, 0),
+        })
+        cache.unwatch(watcher)
+        self.assertEqual(len(cache), 3)
+        cache.remove_server(1)
+        self.assertEqual(len(cache), 1)
+
+
+class TestLiveApi(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.cache = LastValueCache()
+        self.cache.put(1, 'ns=2;i=1', LastValue(1.5, 10.0, 11.0, 0))
+        self.cache.put(1, 'ns=2;s=a:b', LastValue('x', None, 12.0, 0))
+        self.cache.put(2, 'ns=2;i=1', LastValue([1, 2], None, None, 2147483648))
+        self.client = TestClient(TestServer(LiveApi(self.cache).app))
+        await self.client.start_server()
+
+    async def asyncTearDown(self):
+        await self.client.close()
+
+    async def test_get_values(self):
+        response = await self.client.get('/values', params=[('node', '1:ns=2;s=a:b'), ('server_id', '2')])
+        self.assertEqual(await response.json(), [
+            {'server_id': 1, 'node_id': 'ns=2;s=a:b', 'value': 'x', 'source_time': None, 'server_time': 12.0, 'status': 0},
+            {
+                'server_id': 2, 'node_id': 'ns=2;i=1', 'value': [1, 2],
+                'source_time': None, 'server_time': None, 'status': 2147483648,
+            },
+        ])
+        response = await self.client.get('/values')
+        self.assertEqual(len(await response.json()), 3)
+        response = await self.client.get('/values', params={'node': 'a:b'})
+        self.assertEqual(response.status, 400)
+
+    async def test_post_values(self):
+        response = await self.client.post('/values', json={'nodes': [[1, 'ns=2;i=1'], [3, 'ns=2;i=1']]})
+        self.assertEqual([v['value'] for v in await response.json()], [1.5])
+
+    async def test_websocket(self):
+        ws = await self.client.ws_connect('/ws')
+        await ws.send_json({'server_ids': [1]})
+        self.assertEqual(len(await ws.receive_json(timeout=1)), 2)
+        self.cache.put(2, 'ns=2;i=1', LastValue(0, None, None, 0))
+        self.cache.put(1, 'ns=2;i=1', LastValue(2.5, None, None, 0))
+        changes = await ws.receive_json(timeout=1)
+        self.assertEqual([(v['server_id'], v['value']) for v in changes], [(1, 2.5)])
+        await ws.close()
+        for _ in range(10):
+            if not self.cache.watchers:
+                break
+            await asyncio.sleep(0.01)
+        self.assertEqual(self.cache.watchers, [])
+
+
+class TestLiveApiToken(unittest.IsolatedAsyncioTestCase):
+
+    async def test_token(self):
+        client = TestClient(TestServer(LiveApi(LastValueCache(), token='secret').app))
+        await client.start_server()
+        try:
+            self.assertEqual((await client.get('/values')).status, 401)
+            self.assertEqual((await client.get('/values', headers={'Authorization': 'Bearer wrong'})).status, 401)
+            self.assertEqual((await client.get('/values', headers={'Authorization': 'Bearer secret'})).status, 200)
+            self.assertEqual((await client.get('/values', params={'access_token': 'secret'})).status, 200)
+        finally:
+            await client.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
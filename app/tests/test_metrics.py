@@ -0,0 +1,67 @@
+# Copyright (C) 2022 Robin Jespersen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import unittest
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from prometheus_client import CollectorRegistry, REGISTRY
+
+import metrics
+from async_backend import AsyncBackend
+
+
+class TestMetrics(unittest.IsolatedAsyncioTestCase):
+
+    def test_stats_collector(self):
+        registry = CollectorRegistry()
+        stats = {'depth': 3, 'sent': 5, 'dropped': 1, 'failed': 0, 'spooled': 2, 'rejected': 0}
+        registry.register(metrics.StatsCollector(lambda: stats))
+        self.assertEqual(registry.get_sample_value('opcua_collector_ingest_queue_depth'), 3)
+        self.assertEqual(registry.get_sample_value('opcua_collector_ingest_samples_total', {'outcome': 'sent'}), 5)
+        self.assertEqual(registry.get_sample_value('opcua_collector_ingest_samples_total', {'outcome': 'spooled'}), 2)
+
+    async def test_backend_requests(self):
+        async def ping(request: web.Request):
+            return web.Response(status=503)
+
+        app = web.Application()
+        app.router.add_get('/api/status/ping', ping)
+        server = TestServer(app)
+        await server.start_server()
+        backend = AsyncBackend(str(server.make_url('')).rstrip('/'), 'token')
+        labels = {'method': 'GET', 'endpoint': '/api/status/ping'}
+        errors = dict(labels, error='503')
+        before = REGISTRY.get_sample_value('opcua_collector_backend_errors_total', errors) or 0
+        count = REGISTRY.get_sample_value('opcua_collector_backend_request_seconds_count', labels) or 0
+        try:
+            self.assertFalse(await backend.available())
+        finally:
+            await backend.close()
+            await server.close()
+        self.assertEqual(REGISTRY.get_sample_value('opcua_collector_backend_errors_total', errors), before + 1)
+        self.assertEqual(REGISTRY.get_sample_value('opcua_collector_backend_request_seconds_count', labels), count + 1)
+
+    async def test_loop_lag(self):
+        count = REGISTRY.get_sample_value('opcua_collector_event_loop_lag_seconds_count') or 0
+        task = asyncio.create_task(metrics.monitor_loop_lag(0.01))
+        await asyncio.sleep(0.05)
+        task.cancel()
+        self.assertGreater(REGISTRY.get_sample_value('opcua_collector_event_loop_lag_seconds_count'), count)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,125 @@
+# Copyright (C) 2022 Robin Jespersen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import unittest
+from unittest import mock
+
+import asyncua
+
+from monitored_items import MonitoredItems
+from operation_limits import chunks, read_operation_limits
+from tests.helpers import make_node, start_opcua_server
+
+
+class Handler:
+    def datachange_notification(self, node, value, data):
+        pass
+
+
+class TestChunks(unittest.TestCase):
+
+    def test_chunks(self):
+        self.assertEqual(list(chunks([1, 2, 3, 4, 5], 2)), [[1, 2], [3, 4], [5]])
+        self.assertEqual(list(chunks([1, 2, 3], 0)), [[1, 2, 3]])
+        self.assertEqual(list(chunks([], 2)), [])
+
+
+class TestMonitoredItems(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.server, url, self.variables = await start_opcua_server(5)
+        self.client = asyncua.Client(url)
+        await self.client.connect()
+        self.subscription = await self.client.create_subscription(100, Handler())
+
+    async def asyncTearDown(self):
+        await self.client.disconnect()
+        await self.server.stop()
+
+    async def test_read_operation_limits(self):
+        limits = await read_operation_limits(self.client)
+        self.assertIn('MaxMonitoredItemsPerCall', limits)
+        self.assertTrue(all(isinstance(limit, int) for limit in limits.values()))
+
+    async def test_apply(self):
+        items = MonitoredItems(self.client, self.subscription, max_per_call=2)
+        nodes = {i: make_node(i, 1, v.nodeid.to_string()) for i, v in enumerate(self.variables)}
+        nodes[10] = make_node(10, 1, 'ns=2;i=999999')
+        nodes[11] = make_node(11, 1, 'not a node id')
+
+        errors = await items.apply(nodes)
+        self.assertEqual(set(errors), {10, 11})
+        self.assertEqual(set(items.handles), {0, 1, 2, 3, 4})
+
+        # unchanged nodes are kept, removed and changed nodes are unsubscribed
+        handle = items.handles[0]
+        del nodes[1]
+        nodes[2] = make_node(2, 1, self.variables[1].nodeid.to_string())
+        errors = await items.apply(nodes)
+        self.assertEqual(set(errors), {10, 11})
+        self.assertEqual(set(items.handles), {0, 2, 3, 4})
+        self.assertEqual(items.handles[0], handle)
+        self.assertEqual(items.identifiers[2], self.variables[1].nodeid.to_string())
+
+        await items.apply({})
+        self.assertEqual(len(items), 0)
+
+    async def test_update(self):
+        items = MonitoredItems(self.client, self.subscription)
+        nodes = {i: make_node(i, 1, v.nodeid.to_string()) for i, v in enumerate(self.variables)}
+        await items.apply(nodes)
+        await items.update({0: None, 1: make_node(1, 1, 'not a node id')})
+        self.assertEqual(set(items.handles), {2, 3, 4})
+        self.assertEqual(set(items.pending), {1})
+
+        # failed nodes are retried with the next update
+        items.pending[1] = nodes[1]
+        self.assertEqual(await items.update({}), {})
+        self.assertEqual(set(items.handles), {1, 2, 3, 4})
+        self.assertEqual(items.pending, {})
+
+    async def test_timeouts_are_retried(self):
+        items = MonitoredItems(self.client, self.subscription, max_per_call=2)
+        nodes = {i: make_node(i, 1, v.nodeid.to_string()) for i, v in enumerate(self.variables)}
+        create = self.subscription.create_monitored_items
+        calls = [asyncio.TimeoutError()]
+
+        async def flaky_create(requests):
+            if calls:
+                raise calls.pop()
+            return await create(requests)
+
+        with mock.patch.object(self.subscription, 'create_monitored_items', flaky_create):
+            errors = await items.apply(nodes)
+        self.assertEqual(set(errors), {0, 1})
+        self.assertEqual(set(items.pending), {0, 1})
+        self.assertEqual(await items.update({}), {})
+        self.assertEqual(set(items.handles), {0, 1, 2, 3, 4})
+
+        # items that could not be deleted are deleted with the next update
+        with mock.patch.object(self.subscription, 'unsubscribe', side_effect=OSError):
+            errors = await items.update({0: None, 1: make_node(1, 1, self.variables[0].nodeid.to_string())})
+        self.assertEqual(set(errors), {0, 1})
+        self.assertEqual(items.stale, {0, 1})
+        self.assertEqual(set(items.handles), {0, 1, 2, 3, 4})
+        self.assertEqual(await items.update({}), {})
+        self.assertEqual(items.stale, set())
+        self.assertEqual(set(items.handles), {1, 2, 3, 4})
+        self.assertEqual(items.identifiers[1], self.variables[0].nodeid.to_string())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+# Copyright (C) 2022 Robin Jespersen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import unittest
+
+import asyncua
+from asyncua import ua
+
+from polling import Polling
+from tests.helpers import make_node, start_opcua_server
+
+
+class Handler:
+    server_id = 1
+
+    def __init__(self):
+        self.values = []
+
+    async def store(self, node_id, value, data_value):
+        self.values.append((node_id, value))
+
+
+class SlowUaClient:
+    def __init__(self, delay: float):
+        self.delay = delay
+        self.reads = 0
+
+    async def read(self, parameters):
+        self.reads += 1
+        await asyncio.sleep(self.delay)
+        return [ua.DataValue(ua.Variant(self.reads, ua.VariantType.Int64)) for _ in parameters.NodesToRead]
+
+
+class SlowClient:
+    def __init__(self, delay: float):
+        self.uaclient = SlowUaClient(delay)
+
+
+class TestPolling(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.server, url, self.variables = await start_opcua_server(3)
+        self.client = asyncua.Client(url)
+        await self.client.connect()
+
+    async def asyncTearDown(self):
+        await self.client.disconnect()
+        await self.server.stop()
+
+    async def test_polls_changes(self):
+        handler = Handler()
+        polling = Polling(self.client, handler, max_per_read=2)
+        identifiers = [v.nodeid.to_string() for v in self.variables]
+        errors = await polling.apply({
+            0: make_node(0, 1, identifiers[0], publishing_interval=100),
+            1: make_node(1, 1, identifiers[1], publishing_interval=100),
+            2: make_node(2, 1, identifiers[2], publishing_interval=100),
+            3: make_node(3, 1, identifiers[2], publishing_interval=200),
+            4: make_node(4, 1, 'invalid'),
+        })
+        self.assertEqual(set(errors), {4})
+        self.assertEqual(set(polling.groups), {100, 200})
+        self.assertEqual(len(polling), 4)
+        await asyncio.sleep(0.5)
+        # unchanged values are stored once
+        self.assertEqual(sorted(handler.values), sorted([(i, 0.0) for i in identifiers] + [(identifiers[2], 0.0)]))
+        self.assertEqual(len(polling.groups[100].requests), 2)
+
+        await self.variables[0].write_value(1.5)
+        await asyncio.sleep(0.3)
+        self.assertEqual(handler.values[-1], (identifiers[0], 1.5))
+
+        await polling.update({3: None})
+        self.assertEqual(set(polling.groups), {100})
+        await polling.close()
+        self.assertEqual(polling.groups, {})
+
+    async def test_slows_down_when_reads_get_slow(self):
+        client = SlowClient(0.09)
+        polling = Polling(client, Handler(), max_slowdown=4)
+        await polling.apply({0: make_node(0, 1, 'i=1', publishing_interval=100)})
+        await asyncio.sleep(0.5)
+        # reads take 45% of the doubled interval
+        self.assertEqual(polling.slowdown, 2)
+
+        client.uaclient.delay = 0.25
+        await asyncio.sleep(1)
+        self.assertEqual(polling.slowdown, 4)
+
+        client.uaclient.delay = 0
+        await asyncio.sleep(1.5)
+        self.assertLess(polling.slowdown, 4)
+        await polling.close()
+
+    async def test_skips_missed_cycles(self):
+        client = SlowClient(0.25)
+        polling = Polling(client, Handler(), max_slowdown=1)
+        await polling.apply({0: make_node(0, 1, 'i=1', publishing_interval=100)})
+        await asyncio.sleep(0.6)
+        await polling.close()
+        # reads start at 0, 0.3 and 0.6 instead of catching up
+        self.assertLessEqual(client.uaclient.reads, 3)
+        self.assertGreaterEqual(polling.overruns, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
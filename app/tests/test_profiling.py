@@ -0,0 +1,89 @@
+# Copyright (C) 2022 Robin Jespersen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import asyncio
+import os
+import pstats
+import tempfile
+import time
+import unittest
+from types import SimpleNamespace
+
+from asyncua import ua
+
+from profiling import Profiler
+from sub_handler import SubHandler
+from tests.test_sub_handler import RecordingIngest, notification
+
+
+def busy(seconds: float):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+
+class TestProfiler(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    async def asyncTearDown(self):
+        self.directory.cleanup()
+
+    async def test_cprofile_stages_and_slow_callbacks(self):
+        original = SubHandler.datachange_notification
+        handle_run = asyncio.Handle._run
+        profiler = Profiler(self.directory.name, slow_callback=0.05)
+        profiler.enable()
+        self.assertIsNot(SubHandler.datachange_notification, original)
+
+        handler = SubHandler(1, None, RecordingIngest())
+        node = SimpleNamespace(nodeid=ua.NodeId(1, 2))
+        for i in range(3):
+            await handler.datachange_notification(node, i, notification(ua.DataValue(ua.Variant(i))))
+        await handler.close()
+        asyncio.get_running_loop().call_soon(busy, 0.1)
+        await asyncio.sleep(0.01)
+        self.assertEqual(profiler.slow_callbacks, 1)
+
+        files = profiler.dump()
+        stats = pstats.Stats(files[0])
+        self.assertTrue(any(function == 'busy' for _, _, function in stats.stats))
+        with open(files[1]) as f:
+            report = f.read()
+        self.assertIn('SubHandler.datachange_notification', report)
+        self.assertIn('SubHandler._store', report)
+
+        profiler.disable()
+        # nothing is left patched
+        self.assertIs(SubHandler.datachange_notification, original)
+        self.assertIs(asyncio.Handle._run, handle_run)
+        self.assertEqual(len(os.listdir(self.directory.name)), 4)
+
+    async def test_sampling(self):
+        profiler = Profiler(self.directory.name, mode='sample', sample_interval=0.005)
+        profiler.toggle()
+        busy(0.2)
+        profiler.toggle()
+        self.assertFalse(profiler.enabled)
+        folded = [name for name in os.listdir(self.directory.name) if name.endswith('.folded')]
+        with open(os.path.join(self.directory.name, folded[0])) as f:
+            stacks = [line.rsplit(' ', 1) for line in f]
+        self.assertGreater(sum(int(count) for stack, count in stacks if 'busy (test_profiling.py' in stack), 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
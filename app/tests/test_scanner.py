@@ -0,0 +1,177 @@
+# Copyright (C) 2022 Robin Jespersen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import asyncio
+import tempfile
+import time
+import unittest
+from types import SimpleNamespace
+
+import aiohttp
+import asyncua
+from asyncua import ua
+
+from scanner import Scanner, Scans, ScanSettings
+from tests.helpers import make_server, start_opcua_server
+
+
+class PagedUaClient:
+    """
+    returns at most max_references references per node and the rest with BrowseNext,
+    like servers with continuation points
+    """
+
+    def __init__(self, uaclient, max_references: int):
+        self.uaclient = uaclient
+        self.max_references = max_references
+        self.points = {}
+        self.browse_next_calls = 0
+
+    async def browse(self, parameters):
+        return [self._page(result.References) for result in await self.uaclient.browse(parameters)]
+
+    async def browse_next(self, parameters):
+        self.browse_next_calls += 1
+        return [self._page(self.points.pop(point)) for point in parameters.ContinuationPoints]
+
+    async def read(self, parameters):
+        return await self.uaclient.read(parameters)
+
+    def _page(self, references):
+        result = ua.BrowseResult()
+        result.References = references[:self.max_references]
+        if len(references) > self.max_references:
+            result.ContinuationPoint = str(len(self.points)).encode() + b'-' + str(id(references)).encode()
+            self.points[result.ContinuationPoint] = references[self.max_references:]
+        return result
+
+
+class RecordingBackend:
+    def __init__(self, status_code=200):
+        self.status_code = status_code
+        self.stored = []
+        self.scanned = []
+
+    async def node_store_batch(self, server_id, nodes):
+        if isinstance(self.status_code, Exception):
+            raise self.status_code
+        self.stored.append((server_id, list(nodes)))
+        return SimpleNamespace(status_code=self.status_code)
+
+    async def server_scanned(self, server_id):
+        self.scanned.append(server_id)
+
+
+class TestScanner(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.server, self.url, _ = await start_opcua_server(0)
+        idx = await self.server.get_namespace_index('urn:opcua_collector:test')
+        plant = await self.server.nodes.objects.add_object(idx, 'Plant')
+        for i in range(3):
+            line = await plant.add_object(idx, f'Line{i}')
+            for j in range(4):
+                variable = await line.add_variable(idx, f'Value{j}', j, ua.VariantType.Int32)
+                if j % 2:
+                    await variable.set_writable()
+        self.client = asyncua.Client(self.url)
+        await self.client.connect()
+
+    async def asyncTearDown(self):
+        await self.client.disconnect()
+        await self.server.stop()
+
+    async def test_scan(self):
+        paged = PagedUaClient(self.client.uaclient, 2)
+        scanner = Scanner(SimpleNamespace(uaclient=paged), ScanSettings(max_nodes_per_browse=2, max_nodes_per_read=3))
+        nodes = {node.path: node for node in await scanner.scan('i=85')}
+        self.assertGreater(paged.browse_next_calls, 0)
+        # the Server object in namespace 0 is skipped, Test is created by start_opcua_server
+        self.assertEqual(len(nodes), 2 + 3 + 3 * 4)
+        self.assertEqual(nodes['/Plant'].parent_identifier, 'i=85')
+        self.assertEqual(nodes['/Plant'].data_type, '')
+        value = nodes['/Plant/Line2/Value1']
+        self.assertEqual(value.parent_identifier, nodes['/Plant/Line2'].identifier)
+        self.assertEqual((value.display_name, value.data_type, value.readable, value.writable),
+                         ('Value1', 'Int32', True, True))
+        self.assertFalse(nodes['/Plant/Line2/Value0'].writable)
+
+    async def test_depth_and_rate(self):
+        scanner = Scanner(self.client, ScanSettings(max_depth=2, max_rate=20, max_nodes_per_browse=1))
+        started = time.monotonic()
+        nodes = await scanner.scan('i=85')
+        self.assertEqual(
+            sorted(node.path for node in nodes),
+            ['/Plant', '/Plant/Line0', '/Plant/Line1', '/Plant/Line2', '/Test'],
+        )
+        # 1 + 2 browse requests are started 50ms apart
+        self.assertEqual(scanner.requests, 3)
+        self.assertGreaterEqual(time.monotonic() - started, 0.1)
+
+    async def test_scans_push_and_cache(self):
+        backend = RecordingBackend()
+        with tempfile.TemporaryDirectory() as directory:
+            server = make_server(1, self.url, scan_required=True)
+            connection = SimpleNamespace(server=server, client=self.client, limits={}, types_key='key')
+            scans = Scans(backend, directory=directory, batch_size=10)
+            scans.update({1: connection})
+            scans.update({1: connection})
+            self.assertEqual(len(scans.tasks), 1)
+            await asyncio.gather(*scans.tasks.values())
+            self.assertEqual(backend.scanned, [1])
+            self.assertEqual([len(nodes) for _, nodes in backend.stored], [10, 7])
+            # scanned until the API lists the server without scan_required
+            scans.update({1: connection})
+            self.assertEqual(scans.tasks, {})
+
+            # another collector takes the nodes from the cache
+            cached = Scans(backend, directory=directory)
+            cached.update({1: SimpleNamespace(server=server, client=None, limits={}, types_key='key')})
+            await asyncio.gather(*cached.tasks.values())
+            self.assertEqual(backend.scanned, [1, 1])
+            self.assertEqual(backend.stored[2][1], backend.stored[0][1] + backend.stored[1][1])
+
+            # a new request browses the server again
+            server = make_server(1, self.url, scan_required=True, updated_at=server.updated_at + 1)
+            paged = PagedUaClient(self.client.uaclient, 2)
+            rescan = Scans(backend, directory=directory)
+            client = SimpleNamespace(uaclient=paged)
+            rescan.update({1: SimpleNamespace(server=server, client=client, limits={}, types_key='key')})
+            await asyncio.gather(*rescan.tasks.values())
+            self.assertGreater(paged.browse_next_calls, 0)
+            self.assertEqual(backend.scanned, [1, 1, 1])
+
+    async def test_scans_back_off(self):
+        for backend in [RecordingBackend(500), RecordingBackend(aiohttp.ClientConnectionError())]:
+            server = make_server(1, self.url, scan_required=True)
+            connection = SimpleNamespace(server=server, client=self.client, limits={}, types_key='key')
+            scans = Scans(backend, retry_interval=0.2)
+            scans.update({1: connection})
+            await asyncio.gather(*scans.tasks.values())
+            self.assertEqual(backend.scanned, [])
+            # not browsed again before retry_interval passed
+            scans.update({1: connection})
+            self.assertEqual(scans.tasks, {})
+            await asyncio.sleep(0.2)
+            backend.status_code = 200
+            scans.update({1: connection})
+            await asyncio.gather(*scans.tasks.values())
+            self.assertEqual(backend.scanned, [1])
+            self.assertEqual(scans.retry_at, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+# Copyright (C) 2022 Robin Jespersen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import dataclasses
+import datetime
+import unittest
+
+from asyncua import ua
+
+from serializer import Serializer
+
+
+@dataclasses.dataclass
+class Point:
+    X: float = 0.0
+    Y: float = 0.0
+    Valid: bool = True
+
+
+@dataclasses.dataclass
+class Line:
+    Start: Point = dataclasses.field(default_factory=Point)
+    End: Point = dataclasses.field(default_factory=Point)
+    Name: ua.LocalizedText = dataclasses.field(default_factory=ua.LocalizedText)
+
+
+class FakeArray:
+    dtype = 'float64'
+
+    def __init__(self, values):
+        self.values = values
+
+    def tolist(self):
+        return list(self.values)
+
+
+class TestSerializer(unittest.TestCase):
+
+    def setUp(self):
+        self.serializer = Serializer()
+
+    def test_primitives(self):
+        self.assertEqual(self.serializer(None), None)
+        self.assertEqual(self.serializer('a'), 'a')
+        self.assertEqual(self.serializer(1), 1)
+        self.assertEqual(self.serializer(1.5), 1.5)
+        self.assertEqual(self.serializer(True), 1)
+        self.assertEqual(self.serializer(datetime.datetime(2022, 1, 1, tzinfo=datetime.timezone.utc)), '1640995200')
+
+    def test_dataclass(self):
+        line = Line(Point(1.0, 2.0), Point(3.0, 4.0, False), ua.LocalizedText('l', 'en'))
+        self.assertEqual(self.serializer(line), {
+            'Start': {'X': 1.0, 'Y': 2.0, 'Valid': 1},
+            'End': {'X': 3.0, 'Y': 4.0, 'Valid': 0},
+            'Name': {'Locale': 'en', 'Text': 'l'},
+        })
+        self.assertIn(Line, self.serializer._converters)
+
+    def test_arrays(self):
+        values = [1.0, 2.0, 3.0]
+        self.assertIs(self.serializer(values), values)
+        self.assertEqual(self.serializer((1, 2)), [1, 2])
+        self.assertEqual(self.serializer([True, 1]), [1, 1])
+        self.assertEqual(self.serializer([Point(1.0, 2.0)]), [{'X': 1.0, 'Y': 2.0, 'Valid': 1}])
+        self.assertEqual(self.serializer(FakeArray([1.0, 2.0])), [1.0, 2.0])
+
+    def test_ua_types(self):
+        self.assertEqual(self.serializer(b'\x00\x01'), 'AAE=')
+        self.assertEqual(self.serializer(ua.NodeId(1, 2)), 'ns=2;i=1')
+        self.assertEqual(self.serializer(ua.StatusCode(ua.StatusCodes.Good)), 0)
+        self.assertEqual(self.serializer(ua.NodeClass.Variable), 2)
+        self.assertEqual(self.serializer(ua.Variant(5, ua.VariantType.Int32)), 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,91 @@
+# Copyright (C) 2022 Robin Jespersen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import tempfile
+import time
+import unittest
+
+from sharding import HashRing, Shard, worker_names
+
+
+class TestHashRing(unittest.TestCase):
+
+    def test_owner(self):
+        ring = HashRing(frozenset(['a', 'b', 'c']))
+        owners = [ring.owner(str(i)) for i in range(3000)]
+        for member in ['a', 'b', 'c']:
+            self.assertGreater(owners.count(member), 500)
+        self.assertIsNone(HashRing(frozenset()).owner('1'))
+
+    def test_join_moves_only_keys_of_new_member(self):
+        before = HashRing(frozenset(['a', 'b', 'c']))
+        after = HashRing(frozenset(['a', 'b', 'c', 'd']))
+        for i in range(1000):
+            if after.owner(str(i)) != 'd':
+                self.assertEqual(after.owner(str(i)), before.owner(str(i)))
+
+
+class TestShard(unittest.TestCase):
+
+    def test_static_members(self):
+        members = ['worker-0', 'worker-1', 'worker-2']
+        owned = [Shard(name, members).owns(list(range(100))) for name in members]
+        self.assertEqual(sorted(sum(owned, [])), list(range(100)))
+
+    def test_directory_members(self):
+        with tempfile.TemporaryDirectory() as directory:
+            a = Shard('a', directory=directory, ttl=10, settle=0.2)
+            b = Shard('b', directory=directory, ttl=10, settle=0.2)
+            a.heartbeat()
+            # a member owns servers only once it was a member for settle seconds
+            self.assertEqual(a.owns(list(range(10))), [])
+            time.sleep(0.3)
+            self.assertEqual(a.owns(list(range(10))), list(range(10)))
+
+            b.heartbeat()
+            self.assertEqual(a.members_at(time.time()), {'a', 'b'})
+            # until b settled, a only keeps servers it owns in both rings and b owns nothing
+            self.assertEqual(b.owns(list(range(10))), [])
+            kept = a.owns(list(range(10)))
+            time.sleep(0.3)
+            self.assertEqual(a.owns(list(range(10))), kept)
+            self.assertEqual(sorted(kept + b.owns(list(range(10)))), list(range(10)))
+
+            b.leave()
+            self.assertEqual(a.members_at(time.time()), {'a'})
+
+    def test_stale_member_rejoins(self):
+        with tempfile.TemporaryDirectory() as directory:
+            a = Shard('a', directory=directory, ttl=1, settle=1)
+            a.heartbeat()
+            path = os.path.join(directory, 'a')
+            os.utime(path, (time.time() - 10, time.time() - 10))
+            self.assertEqual(a.members_at(time.time()), set())
+            a.heartbeat()
+            self.assertEqual(a.members_at(time.time()), {'a'})
+            self.assertEqual(a.members_at(time.time() - 0.5), set())
+
+
+class TestWorkers(unittest.TestCase):
+
+    def test_worker_names(self):
+        self.assertEqual(worker_names('a', 2), ['a-worker-0', 'a-worker-1'])
+        # the workers of two replicas sharing a directory are distinct members
+        self.assertFalse(set(worker_names('a', 2)) & set(worker_names('b', 2)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,181 @@
+# Copyright (C) 2022 Robin Jespersen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import tempfile
+import unittest
+
+from async_backend import BackendResponse
+from ingest import IngestQueue
+from models.sample import Sample
+from spool import Spool
+
+
+def samples(start: int, stop: int):
+    return [Sample(1, 'ns=2;i=1', i, {'v': i}) for i in range(start, stop)]
+
+
+class TestSpool(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_read_commit(self):
+        spool = Spool(self.directory.name, segment_size=100)
+        spool.append(samples(0, 5))
+        spool.append(samples(5, 10))
+        self.assertGreater(len(spool), 1)
+
+        read = []
+        while not spool.empty:
+            batch, position = spool.read(3)
+            read += batch
+            spool.commit(position)
+        self.assertEqual(read, samples(0, 10))
+        self.assertEqual(len(spool), 0)
+
+    def test_resume(self):
+        spool = Spool(self.directory.name)
+        spool.append(samples(0, 4))
+        batch, position = spool.read(2)
+        spool.commit(position)
+        spool.close()
+
+        spool = Spool(self.directory.name)
+        batch, position = spool.read(10)
+        self.assertEqual(batch, samples(2, 4))
+
+    def test_skip_corrupt_lines(self):
+        spool = Spool(self.directory.name)
+        spool.append(samples(0, 2))
+        spool.close()
+        # a corrupt line and one written partly before a crash
+        with open(spool._path(1), 'a') as f:
+            f.write('{"v": 1}\n[1,"ns=2;i=1",2,{"v"')
+
+        spool = Spool(self.directory.name)
+        spool.append(samples(2, 3))
+        read = []
+        while not spool.empty:
+            batch, position = spool.read(10)
+            read += batch
+            spool.commit(position)
+        self.assertEqual(read, samples(0, 3))
+        self.assertEqual(spool.skipped_lines, 2)
+        self.assertEqual(len(spool), 0)
+
+    def test_max_bytes(self):
+        spool = Spool(self.directory.name, segment_size=50, max_bytes=200)
+        for i in range(20):
+            spool.append(samples(i, i + 1))
+        self.assertLessEqual(spool.size, 200 + 50)
+        self.assertGreater(spool.dropped_segments, 0)
+        read = []
+        while not spool.empty:
+            batch, position = spool.read(100)
+            read += batch
+            spool.commit(position)
+        self.assertEqual(read[-1], samples(19, 20)[0])
+
+    def test_retention(self):
+        spool = Spool(self.directory.name, segment_size=10, retention=-1)
+        spool.append(samples(0, 1))
+        spool.append(samples(1, 2))
+        self.assertEqual(len(spool), 1)
+
+
+class FlakyBackend:
+    def __init__(self):
+        self.available = False
+        self.stored = []
+
+    async def influx_store_batch(self, batch):
+        if not self.available:
+            return BackendResponse(503, '')
+        self.stored += batch
+        return BackendResponse(200, '')
+
+
+class TestIngestQueueSpool(unittest.IsolatedAsyncioTestCase):
+
+    async def test_replay_in_order(self):
+        with tempfile.TemporaryDirectory() as directory:
+            backend = FlakyBackend()
+            ingest = IngestQueue(backend, max_batch_size=2, spool=Spool(directory))
+            ingest.start()
+            for sample in samples(0, 5):
+                await ingest.put(sample)
+            await ingest.close()
+            self.assertEqual(ingest.spooled, 5)
+            self.assertEqual(backend.stored, [])
+
+            backend.available = True
+            ingest = IngestQueue(backend, max_batch_size=2, spool=Spool(directory))
+            ingest.start()
+            for sample in samples(5, 7):
+                await ingest.put(sample)
+            await ingest.close()
+            self.assertEqual(backend.stored, samples(0, 7))
+
+    async def test_replay_partial_line(self):
+        with tempfile.TemporaryDirectory() as directory:
+            spool = Spool(directory)
+            spool.append(samples(0, 2))
+            spool.close()
+            with open(spool._path(1), 'a') as f:
+                f.write('[1,"ns=2;i=1",2,{"v"')
+
+            backend = FlakyBackend()
+            backend.available = True
+            ingest = IngestQueue(backend, max_batch_size=10, spool=Spool(directory))
+            ingest.start()
+            await ingest.put(samples(2, 3)[0])
+            await asyncio.wait_for(ingest.close(), 1)
+            self.assertEqual(backend.stored, samples(0, 3))
+
+    async def test_rejected_batch_is_dropped(self):
+        with tempfile.TemporaryDirectory() as directory:
+            backend = FlakyBackend()
+            backend.available = True
+            store = backend.influx_store_batch
+            responses = [BackendResponse(400, 'invalid'), BackendResponse(503, '')]
+
+            async def influx_store_batch(batch):
+                return responses.pop(0) if responses else await store(batch)
+            backend.influx_store_batch = influx_store_batch
+
+            ingest = IngestQueue(backend, max_batch_size=2, spool=Spool(directory))
+            ingest.start()
+            for i in range(0, 6, 2):
+                for sample in samples(i, i + 2):
+                    await ingest.put(sample)
+                await asyncio.sleep(0.01)
+            await asyncio.wait_for(ingest.close(), 1)
+            # the second batch failed with a server error and is replayed from the spool
+            self.assertEqual(ingest.rejected, 2)
+            self.assertEqual(ingest.spooled, 2)
+
+            ingest = IngestQueue(backend, max_batch_size=2, spool=Spool(directory))
+            ingest.start()
+            await ingest.put(samples(6, 7)[0])
+            await asyncio.wait_for(ingest.close(), 1)
+            self.assertEqual(backend.stored, samples(2, 7))
+
+
+if __name__ == '__main__':
+    unittest.main()
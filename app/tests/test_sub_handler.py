@@ -0,0 +1,102 @@
+# Copyright (C) 2022 Robin Jespersen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import datetime
+import unittest
+from dataclasses import make_dataclass
+from types import SimpleNamespace
+
+from asyncua import ua
+
+from encoder import KINDS, EncoderPool, _portable
+from sub_handler import SubHandler
+
+
+class RecordingIngest:
+    def __init__(self):
+        self.samples = []
+
+    async def put(self, sample):
+        self.samples.append(sample)
+
+
+def notification(value: ua.DataValue):
+    return SimpleNamespace(monitored_item=SimpleNamespace(Value=value))
+
+
+class TestSubHandler(unittest.IsolatedAsyncioTestCase):
+
+    async def test_timestamps_and_status(self):
+        source = datetime.datetime(2022, 1, 1, 0, 0, 0, 123456, tzinfo=datetime.timezone.utc)
+        server = datetime.datetime(2022, 1, 1, 0, 0, 1, tzinfo=datetime.timezone.utc)
+        value = ua.DataValue(
+            ua.Variant(1.5),
+            StatusCode=ua.StatusCode(ua.StatusCodes.UncertainLastUsableValue),
+            SourceTimestamp=source,
+            ServerTimestamp=server,
+        )
+        node = SimpleNamespace(nodeid=ua.NodeId(1, 2))
+
+        ingest = RecordingIngest()
+        handler = SubHandler(1, None, ingest)
+        await handler.datachange_notification(node, 1.5, notification(value))
+        await handler.close()
+        handler = SubHandler(1, None, ingest, timestamp_source='source')
+        await handler.datachange_notification(node, 1.5, notification(value))
+        await handler.flush()
+        self.assertEqual([s.time for s in ingest.samples], [1640995201000000000, 1640995200123456000])
+        self.assertEqual(ingest.samples[0].status, ua.StatusCodes.UncertainLastUsableValue)
+
+        # the other timestamp is used if one is missing
+        value.SourceTimestamp = None
+        await handler.datachange_notification(node, 1.5, notification(value))
+        await handler.close()
+        self.assertEqual(ingest.samples[2].time, 1640995201000000000)
+
+    async def test_callback_only_queues(self):
+        ingest = RecordingIngest()
+        handler = SubHandler(1, None, ingest, batch_size=10, max_pending=50)
+        node = SimpleNamespace(nodeid=ua.NodeId(1, 2))
+        for i in range(60):
+            await handler.datachange_notification(node, i, notification(ua.DataValue(ua.Variant(i))))
+        self.assertEqual(ingest.samples, [])
+        self.assertEqual(handler.dropped, 10)
+        await handler.close()
+        self.assertEqual([s.value for s in ingest.samples], list(range(50)))
+
+    async def test_workers_keep_order(self):
+        for kind in KINDS:
+            encoder = EncoderPool(2, kind)
+            try:
+                handlers = [SubHandler(i, None, RecordingIngest(), encoder=encoder, batch_size=7) for i in range(3)]
+                for i in range(100):
+                    for handler in handlers:
+                        await handler.store('ns=2;i=1', i, ua.DataValue(ua.Variant([float(i), 0.5])))
+                for handler in handlers:
+                    await handler.close()
+                    self.assertEqual([s.value[0] for s in handler.ingest.samples], list(range(100)))
+                    self.assertEqual({s.server_id for s in handler.ingest.samples}, {handler.server_id})
+            finally:
+                encoder.close()
+
+    def test_portable(self):
+        self.assertTrue(_portable([1.5]))
+        self.assertTrue(_portable(ua.LocalizedText('a')))
+        # structures generated for a server are unknown to worker processes
+        self.assertFalse(_portable([make_dataclass('Generated', ['a'])(1)]))
+
+
+if __name__ == '__main__':
+    unittest.main()
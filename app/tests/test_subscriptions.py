@@ -0,0 +1,86 @@
+# Copyright (C) 2022 Robin Jespersen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+
+import asyncua
+
+from monitored_items import MonitoringSettings
+from subscriptions import Subscriptions
+from tests.helpers import make_node, start_opcua_server
+
+
+class Handler:
+    def datachange_notification(self, node, value, data):
+        pass
+
+
+class TestMonitoringSettings(unittest.TestCase):
+
+    def test_of(self):
+        defaults = MonitoringSettings(publishing_interval=500, deadband_type='absolute', deadband_value=1)
+        settings = defaults.of(make_node(1, 1, 'i=1', queue_size=10, deadband_value=0.5))
+        self.assertEqual(settings, MonitoringSettings(500, 50, 10, 'absolute', 0.5))
+        self.assertEqual(settings.filter().DeadbandValue, 0.5)
+        self.assertIsNone(MonitoringSettings().filter())
+
+
+class TestSubscriptions(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.server, url, self.variables = await start_opcua_server(4)
+        self.client = asyncua.Client(url)
+        await self.client.connect()
+
+    async def asyncTearDown(self):
+        await self.client.disconnect()
+        await self.server.stop()
+
+    async def test_groups(self):
+        subscriptions = Subscriptions(self.client, Handler(), defaults=MonitoringSettings(publishing_interval=500))
+        identifiers = [v.nodeid.to_string() for v in self.variables]
+        nodes = {
+            0: make_node(0, 1, identifiers[0]),
+            1: make_node(1, 1, identifiers[1], publishing_interval=100),
+            2: make_node(2, 1, identifiers[2], publishing_interval=100, deadband_type='absolute', deadband_value=1),
+            3: make_node(3, 1, identifiers[3], deadband_type='unknown'),
+        }
+        errors = await subscriptions.apply(nodes)
+        self.assertEqual(set(errors), {3})
+        self.assertEqual(set(subscriptions.groups), {100, 500})
+        self.assertEqual(set(subscriptions.groups[100].handles), {1, 2})
+        self.assertEqual(set(subscriptions.groups[500].handles), {0})
+        self.assertEqual(len(subscriptions), 3)
+
+        # a changed publishing interval moves the node, the emptied subscription is deleted
+        errors = await subscriptions.update({
+            0: make_node(0, 1, identifiers[0], publishing_interval=100),
+            3: None,
+        })
+        self.assertEqual(errors, {})
+        self.assertEqual(set(subscriptions.groups), {100})
+        self.assertEqual(set(subscriptions.groups[100].handles), {0, 1, 2})
+
+        # changed monitoring settings subscribe the node again
+        handle = subscriptions.groups[100].handles[1]
+        await subscriptions.update({1: make_node(1, 1, identifiers[1], publishing_interval=100, queue_size=5)})
+        self.assertNotEqual(subscriptions.groups[100].handles[1], handle)
+
+        await subscriptions.apply({})
+        self.assertEqual(subscriptions.groups, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+# Copyright (C) 2022 Robin Jespersen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import asyncua
+from asyncua import ua
+from asyncua.common.structures104 import new_enum, new_struct, new_struct_field
+
+import type_cache
+from type_cache import TypeCache, parse_node_id
+from tests.helpers import start_opcua_server
+
+
+class TestParseNodeId(unittest.TestCase):
+
+    def test_parse(self):
+        self.assertEqual(parse_node_id('ns=2;s=a'), ua.NodeId('a', 2))
+        self.assertIs(parse_node_id('ns=2;s=a'), parse_node_id('ns=2;s=a'))
+
+
+class TestTypeCache(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.server, self.url, _ = await start_opcua_server(0)
+        self.client = asyncua.Client(self.url)
+        await self.client.connect()
+        self.directory = tempfile.TemporaryDirectory()
+
+    async def asyncTearDown(self):
+        await self.client.disconnect()
+        await self.server.stop()
+        self.directory.cleanup()
+
+    async def test_registers_server_types(self):
+        idx = await self.server.get_namespace_index('urn:opcua_collector:test')
+        data_type, _ = await new_struct(self.server, idx, 'TypeCacheStruct', [
+            new_struct_field('Number', ua.VariantType.Int32),
+            new_struct_field('Text', ua.VariantType.String),
+        ])
+        await new_enum(self.server, idx, 'TypeCacheEnum', ['Off', 'On'])
+        self.assertFalse(hasattr(ua, 'TypeCacheStruct'))
+
+        cache = TypeCache(self.directory.name)
+        key = await cache.load(self.client, self.url)
+        self.assertEqual(ua.TypeCacheStruct.data_type, data_type.nodeid)
+        self.assertEqual(ua.TypeCacheEnum.On, 1)
+        self.assertEqual(len(os.listdir(self.directory.name)), 1)
+
+        # the generated class encodes and decodes values
+        variable = await self.server.nodes.objects.add_variable(
+            idx, 'TypeCacheValue', ua.Variant(ua.TypeCacheStruct(1, 'a'), ua.VariantType.ExtensionObject),
+            datatype=data_type.nodeid,
+        )
+        value = await self.client.get_node(variable.nodeid).read_value()
+        self.assertEqual(value, ua.TypeCacheStruct(1, 'a'))
+
+        # a restarted collector reads the types from disk
+        with mock.patch.object(type_cache, 'collect', side_effect=AssertionError) as collect:
+            self.assertEqual(await TypeCache(self.directory.name).load(self.client, self.url), key)
+        collect.assert_not_called()
+
+    async def test_key_changes_with_the_model(self):
+        cache = TypeCache(self.directory.name)
+        key = await cache.load(self.client, self.url)
+        with mock.patch.object(type_cache, 'collect', wraps=type_cache.collect) as collect:
+            self.assertEqual(await cache.load(self.client, self.url), key)
+            self.assertEqual(await TypeCache(self.directory.name).load(self.client, self.url), key)
+            self.assertEqual(collect.call_count, 0)
+            await self.server.register_namespace('urn:opcua_collector:other')
+            self.assertNotEqual(await cache.load(self.client, self.url), key)
+            self.assertEqual(collect.call_count, 1)
+            await TypeCache(self.directory.name, max_age=0).load(self.client, self.url)
+            self.assertEqual(collect.call_count, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
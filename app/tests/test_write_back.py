@@ -0,0 +1,106 @@
+# Copyright (C) 2022 Robin Jespersen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+
+import asyncua
+
+from tests.helpers import make_node, start_opcua_server
+from write_back import WriteBack
+
+
+class FakeBackend:
+    def __init__(self):
+        self.nodes = []
+        self.requests = 0
+        self.updates = []
+        self.failing = False
+
+    async def node_index_requiring_update_changed(self):
+        self.requests += 1
+        return self.nodes
+
+    async def node_update_batch(self, updates):
+        self.updates.append(updates)
+        return [] if self.failing else list(updates)
+
+
+class FakeConnection:
+    def __init__(self, client):
+        self.client = client
+        self.limits = {'MaxNodesPerWrite': 2}
+
+
+class FakeConnections:
+    def __init__(self, connections):
+        self.connections = connections
+
+    def connected(self):
+        return self.connections
+
+
+class TestWriteBack(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.server, url, self.variables = await start_opcua_server(3)
+        self.client = asyncua.Client(url)
+        await self.client.connect()
+
+    async def asyncTearDown(self):
+        await self.client.disconnect()
+        await self.server.stop()
+
+    async def test_run_once(self):
+        backend = FakeBackend()
+        write_back = WriteBack(backend, FakeConnections({1: FakeConnection(self.client)}))
+        backend.nodes = [make_node(i, 1, v.nodeid.to_string(), change_value=i + 0.5) for i, v in enumerate(self.variables)]
+        backend.nodes.append(make_node(3, 1, 'not a node id', change_value=1.0))
+        backend.nodes.append(make_node(4, 1, 'ns=2;i=999999', change_value=1.0))
+        backend.nodes.append(make_node(5, 2, 'ns=2;i=1', change_value=1.0))
+
+        await write_back.run_once()
+        self.assertEqual(len(backend.updates), 1)
+        updates = backend.updates[0]
+        self.assertEqual(set(updates), {0, 1, 2, 3, 4})
+        self.assertEqual(updates[0], {'change_value': None, 'change_error_at': None, 'change_error': None})
+        self.assertIn('Bad', updates[4]['change_error'])
+        self.assertIn('change_error', updates[3])
+        self.assertEqual([await v.read_value() for v in self.variables], [0.5, 1.5, 2.5])
+        self.assertEqual((write_back.written, write_back.errors), (3, 2))
+
+        # the node of the server that is not connected stays pending while the listing is unchanged
+        backend.nodes = None
+        await write_back.run_once()
+        self.assertEqual([node.id for node in write_back.pending], [5])
+        self.assertEqual(len(backend.updates), 1)
+
+    async def test_unacknowledged_stay_pending(self):
+        backend = FakeBackend()
+        write_back = WriteBack(backend, FakeConnections({1: FakeConnection(self.client)}))
+        backend.nodes = [make_node(0, 1, self.variables[0].nodeid.to_string(), change_value=0.5)]
+        backend.failing = True
+        await write_back.run_once()
+        self.assertEqual([node.id for node in write_back.pending], [0])
+
+        # the listing did not change, the value is written and acknowledged again
+        backend.nodes = None
+        backend.failing = False
+        await write_back.run_once()
+        self.assertEqual(len(backend.updates), 2)
+        self.assertEqual(write_back.pending, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
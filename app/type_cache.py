@@ -0,0 +1,226 @@
+# Copyright (C) 2022 Robin Jespersen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import base64
+import functools
+import hashlib
+import json
+import os
+import time
+from typing import Any, Dict, List, Optional
+
+import asyncua
+from asyncua import ua
+# RecursiveParser, _generate_object and _topological_sort_dtypes are not public
+# API of asyncua, requirements.txt pins the major version they are used with
+from asyncua.common.structures104 import (
+    RecursiveParser,
+    _generate_object,
+    _topological_sort_dtypes,
+    clean_name,
+    get_children_descriptions_type_definitions,
+    make_basetype,
+)
+from asyncua.common.utils import Buffer
+from asyncua.ua.ua_binary import struct_from_binary, struct_to_binary
+
+
+@functools.lru_cache(maxsize=2 ** 17)
+def parse_node_id(identifier: str) -> ua.NodeId:
+    """
+    parses the identifier of a node, the result is shared and must not be changed
+    """
+    return ua.NodeId.from_string(identifier)
+
+
+class TypeCache:
+    """
+    Data type definitions of OPC UA servers, stored in directory with one file per server url.
+
+    The definitions are keyed by a hash of the namespace array and the build info
+    of the server, they are read from the server again when either changes or the
+    file is older than max_age seconds. The python classes generated from the
+    definitions are registered globally in asyncua.ua, once registered for a key
+    they are only registered again when the key changes. Without a directory the
+    definitions are only kept while the process runs.
+    """
+
+    def __init__(self, directory: Optional[str] = None, max_age: float = 24 * 60 * 60):
+        self.directory = directory
+        self.max_age = max_age
+
+        # the key the types of each url were registered for
+        self.registered: Dict[str, str] = {}
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    async def load(self, client: asyncua.Client, url: str) -> str:
+        """
+        registers the data types of the server the client is connected to, returns their key
+        """
+        key = await self.key(client)
+        if self.registered.get(url) == key:
+            return key
+        types = self._read(url, key)
+        if types is None:
+            types = await collect(client)
+            self._write(url, key, types)
+        register(types)
+        self.registered[url] = key
+        return key
+
+    @staticmethod
+    async def key(client: asyncua.Client) -> str:
+        namespaces, build_info = await client.read_values([
+            client.get_node(ua.ObjectIds.Server_NamespaceArray),
+            client.get_node(ua.ObjectIds.Server_ServerStatus_BuildInfo),
+        ])
+        return hashlib.sha256(json.dumps([namespaces, str(build_info)]).encode()).hexdigest()
+
+    def _path(self, url: str) -> str:
+        return os.path.join(self.directory, hashlib.sha256(url.encode()).hexdigest()[:32] + '.json')
+
+    def _read(self, url: str, key: str) -> Optional[Dict[str, List[Any]]]:
+        if self.directory is None:
+            return None
+        try:
+            with open(self._path(url)) as f:
+                cached = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as error:
+            print(f'could not read data types of {url}: {error!r}')
+            return None
+        if cached.get('key') != key or cached.get('created_at', 0) < time.time() - self.max_age:
+            return None
+        return cached['types']
+
+    def _write(self, url: str, key: str, types: Dict[str, List[Any]]):
+        if self.directory is None:
+            return
+        path = self._path(url)
+        try:
+            with open(path + '.tmp', 'w') as f:
+                json.dump({'url': url, 'key': key, 'created_at': time.time(), 'types': types}, f)
+            os.replace(path + '.tmp', path)
+        except OSError as error:
+            print(f'could not write data types of {url}: {error!r}')
+
+
+def _encode(definition: Any) -> List[str]:
+    return [type(definition).__name__, base64.b64encode(struct_to_binary(definition)).decode()]
+
+
+def _decode(encoded: List[str]) -> Any:
+    return struct_from_binary(getattr(ua, encoded[0]), Buffer(base64.b64decode(encoded[1])))
+
+
+async def collect(client: asyncua.Client) -> Dict[str, List[Any]]:
+    """
+    reads the data type definitions of the server like asyncua's load_data_type_definitions(),
+    the result is json serializable and registered with register()
+    """
+    aliases: List[Any] = []
+
+    async def collect_aliases(node: asyncua.Node, parent: str):
+        descriptions = await node.get_children_descriptions(refs=ua.ObjectIds.HasSubtype)
+        # parents are listed before their children
+        for description in descriptions:
+            if parent != 'Number':
+                aliases.append([clean_name(description.BrowseName.Name), description.NodeId.to_string(), parent])
+        await asyncio.gather(*[
+            collect_aliases(client.get_node(d.NodeId), clean_name(d.BrowseName.Name)) for d in descriptions
+        ])
+
+    for description in await client.nodes.base_data_type.get_children_descriptions():
+        name = clean_name(description.BrowseName.Name)
+        if name not in ['Structure', 'Enumeration']:
+            await collect_aliases(client.get_node(description.NodeId), name)
+
+    enums: List[Any] = []
+    for option_set, base_node in [(False, client.nodes.enum_data_type), (True, client.nodes.option_set_type)]:
+        descriptions, definitions = await get_children_descriptions_type_definitions(client, base_node, True)
+        for description, definition in zip(descriptions, definitions):
+            if definition:
+                enums.append([
+                    clean_name(description.BrowseName.Name),
+                    description.NodeId.to_string(),
+                    option_set,
+                    _encode(definition),
+                ])
+
+    structures = [
+        [info.name, info.data_type.to_string(), _encode(info.sdef)]
+        for info in _topological_sort_dtypes(
+            await RecursiveParser(client).parse(client.nodes.base_structure_type, overwrite_existing=True)
+        )
+    ]
+    return {'aliases': aliases, 'enums': enums, 'structures': structures}
+
+
+def _registered(name: str, data_type: ua.NodeId) -> bool:
+    existing = getattr(ua, name, None)
+    return existing is not None and getattr(existing, 'data_type', None) == data_type
+
+
+def register(types: Dict[str, List[Any]]):
+    """
+    generates and registers the classes of the data types from collect() that are not registered yet
+    """
+    for name, node_id, parent in types['aliases']:
+        if not hasattr(ua, name):
+            ua.register_basetype(name, parse_node_id(node_id), make_basetype(name, parent)[name])
+    for name, node_id, option_set, definition in types['enums']:
+        _register_enum(name, parse_node_id(node_id), option_set, definition)
+    structures = types['structures']
+    # a structure may depend on one that could only be generated later, those are retried
+    for attempt in range(3):
+        structures = [
+            structure for structure in structures if not _register_structure(*structure, log_fail=attempt == 2)
+        ]
+        if not structures:
+            break
+
+
+def _register_enum(name: str, data_type: ua.NodeId, option_set: bool, definition: Any):
+    if _registered(name, data_type):
+        return
+    try:
+        cls = _generate_object(name, _decode(definition), enum=True, option_set=option_set, log_fail=False)[name]
+    except Exception as error:
+        print(f'could not generate enum {name}: {error!r}')
+        return
+    ua.register_enum(name, data_type, cls)
+
+
+def _register_structure(name: str, node_id: str, definition: Any, log_fail: bool) -> bool:
+    """
+    returns False if the structure could not be generated and is to be retried
+    """
+    data_type = parse_node_id(node_id)
+    if _registered(name, data_type):
+        return True
+    sdef = _decode(definition)
+    try:
+        cls = _generate_object(name, sdef, data_type=data_type, log_fail=log_fail)[name]
+    except NotImplementedError:
+        print(f'structure {name} not implemented')
+        return True
+    except (AttributeError, RuntimeError, KeyError, TypeError, ValueError):
+        return False
+    cls.data_type = data_type
+    ua.register_extension_object(name, sdef.DefaultEncodingId, cls, data_type)
+    return True
@@ -0,0 +1,146 @@
+# Copyright (C) 2022 Robin Jespersen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import time
+from typing import Dict, List, Optional
+
+import aiohttp
+from asyncua import ua
+from asyncua.ua import UaError, UaStatusCodeError
+
+from async_backend import AsyncBackend
+from connection import ConnectionManager, ServerConnection
+from models.node import Node as NodeModel
+from operation_limits import chunks
+from type_cache import parse_node_id
+
+
+class WriteBack:
+    """
+    Writes the change_value of nodes to their OPC UA server.
+
+    The list of nodes requiring an update is requested every interval seconds,
+    the request is conditional and cheap while there is nothing to do, unless
+    the API does not send an ETag or listings are paged. Pending
+    values of a server are written with one Write call per MaxNodesPerWrite
+    nodes and the results are acknowledged with one batch update.
+    """
+
+    def __init__(self, backend: AsyncBackend, connections: ConnectionManager, interval: float = 5):
+        self.backend = backend
+        self.connections = connections
+        self.interval = interval
+
+        # last listing, reused while the API answers with 304 Not Modified
+        self.pending: List[NodeModel] = []
+        self.written: int = 0
+        self.errors: int = 0
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                await self.run_once()
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as error:
+                print(f'could not write back node values: {error!r}')
+            await asyncio.sleep(self.interval)
+
+    async def run_once(self):
+        nodes = await self.backend.node_index_requiring_update_changed()
+        if nodes is not None:
+            self.pending = nodes
+        if not self.pending:
+            return
+        connected = self.connections.connected()
+        server_nodes: Dict[int, List[NodeModel]] = {}
+        for node in self.pending:
+            # nodes of servers that are not connected wait for the connection
+            if node.server_id in connected:
+                server_nodes.setdefault(node.server_id, []).append(node)
+        if not server_nodes:
+            return
+        results = await asyncio.gather(*[
+            self.write(connected[server_id], nodes) for server_id, nodes in server_nodes.items()
+        ])
+        updates: Dict[int, dict] = {}
+        for result in results:
+            updates.update(result)
+        if not updates:
+            return
+        # nodes whose results were not acknowledged stay pending and are written again
+        acknowledged = set(await self.backend.node_update_batch(updates))
+        if len(acknowledged) < len(updates):
+            print(f'could not acknowledge {len(updates) - len(acknowledged)} written node values')
+        self.pending = [node for node in self.pending if node.id not in acknowledged]
+
+    async def write(self, connection: ServerConnection, nodes: List[NodeModel]) -> Dict[int, dict]:
+        """
+        writes the values of the nodes, returns the node updates acknowledging the results
+        """
+        updates: Dict[int, dict] = {}
+        parsed = []
+        for node in nodes:
+            try:
+                parsed.append((node, connection.client.get_node(parse_node_id(node.identifier))))
+            except (UaError, ValueError) as error:
+                updates[node.id] = self._error(str(error))
+        for chunk in chunks(parsed, connection.limits.get('MaxNodesPerWrite', 0)):
+            try:
+                results = await connection.client.write_values(
+                    [ua_node for _, ua_node in chunk],
+                    [node.change_value for node, _ in chunk],
+                    raise_on_partial_error=False,
+                )
+            except (OSError, asyncio.TimeoutError):
+                # the connection is lost, the values are written after reconnecting
+                continue
+            except Exception as exception:
+                results = [exception] * len(chunk)
+            for (node, _), result in zip(chunk, results):
+                updates[node.id] = self._result(result)
+        return updates
+
+    def _result(self, result) -> dict:
+        """
+        the node update acknowledging the status code or exception of a write
+        """
+        if isinstance(result, ua.StatusCode) and result.is_good():
+            self.written += 1
+            return {
+                'change_value': None,
+                'change_error_at': None,
+                'change_error': None,
+            }
+        if isinstance(result, ua.StatusCode):
+            return self._error(str(UaStatusCodeError(result.value)))
+        return self._error(str(result))
+
+    def _error(self, error: str) -> dict:
+        self.errors += 1
+        return {
+            'change_error_at': round(time.time()),
+            'change_error': error,
+        }